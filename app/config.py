@@ -1,37 +1,65 @@
 import os
-from functools import lru_cache
-from pydantic import BaseModel, Field
+import threading
+from typing import Optional
+
+from dotenv import load_dotenv
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class Settings(BaseModel):
-    app_name: str = Field(default=os.getenv("APP_NAME", "otp-service"))
-    environment: str = Field(default=os.getenv("ENVIRONMENT", "dev"))
-    debug: bool = Field(default=os.getenv("DEBUG", "false").lower() in ["1", "true", "yes"])
-    host: str = Field(default=os.getenv("HOST", "0.0.0.0"))
-    port: int = Field(default=int(os.getenv("PORT", "8000")))
+    # Snapshots are shared by every thread, so they must never be mutated in place
+    model_config = ConfigDict(frozen=True)
+
+    app_name: str = Field(default_factory=lambda: os.getenv("APP_NAME", "otp-service"))
+    environment: str = Field(default_factory=lambda: os.getenv("ENVIRONMENT", "dev"))
+    debug: bool = Field(default_factory=lambda: os.getenv("DEBUG", "false").lower() in ["1", "true", "yes"])
+    host: str = Field(default_factory=lambda: os.getenv("HOST", "0.0.0.0"))
+    port: int = Field(default_factory=lambda: int(os.getenv("PORT", "8000")))
 
     # Security
-    admin_username: str = Field(default=os.getenv("ADMIN_USERNAME", "admin"))
-    admin_password: str = Field(default=os.getenv("ADMIN_PASSWORD", "admin"))
-    admin_token: str = Field(default=os.getenv("ADMIN_TOKEN", ""))
-    otp_default_length: int = Field(default=int(os.getenv("OTP_DEFAULT_LENGTH", "6")))
-    otp_default_ttl_seconds: int = Field(default=int(os.getenv("OTP_DEFAULT_TTL_SECONDS", "300")))
-    otp_charset: str = Field(default=os.getenv("OTP_CHARSET", "0123456789"))
-    otp_hash_alg: str = Field(default=os.getenv("OTP_HASH_ALG", "sha256"))
-    otp_pepper: str = Field(default=os.getenv("OTP_PEPPER", "default-pepper-change-me"))
+    admin_username: str = Field(default_factory=lambda: os.getenv("ADMIN_USERNAME", "admin"))
+    admin_password: str = Field(default_factory=lambda: os.getenv("ADMIN_PASSWORD", "admin"))
+    admin_token: str = Field(default_factory=lambda: os.getenv("ADMIN_TOKEN", ""))
+    otp_default_length: int = Field(default_factory=lambda: int(os.getenv("OTP_DEFAULT_LENGTH", "6")))
+    otp_default_ttl_seconds: int = Field(default_factory=lambda: int(os.getenv("OTP_DEFAULT_TTL_SECONDS", "300")))
+    # Wrong codes tolerated per OTP before it is burned (0 = unlimited); requests may set their own
+    otp_max_attempts: int = Field(default_factory=lambda: int(os.getenv("OTP_MAX_ATTEMPTS", "5")))
+    otp_charset: str = Field(default_factory=lambda: os.getenv("OTP_CHARSET", "0123456789"))
+    otp_hash_alg: str = Field(default_factory=lambda: os.getenv("OTP_HASH_ALG", "sha256"))
+    otp_pepper: str = Field(default_factory=lambda: os.getenv("OTP_PEPPER", "default-pepper-change-me"))
+    otp_batch_max_items: int = Field(default_factory=lambda: int(os.getenv("OTP_BATCH_MAX_ITEMS", "1000")))
 
     # Email Configuration
-    smtp_host: str = Field(default=os.getenv("SMTP_HOST", "smtp.gmail.com"))
-    smtp_port: int = Field(default=int(os.getenv("SMTP_PORT", "587")))
-    smtp_username: str = Field(default=os.getenv("SMTP_USERNAME", ""))
-    smtp_password: str = Field(default=os.getenv("SMTP_PASSWORD", ""))
-    smtp_use_tls: bool = Field(default=os.getenv("SMTP_USE_TLS", "true").lower() in ["1", "true", "yes"])
-    email_from: str = Field(default=os.getenv("EMAIL_FROM", "noreply@otp-service.com"))
-    email_from_name: str = Field(default=os.getenv("EMAIL_FROM_NAME", "OTP Service"))
+    smtp_host: str = Field(default_factory=lambda: os.getenv("SMTP_HOST", "smtp.gmail.com"))
+    smtp_port: int = Field(default_factory=lambda: int(os.getenv("SMTP_PORT", "587")))
+    smtp_username: str = Field(default_factory=lambda: os.getenv("SMTP_USERNAME", ""))
+    smtp_password: str = Field(default_factory=lambda: os.getenv("SMTP_PASSWORD", ""))
+    smtp_use_tls: bool = Field(default_factory=lambda: os.getenv("SMTP_USE_TLS", "true").lower() in ["1", "true", "yes"])
+    # Set SMTP_AUTH=false for relays that accept unauthenticated mail (e.g. a local aiosmtpd)
+    smtp_auth: bool = Field(default_factory=lambda: os.getenv("SMTP_AUTH", "true").lower() in ["1", "true", "yes"])
+    smtp_timeout: float = Field(default_factory=lambda: float(os.getenv("SMTP_TIMEOUT", "10")))
+    smtp_idle_seconds: float = Field(default_factory=lambda: float(os.getenv("SMTP_IDLE_SECONDS", "60")))
+    # Many servers cap messages per connection; sessions reconnect after this many
+    smtp_max_messages_per_connection: int = Field(
+        default_factory=lambda: int(os.getenv("SMTP_MAX_MESSAGES_PER_CONNECTION", "100")))
+    email_from: str = Field(default_factory=lambda: os.getenv("EMAIL_FROM", "noreply@otp-service.com"))
+    email_from_name: str = Field(default_factory=lambda: os.getenv("EMAIL_FROM_NAME", "OTP Service"))
+    # Default language of OTP emails (en, fr); requests may override it with "locale"
+    email_default_locale: str = Field(default_factory=lambda: os.getenv("EMAIL_DEFAULT_LOCALE", "en"))
+
+    # Background email delivery
+    email_workers: int = Field(default_factory=lambda: int(os.getenv("EMAIL_WORKERS", "2")))
+    email_queue_size: int = Field(default_factory=lambda: int(os.getenv("EMAIL_QUEUE_SIZE", "1000")))
+    email_max_retries: int = Field(default_factory=lambda: int(os.getenv("EMAIL_MAX_RETRIES", "3")))
+    email_retry_backoff_seconds: float = Field(
+        default_factory=lambda: float(os.getenv("EMAIL_RETRY_BACKOFF_SECONDS", "1.0")))
+    email_status_ttl_seconds: int = Field(default_factory=lambda: int(os.getenv("EMAIL_STATUS_TTL_SECONDS", "3600")))
+    # Parallel SMTP sessions used by EmailService.send_bulk
+    email_bulk_sessions: int = Field(default_factory=lambda: int(os.getenv("EMAIL_BULK_SESSIONS", "4")))
 
     # OTP Email Settings
-    organization_name: str = Field(default=os.getenv("ORGANIZATION_NAME", "OTP Service"))
-    email_subject_template: str = Field(default=os.getenv("EMAIL_SUBJECT_TEMPLATE", "Your OTP Code - {organization}"))
+    organization_name: str = Field(default_factory=lambda: os.getenv("ORGANIZATION_NAME", "OTP Service"))
+    email_subject_template: str = Field(default_factory=lambda: os.getenv("EMAIL_SUBJECT_TEMPLATE", "Your OTP Code - {organization}"))
 
     # Spam Protection
     spam_keywords: list = Field(
@@ -40,18 +68,87 @@ class Settings(BaseModel):
         default_factory=lambda: os.getenv("ALLOWED_DOMAINS", "").split(",") if os.getenv("ALLOWED_DOMAINS") else [])
 
     # Redis
-    redis_url: str = Field(default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
-    redis_namespace: str = Field(default=os.getenv("REDIS_NAMESPACE", "otp"))
+    redis_url: str = Field(default_factory=lambda: os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    redis_namespace: str = Field(default_factory=lambda: os.getenv("REDIS_NAMESPACE", "otp"))
+    redis_max_connections: int = Field(default_factory=lambda: int(os.getenv("REDIS_MAX_CONNECTIONS", "50")))
+    redis_socket_timeout: float = Field(default_factory=lambda: float(os.getenv("REDIS_SOCKET_TIMEOUT", "2.0")))
+    redis_connect_timeout: float = Field(default_factory=lambda: float(os.getenv("REDIS_CONNECT_TIMEOUT", "2.0")))
+    redis_socket_keepalive: bool = Field(
+        default_factory=lambda: os.getenv("REDIS_SOCKET_KEEPALIVE", "true").lower() in ["1", "true", "yes"])
+    redis_heartbeat_seconds: float = Field(default_factory=lambda: float(os.getenv("REDIS_HEARTBEAT_SECONDS", "5")))
+    redis_recovery_max_backoff_seconds: float = Field(
+        default_factory=lambda: float(os.getenv("REDIS_RECOVERY_MAX_BACKOFF_SECONDS", "30")))
+
+    # How often the background sampler refreshes CPU/memory/connection stats for /api/v1/metrics
+    metrics_sample_seconds: float = Field(default_factory=lambda: float(os.getenv("METRICS_SAMPLE_SECONDS", "5")))
+    # Background purge of expired index entries
+    purge_interval_seconds: float = Field(default_factory=lambda: float(os.getenv("PURGE_INTERVAL_SECONDS", "60")))
+    purge_batch_size: int = Field(default_factory=lambda: int(os.getenv("PURGE_BATCH_SIZE", "500")))
+    purge_max_seconds: float = Field(default_factory=lambda: float(os.getenv("PURGE_MAX_SECONDS", "0.5")))
+
+    # In-memory fallback storage
+    memory_shards: int = Field(default_factory=lambda: int(os.getenv("MEMORY_SHARDS", "16")))
 
     # TOTP Settings
-    totp_issuer: str = Field(default=os.getenv("TOTP_ISSUER", "OTP Service"))
-    totp_default_window: int = Field(default=int(os.getenv("TOTP_DEFAULT_WINDOW", "1")))
+    totp_issuer: str = Field(default_factory=lambda: os.getenv("TOTP_ISSUER", "OTP Service"))
+    totp_default_window: int = Field(default_factory=lambda: int(os.getenv("TOTP_DEFAULT_WINDOW", "1")))
+    # Largest window (time steps each side) a client may ask for; each extra step is another
+    # code an attacker's guess can match, and another HMAC to compute
+    totp_max_window: int = Field(default_factory=lambda: int(os.getenv("TOTP_MAX_WINDOW", "2")))
+    # QR codes: render processes (0 renders inline), cache size, PNG module size, and how long
+    # /api/v1/totp/qr/<enrollment_id> serves the QR of a new enrollment
+    qr_render_processes: int = Field(default_factory=lambda: int(os.getenv("QR_RENDER_PROCESSES", "2")))
+    qr_cache_size: int = Field(default_factory=lambda: int(os.getenv("QR_CACHE_SIZE", "256")))
+    qr_png_box_size: int = Field(default_factory=lambda: int(os.getenv("QR_PNG_BOX_SIZE", "4")))
+    totp_qr_ttl_seconds: int = Field(default_factory=lambda: int(os.getenv("TOTP_QR_TTL_SECONDS", "600")))
+    totp_batch_max_items: int = Field(default_factory=lambda: int(os.getenv("TOTP_BATCH_MAX_ITEMS", "1000")))
+    # Decoded TOTP keys kept in memory (LRU, keyed by a hash of the secret)
+    totp_key_cache_size: int = Field(default_factory=lambda: int(os.getenv("TOTP_KEY_CACHE_SIZE", "10000")))
+
+    # Brute-force protection on OTP/TOTP verification: more than SECURITY_MAX_FAILURES failed
+    # attempts from one IP within the window blocks it; blocks are synced from Redis periodically
+    security_max_failures: int = Field(default_factory=lambda: int(os.getenv("SECURITY_MAX_FAILURES", "5")))
+    security_window_seconds: int = Field(default_factory=lambda: int(os.getenv("SECURITY_WINDOW_SECONDS", "3600")))
+    security_block_seconds: int = Field(default_factory=lambda: int(os.getenv("SECURITY_BLOCK_SECONDS", "3600")))
+    security_max_tracked_ips: int = Field(default_factory=lambda: int(os.getenv("SECURITY_MAX_TRACKED_IPS", "100000")))
+    security_sync_seconds: float = Field(default_factory=lambda: float(os.getenv("SECURITY_SYNC_SECONDS", "2")))
+    # Reverse proxies in front of the app that append to X-Forwarded-For; the client IP is
+    # the entry that many hops from the end. 0 ignores the header (direct connections)
+    trusted_proxy_hops: int = Field(default_factory=lambda: int(os.getenv("TRUSTED_PROXY_HOPS", "0")))
 
     # Rate limits (simple, optional)
-    rate_limit_per_minute: int = Field(default=int(os.getenv("RATE_LIMIT_PER_MINUTE", "60")))
-    rate_limit_burst: int = Field(default=int(os.getenv("RATE_LIMIT_BURST", "120")))
+    rate_limit_per_minute: int = Field(default_factory=lambda: int(os.getenv("RATE_LIMIT_PER_MINUTE", "60")))
+    rate_limit_burst: int = Field(default_factory=lambda: int(os.getenv("RATE_LIMIT_BURST", "120")))
+    # Local tier: how long a client's Redis-synced allowance may be spent in-process before the
+    # next sync (0 = check Redis on every request), and how many clients are tracked (LRU)
+    rate_limit_local_sync_seconds: float = Field(default_factory=lambda: float(os.getenv("RATE_LIMIT_LOCAL_SYNC_SECONDS", "1.0")))
+    rate_limit_local_max_keys: int = Field(default_factory=lambda: int(os.getenv("RATE_LIMIT_LOCAL_MAX_KEYS", "100000")))
+
+
+_settings: Optional[Settings] = None
+_settings_lock = threading.Lock()
 
 
-# Removed cache to ensure settings are always fresh
 def get_settings() -> Settings:
-    return Settings()
+    """Return the process-wide settings snapshot (built on first use)."""
+    global _settings
+    snapshot = _settings
+    if snapshot is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = Settings()
+            snapshot = _settings
+    return snapshot
+
+
+def reload_settings() -> Settings:
+    """Re-read .env and the environment, then atomically swap the snapshot.
+
+    Callers holding the previous snapshot keep a consistent view until they
+    call get_settings() again.
+    """
+    global _settings
+    with _settings_lock:
+        load_dotenv(override=True)
+        _settings = Settings()
+        return _settings
@@ -0,0 +1,90 @@
+"""
+Redis connection management: pooled client plus health tracking
+"""
+import logging
+import threading
+from typing import Callable, List, Optional
+
+import redis
+
+from . import jobs
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+REDIS_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+
+class RedisConnectionManager:
+    """Owns the pooled Redis client and tracks whether Redis is usable.
+
+    Health is derived from real command outcomes (callers report failures via
+    mark_failed) and from a background heartbeat, so the request path never
+    has to PING. While Redis is down the heartbeat backs off exponentially.
+    """
+
+    def __init__(self, settings: Settings):
+        self.client: redis.Redis = redis.from_url(
+            settings.redis_url,
+            decode_responses=True,
+            max_connections=settings.redis_max_connections,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_connect_timeout,
+            socket_keepalive=settings.redis_socket_keepalive,
+        )
+        self.healthy = False
+        self.last_error: Optional[str] = None
+        self._failures = 0
+        self._max_backoff = settings.redis_recovery_max_backoff_seconds
+        self._listeners: List[Callable[[bool], None]] = []
+        self._lock = threading.Lock()
+        self._heartbeat = jobs.PeriodicTask("redis-heartbeat", settings.redis_heartbeat_seconds, self._beat)
+
+    def add_listener(self, fn: Callable[[bool], None]) -> None:
+        """Call fn(healthy) whenever the health state flips."""
+        self._listeners.append(fn)
+
+    def start(self) -> None:
+        jobs.register(self._heartbeat)
+
+    def close(self) -> None:
+        self._heartbeat.stop(1)
+        self.client.close()
+
+    def probe(self) -> bool:
+        try:
+            self.client.ping()
+        except REDIS_ERRORS as e:
+            self.mark_failed(e)
+            return False
+        self.mark_ok()
+        return True
+
+    def mark_ok(self) -> None:
+        if not self.healthy:
+            self._transition(True)
+
+    def mark_failed(self, exc: Exception) -> None:
+        self.last_error = str(exc)
+        if self.healthy:
+            self._transition(False)
+
+    def _transition(self, healthy: bool) -> None:
+        with self._lock:
+            if self.healthy == healthy:
+                return
+            self.healthy = healthy
+        logger.info("Redis is %s", "healthy" if healthy else f"unreachable: {self.last_error}")
+        for fn in self._listeners:
+            try:
+                fn(healthy)
+            except Exception:
+                logger.exception("Redis health listener failed")
+
+    def _beat(self) -> Optional[float]:
+        if self.probe():
+            self._failures = 0
+            return None
+        # Back off while Redis stays down
+        self._failures += 1
+        return min(self._heartbeat.interval * (2 ** self._failures), self._max_backoff)
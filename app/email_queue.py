@@ -0,0 +1,224 @@
+"""
+Background OTP email delivery: a bounded queue drained by worker threads
+that each keep their own SMTP session open
+"""
+import json
+import logging
+import queue
+import secrets
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .config import get_settings
+from .email_service import EmailService, SMTPSession, get_email_service
+from .metrics import EMAIL_SENT, EMAIL_FAILED, EMAIL_SEND_DURATION
+
+logger = logging.getLogger(__name__)
+
+
+class EmailQueueFull(Exception):
+    """Raised by EmailDispatcher.submit when the queue is at capacity."""
+
+
+class EmailJob:
+    __slots__ = ("id", "to_email", "otp_code", "organization", "subject", "ttl_seconds", "locale", "attempts")
+
+    def __init__(self, job_id: str, to_email: str, otp_code: str, organization: Optional[str],
+                 subject: Optional[str], ttl_seconds: Optional[int] = None, locale: Optional[str] = None):
+        self.id = job_id
+        self.to_email = to_email
+        self.otp_code = otp_code
+        self.organization = organization
+        self.subject = subject
+        self.ttl_seconds = ttl_seconds
+        self.locale = locale
+        self.attempts = 0
+
+
+class BulkEmailJob:
+    __slots__ = ("id", "recipients", "organization", "subject", "ttl_seconds", "locale", "attempts")
+
+    def __init__(self, job_id: str, recipients: Sequence[Tuple], organization: Optional[str],
+                 subject: Optional[str], ttl_seconds: Optional[int], locale: Optional[str]):
+        self.id = job_id
+        self.recipients = recipients
+        self.organization = organization
+        self.subject = subject
+        self.ttl_seconds = ttl_seconds
+        self.locale = locale
+        self.attempts = 0
+
+
+class EmailDispatcher:
+    """Queue OTP emails and deliver them off the request thread.
+
+    Request handlers validate the address synchronously, then submit() and
+    answer immediately with the job id. Each worker owns one SMTPSession, so
+    the TCP/TLS handshake and login are paid once per connection instead of
+    once per email. Transient failures (connection drops, 4xx replies) are
+    retried with exponential backoff. Bulk jobs (one code per recipient) go to
+    a separate queue and are sent with EmailService.send_bulk, so a campaign
+    never holds up single OTP emails. Job status is written to storage so any
+    replica can answer GET /api/v1/email/<job_id>.
+    """
+
+    def __init__(self, storage, service: Optional[EmailService] = None, workers: Optional[int] = None,
+                 queue_size: Optional[int] = None):
+        s = get_settings()
+        self.storage = storage
+        self.service = service or get_email_service()
+        self.workers = max(1, workers or s.email_workers)
+        self._queue: "queue.Queue[EmailJob]" = queue.Queue(maxsize=queue_size or s.email_queue_size)
+        self._bulk_queue: "queue.Queue[BulkEmailJob]" = queue.Queue(maxsize=queue_size or s.email_queue_size)
+        self._stopping = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self._stopping.clear()
+            self._threads = [t for t in self._threads if t.is_alive()]
+            names = {t.name for t in self._threads}
+            targets = [(f"email-worker-{i}", self._work) for i in range(self.workers)]
+            targets.append(("email-bulk", self._work_bulk))
+            for name, target in targets:
+                if name not in names:
+                    thread = threading.Thread(target=target, name=name, daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop accepting work and let the workers drain what is already queued."""
+        self._stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        if not self._queue.empty() or not self._bulk_queue.empty():
+            logger.warning("Email dispatcher stopped with %d emails and %d bulk jobs still queued",
+                           self._queue.qsize(), self._bulk_queue.qsize())
+
+    def pending(self) -> int:
+        return self._queue.qsize() + self._bulk_queue.qsize()
+
+    def submit(self, to_email: str, otp_code: str, organization: Optional[str] = None,
+               subject: Optional[str] = None, ttl_seconds: Optional[int] = None, locale: Optional[str] = None) -> str:
+        if self._stopping.is_set():
+            raise EmailQueueFull("Email dispatcher is shutting down")
+        if self._queue.full():
+            raise EmailQueueFull("Email queue is full")
+        job = EmailJob("eml_" + secrets.token_urlsafe(12), to_email, otp_code, organization, subject,
+                       ttl_seconds, locale)
+        # Record the status first so a fast worker's "sent" is never overwritten by "queued"
+        self._set_status(job, "queued")
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._set_status(job, "failed", "Email queue is full")
+            raise EmailQueueFull("Email queue is full") from None
+        return job.id
+
+    def submit_bulk(self, recipients: Sequence[Tuple], organization: Optional[str] = None,
+                    subject: Optional[str] = None, ttl_seconds: Optional[int] = None,
+                    locale: Optional[str] = None) -> str:
+        """Queue one email per (email, code[, ttl_seconds]) tuple as a single job."""
+        if self._stopping.is_set():
+            raise EmailQueueFull("Email dispatcher is shutting down")
+        if self._bulk_queue.full():
+            raise EmailQueueFull("Email queue is full")
+        job = BulkEmailJob("eml_" + secrets.token_urlsafe(12), list(recipients), organization, subject,
+                           ttl_seconds, locale)
+        self._set_status(job, "queued", extra={"total": str(len(job.recipients))})
+        try:
+            self._bulk_queue.put_nowait(job)
+        except queue.Full:
+            self._set_status(job, "failed", "Email queue is full")
+            raise EmailQueueFull("Email queue is full") from None
+        return job.id
+
+    def status(self, job_id: str) -> Optional[Dict[str, str]]:
+        return self.storage.get_email_status(job_id)
+
+    def _set_status(self, job, status: str, error: Optional[str] = None,
+                    extra: Optional[Dict[str, str]] = None) -> None:
+        fields = {"status": status, "attempts": str(job.attempts), "updated_at": str(int(time.time()))}
+        if error:
+            fields["error"] = error
+        if extra:
+            fields.update(extra)
+        try:
+            self.storage.put_email_status(job.id, fields, get_settings().email_status_ttl_seconds)
+        except Exception:
+            logger.exception("Failed to record status of email job %s", job.id)
+
+    def _work(self) -> None:
+        session = SMTPSession()
+        try:
+            while True:
+                try:
+                    job = self._queue.get(timeout=0.5)
+                except queue.Empty:
+                    if self._stopping.is_set():
+                        return
+                    continue
+                try:
+                    self._deliver(session, job)
+                except Exception:
+                    logger.exception("Email job %s crashed", job.id)
+                    EMAIL_FAILED.inc()
+                    self._set_status(job, "failed", "Unexpected error sending email")
+                finally:
+                    self._queue.task_done()
+        finally:
+            session.close()
+
+    def _deliver(self, session: SMTPSession, job: EmailJob) -> None:
+        s = get_settings()
+        while True:
+            job.attempts += 1
+            started = time.time()
+            ok, message, retryable = self.service.deliver(session, job.to_email, job.otp_code, job.organization,
+                                                          job.subject, job.ttl_seconds, job.locale)
+            EMAIL_SEND_DURATION.observe(time.time() - started)
+            if ok:
+                EMAIL_SENT.inc()
+                self._set_status(job, "sent")
+                return
+            if not retryable or job.attempts > s.email_max_retries:
+                EMAIL_FAILED.inc()
+                self._set_status(job, "failed", message)
+                return
+            self._set_status(job, "retrying", message)
+            # Exponential backoff; a shutdown cuts the wait short but the retry still happens
+            self._stopping.wait(s.email_retry_backoff_seconds * (2 ** (job.attempts - 1)))
+
+    def _work_bulk(self) -> None:
+        while True:
+            try:
+                job = self._bulk_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                job.attempts = 1
+                self._set_status(job, "sending")
+                results = self.service.send_bulk(job.recipients, job.organization, job.subject,
+                                                 job.ttl_seconds, job.locale)
+                failures = [{"email": email, "error": message} for email, ok, message in results if not ok]
+                sent = len(results) - len(failures)
+                status = "sent" if not failures else ("partial" if sent else "failed")
+                self._set_status(job, status, extra={
+                    "total": str(len(results)),
+                    "sent": str(sent),
+                    "failed": str(len(failures)),
+                    # keep the stored status small; the first failures are enough to diagnose
+                    "failures": json.dumps(failures[:100]),
+                })
+            except Exception:
+                logger.exception("Bulk email job %s crashed", job.id)
+                self._set_status(job, "failed", "Unexpected error sending email")
+            finally:
+                self._bulk_queue.task_done()
@@ -1,19 +1,22 @@
 import smtplib
 import logging
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from typing import Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
 import re
-from datetime import datetime
 
 from .config import get_settings
+from .email_templates import render_otp_email
+from .metrics import EMAIL_SENT, EMAIL_FAILED, EMAIL_SEND_DURATION
 
 logger = logging.getLogger(__name__)
 
 
 class EmailService:
-    def __init__(self):
-        self.settings = get_settings()
+    @property
+    def settings(self):
+        # Always read the current snapshot so a settings reload takes effect
+        return get_settings()
 
     def _validate_email(self, email: str) -> bool:
         """Validate email format"""
@@ -38,161 +41,162 @@ class EmailService:
 
         return any(spam_word in text_to_check for spam_word in spam_words)
 
-    def _create_otp_email(self, to_email: str, otp_code: str, organization: str = None,
-                          subject: str = None) -> MIMEMultipart:
-        """Create OTP email message"""
-        org_name = organization or self.settings.organization_name
-        email_subject = subject or self.settings.email_subject_template.format(organization=org_name)
-
-        msg = MIMEMultipart('alternative')
-        msg['From'] = f"{self.settings.email_from_name} <{self.settings.email_from}>"
-        msg['To'] = to_email
-        msg['Subject'] = email_subject
-
-        # Enhanced HTML email template with better security features
-        html_body = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>OTP Verification - {org_name}</title>
-            <style>
-                body {{ font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }}
-                .container {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 8px 32px rgba(0,0,0,0.1); }}
-                .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 40px 30px; text-align: center; position: relative; }}
-                .header::before {{ content: ''; position: absolute; top: 0; left: 0; right: 0; bottom: 0; background: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><defs><pattern id="grain" width="100" height="100" patternUnits="userSpaceOnUse"><circle cx="25" cy="25" r="1" fill="white" opacity="0.1"/><circle cx="75" cy="75" r="1" fill="white" opacity="0.1"/></pattern></defs><rect width="100" height="100" fill="url(%23grain)"/></svg>'); opacity: 0.1; }}
-                .content {{ padding: 50px 30px; text-align: center; }}
-                .otp-code {{ font-size: 36px; font-weight: bold; color: #667eea; letter-spacing: 8px; margin: 30px 0; padding: 20px; background: linear-gradient(135deg, #f8f9ff 0%, #e8f0ff 100%); border-radius: 12px; border: 3px dashed #667eea; box-shadow: 0 4px 15px rgba(102, 126, 234, 0.2); }}
-                .footer {{ background: #f8f9fa; padding: 30px; text-align: center; color: #6c757d; font-size: 14px; border-top: 1px solid #e9ecef; }}
-                .warning {{ color: #dc3545; font-size: 14px; margin-top: 25px; padding: 15px; background: #fff5f5; border-radius: 8px; border-left: 4px solid #dc3545; }}
-                .security-badge {{ display: inline-block; background: #28a745; color: white; padding: 5px 15px; border-radius: 20px; font-size: 12px; margin: 10px 0; }}
-                .timestamp {{ color: #6c757d; font-size: 12px; margin-top: 15px; }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>🔐 {org_name}</h1>
-                    <p>Your secure verification code</p>
-                    <div class="security-badge">🔒 End-to-End Encrypted</div>
-                </div>
-                <div class="content">
-                    <h2>Your OTP Code</h2>
-                    <p>Use this code to complete your verification:</p>
-                    <div class="otp-code">{otp_code}</div>
-                    <p>This code will expire in <strong>5 minutes</strong></p>
-                    <div class="warning">
-                        ⚠️ <strong>Security Notice:</strong> Never share this code with anyone. {org_name} will never ask for your OTP code via phone or email.
-                    </div>
-                    <div class="timestamp">
-                        Generated at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}
-                    </div>
-                </div>
-                <div class="footer">
-                    <p>If you didn't request this code, please ignore this email and consider changing your password.</p>
-                    <p>© 2025 {org_name}. All rights reserved. | <a href="#" style="color: #667eea;">Privacy Policy</a></p>
-                </div>
-            </div>
-        </body>
-        </html>
+    def _render_otp_email(self, to_email: str, otp_code: str, organization: str = None, subject: str = None,
+                          ttl_seconds: int = None, locale: str = None) -> bytes:
+        """Serialized OTP email, spliced into a cached pre-rendered template"""
+        s = self.settings
+        org_name = organization or s.organization_name
+        email_subject = subject or s.email_subject_template.format(organization=org_name)
+        return render_otp_email(
+            to_email, otp_code, ttl_seconds or s.otp_default_ttl_seconds, org_name, email_subject,
+            f"{s.email_from_name} <{s.email_from}>", locale or s.email_default_locale,
+        )
+
+    def smtp_configured(self) -> bool:
+        s = self.settings
+        return bool(s.smtp_host) and (not s.smtp_auth or bool(s.smtp_username and s.smtp_password))
+
+    def check_request(self, to_email: str, subject: str = None, purpose: str = "") -> Optional[str]:
+        """Cheap synchronous checks run before anything is queued; returns an error message or None."""
+        if not self._validate_email(to_email):
+            return "Invalid email format"
+
+        if not self._check_allowed_domain(to_email):
+            return "Email domain not allowed"
+
+        if self._check_spam_keywords(subject or "", purpose):
+            return "Request blocked due to spam detection"
+        return None
+
+    def deliver(self, session: "SMTPSession", to_email: str, otp_code: str, organization: str = None,
+                subject: str = None, ttl_seconds: int = None, locale: str = None) -> Tuple[bool, str, bool]:
+        """
+        Send one OTP email over an open session
+        Returns: (success: bool, message: str, retryable: bool)
         """
+        try:
+            data = self._render_otp_email(to_email, otp_code, organization, subject, ttl_seconds, locale)
+        except Exception as e:
+            # A message that cannot be built will not build on a retry either
+            logger.error(f"Failed to render OTP email for {to_email}: {e}")
+            return False, f"Failed to render email: {e}", False
+        try:
+            session.send(self.settings.email_from, to_email, data)
+            logger.info(f"✅ OTP email sent successfully to {to_email}")
+            return True, f"Email sent to {to_email}", False
+        except smtplib.SMTPAuthenticationError as e:
+            session.close()
+            logger.error(f"SMTP authentication failed: {e}")
+            print("💡 For Gmail, make sure you're using an App Password, not your regular password!")
+            return False, "Email authentication failed - check credentials", False
+        except smtplib.SMTPRecipientsRefused as e:
+            logger.error(f"SMTP recipient refused: {e}")
+            return False, f"Failed to send email: {e}", False
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError) as e:
+            # connection-level problems: drop the session and let the caller retry
+            session.close()
+            logger.warning(f"SMTP connection error: {e}")
+            return False, f"Failed to send email: {e}", True
+        except smtplib.SMTPResponseException as e:
+            session.close()
+            logger.error(f"SMTP error: {e}")
+            # 4xx replies are transient by definition
+            return False, f"Failed to send email: {e}", 400 <= e.smtp_code < 500
+        except smtplib.SMTPException as e:
+            session.close()
+            logger.error(f"SMTP error: {e}")
+            return False, f"Failed to send email: {e}", False
 
-        # Text version for email clients that don't support HTML
-        text_body = f"""
-        {org_name} - OTP Verification
-        
-        Your verification code: {otp_code}
-        
-        This code will expire in 5 minutes.
-        
-        Never share this code with anyone. {org_name} will never ask for your OTP code.
-        
-        If you didn't request this code, please ignore this email.
+    def send_bulk(self, recipients: Iterable[Tuple], organization: str = None, subject: str = None,
+                  ttl_seconds: int = None, locale: str = None,
+                  sessions: int = None) -> List[Tuple[str, bool, str]]:
+        """
+        Send many OTP emails over a few long-lived SMTP sessions
+        recipients: (email, code) or (email, code, ttl_seconds) tuples, split round-robin
+        across `sessions` parallel connections
+        Returns: per-recipient (email, success, message), in input order
         """
+        s = self.settings
+        recipients = list(recipients)
+        results: List[Optional[Tuple[str, bool, str]]] = [None] * len(recipients)
+        pending = []
+        configured = self.smtp_configured()
+        for i, (to_email, *_rest) in enumerate(recipients):
+            error = self.check_request(to_email, subject) or (None if configured else "SMTP not configured")
+            if error:
+                EMAIL_FAILED.inc()
+                results[i] = (to_email, False, error)
+            else:
+                pending.append(i)
 
-        msg.attach(MIMEText(text_body, 'plain'))
-        msg.attach(MIMEText(html_body, 'html'))
+        def run(indexes: List[int]) -> None:
+            session = SMTPSession()
+            try:
+                for i in indexes:
+                    to_email, code, *rest = recipients[i]
+                    ttl = rest[0] if rest else ttl_seconds
+                    started = time.time()
+                    ok, message, retryable = self.deliver(session, to_email, code, organization, subject, ttl, locale)
+                    if not ok and retryable:
+                        # the session was dropped; one retry on a fresh connection
+                        ok, message, _ = self.deliver(session, to_email, code, organization, subject, ttl, locale)
+                    EMAIL_SEND_DURATION.observe(time.time() - started)
+                    (EMAIL_SENT if ok else EMAIL_FAILED).inc()
+                    results[i] = (to_email, ok, message)
+            finally:
+                session.close()
 
-        return msg
+        workers = max(1, min(sessions or s.email_bulk_sessions, len(pending)))
+        if pending:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="smtp-bulk") as pool:
+                list(pool.map(run, [pending[k::workers] for k in range(workers)]))
+        return results
+
+    def not_configured_message(self, to_email: str, otp_code: str) -> str:
+        logger.warning("❌ SMTP not configured! Please set SMTP_USERNAME and SMTP_PASSWORD")
+        print(f"❌ SMTP Configuration Missing:")
+        print(f"   Current SMTP_USERNAME: '{self.settings.smtp_username}'")
+        print(
+            f"   Current SMTP_PASSWORD: '{'*' * len(self.settings.smtp_password) if self.settings.smtp_password else 'NOT SET'}'")
+        print(f"   SMTP_HOST: {self.settings.smtp_host}")
+        print(f"   SMTP_PORT: {self.settings.smtp_port}")
+        print(f"📧 Email would be sent to: {to_email}")
+        print(f"🔐 OTP Code would be: {otp_code}")
+        return f"SMTP not configured. Code would be: {otp_code}"
 
     def send_otp_email(self, to_email: str, otp_code: str, organization: str = None,
-                       subject: str = None, purpose: str = "") -> tuple[bool, str]:
+                       subject: str = None, purpose: str = "", ttl_seconds: int = None,
+                       locale: str = None) -> tuple[bool, str]:
         """
-        Send OTP via email
+        Send OTP via email synchronously over a one-off connection
+        (request handlers go through the EmailDispatcher queue instead)
         Returns: (success: bool, message: str)
         """
         try:
             # Validation checks
-            if not self._validate_email(to_email):
-                return False, "Invalid email format"
-
-            if not self._check_allowed_domain(to_email):
-                return False, "Email domain not allowed"
-
-            if self._check_spam_keywords(subject or "", purpose):
-                return False, "Request blocked due to spam detection"
+            error = self.check_request(to_email, subject, purpose)
+            if error:
+                return False, error
 
             # Check if SMTP is configured
-            if not self.settings.smtp_username or not self.settings.smtp_password:
-                logger.warning("❌ SMTP not configured! Please set SMTP_USERNAME and SMTP_PASSWORD")
-                print(f"❌ SMTP Configuration Missing:")
-                print(f"   Current SMTP_USERNAME: '{self.settings.smtp_username}'")
-                print(
-                    f"   Current SMTP_PASSWORD: '{'*' * len(self.settings.smtp_password) if self.settings.smtp_password else 'NOT SET'}'")
-                print(f"   SMTP_HOST: {self.settings.smtp_host}")
-                print(f"   SMTP_PORT: {self.settings.smtp_port}")
-                print(f"📧 Email would be sent to: {to_email}")
-                print(f"🔐 OTP Code would be: {otp_code}")
-                return False, f"SMTP not configured. Code would be: {otp_code}"
+            if not self.smtp_configured():
+                return False, self.not_configured_message(to_email, otp_code)
 
             # Debug SMTP settings
             print(f"📧 Attempting to send email...")
             print(f"   SMTP Host: {self.settings.smtp_host}:{self.settings.smtp_port}")
             print(f"   From: {self.settings.email_from}")
             print(f"   To: {to_email}")
-            print(f"   OTP: {otp_code}")
-
-            # Create and send email
-            msg = self._create_otp_email(to_email, otp_code, organization, subject)
-
-            print(f"📧 Detailed email configuration:")
-            print(f"   SMTP Host: {self.settings.smtp_host}")
-            print(f"   SMTP Port: {self.settings.smtp_port}")
-            print(f"   SMTP Username: {self.settings.smtp_username}")
-            print(f"   SMTP Password: {'*' * len(self.settings.smtp_password)}")
-            print(f"   From: {msg['From']}")
-            print(f"   To: {msg['To']}")
-            print(f"   Subject: {msg['Subject']}")
-            
-            with smtplib.SMTP(self.settings.smtp_host, self.settings.smtp_port, timeout=10) as server:
-                server.set_debuglevel(1)  # Enable SMTP debugging
-                if self.settings.smtp_use_tls:
-                    print(f"🔒 Starting TLS...")
-                    server.starttls()
-
-                print(f"🔑 Authenticating with {self.settings.smtp_username}...")
-                server.login(self.settings.smtp_username, self.settings.smtp_password)
-
-                print(f"📤 Sending email...")
-                server.send_message(msg)
-                server.quit()
 
-            logger.info(f"✅ OTP email sent successfully to {to_email}")
-            print(f"✅ Email sent successfully to {to_email}!")
-            return True, f"Email sent to {to_email}"
+            session = SMTPSession()
+            try:
+                success, message, _ = self.deliver(session, to_email, otp_code, organization, subject,
+                                                   ttl_seconds, locale)
+            finally:
+                session.close()
+            print(f"✅ Email sent successfully to {to_email}!" if success else f"❌ {message}")
+            return success, message
 
-        except smtplib.SMTPAuthenticationError as e:
-            error_msg = f"SMTP authentication failed: {e}"
-            logger.error(error_msg)
-            print(f"❌ {error_msg}")
-            print("💡 For Gmail, make sure you're using an App Password, not your regular password!")
-            return False, "Email authentication failed - check credentials"
-        except smtplib.SMTPException as e:
-            error_msg = f"SMTP error: {e}"
-            logger.error(error_msg)
-            print(f"❌ {error_msg}")
-            return False, f"Failed to send email: {e}"
         except Exception as e:
             error_msg = f"Unexpected error sending email: {e}"
             logger.error(error_msg)
@@ -200,6 +204,56 @@ class EmailService:
             return False, f"Failed to send email: {e}"
 
 
+class SMTPSession:
+    """One SMTP connection, opened lazily and reused across messages.
+
+    The connection is authenticated once and kept open; it is dropped after
+    SMTP_IDLE_SECONDS without traffic (servers close idle sessions anyway) or
+    after SMTP_MAX_MESSAGES_PER_CONNECTION messages, and re-opened on the next send.
+    """
+
+    def __init__(self):
+        self._server: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+        self.sent = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        s = get_settings()
+        server = smtplib.SMTP(s.smtp_host, s.smtp_port, timeout=s.smtp_timeout)
+        try:
+            server.ehlo()
+            if s.smtp_use_tls:
+                server.starttls()
+                server.ehlo()
+            if s.smtp_auth:
+                server.login(s.smtp_username, s.smtp_password)
+        except Exception:
+            server.close()
+            raise
+        self.sent = 0
+        return server
+
+    def send(self, from_addr: str, to_email: str, data: bytes) -> None:
+        s = get_settings()
+        if self._server is not None and (time.monotonic() - self._last_used > s.smtp_idle_seconds
+                                         or self.sent >= s.smtp_max_messages_per_connection):
+            self.close()
+        if self._server is None:
+            self._server = self._connect()
+        self._server.sendmail(from_addr, [to_email], data)
+        self.sent += 1
+        self._last_used = time.monotonic()
+
+    def close(self) -> None:
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+
 # Global email service instance - sera initialisé avec les variables d'environnement
 email_service = None
 
@@ -0,0 +1,210 @@
+"""
+Pre-rendered OTP email templates
+
+Building the MIME tree and serializing it is the bulk of the CPU cost of an
+email send, and only the recipient, code, TTL and timestamp change between two
+messages of the same organization. Each (organization, subject, locale, sender)
+combination is therefore rendered once into a serialized MIME skeleton whose
+parts use quoted-printable encoding, so the per-send values can be spliced into
+the bytes directly.
+"""
+import binascii
+import html
+from datetime import datetime, timezone
+from email.charset import Charset, QP
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import SMTP
+from functools import lru_cache
+from typing import Dict, Optional
+
+# Tokens sit alone on their line so quoted-printable soft line breaks never split them
+_TO = b"@@OTP_TO@@"
+_CODE = b"@@OTP_CODE@@"
+_CODE_HTML = b"@@OTP_CODE_HTML@@"  # the code in the HTML part, where it must be escaped
+_TTL = b"@@OTP_TTL@@"
+_TIMESTAMP = b"@@OTP_TIMESTAMP@@"
+
+DEFAULT_LOCALE = "en"
+
+LOCALES: Dict[str, Dict[str, str]] = {
+    "en": {
+        "title": "OTP Verification",
+        "tagline": "Your secure verification code",
+        "badge": "🔒 End-to-End Encrypted",
+        "heading": "Your OTP Code",
+        "intro": "Use this code to complete your verification:",
+        "expires": "This code will expire in",
+        "notice_label": "Security Notice:",
+        "notice": "Never share this code with anyone. {org} will never ask for your OTP code via phone or email.",
+        "generated": "Generated at:",
+        "ignore": "If you didn't request this code, please ignore this email and consider changing your password.",
+        "rights": "All rights reserved.",
+        "privacy": "Privacy Policy",
+        "text_code": "Your verification code:",
+        "text_notice": "Never share this code with anyone. {org} will never ask for your OTP code.",
+        "text_ignore": "If you didn't request this code, please ignore this email.",
+        "second": "second", "seconds": "seconds",
+        "minute": "minute", "minutes": "minutes",
+        "hour": "hour", "hours": "hours",
+    },
+    "fr": {
+        "title": "Vérification OTP",
+        "tagline": "Votre code de vérification sécurisé",
+        "badge": "🔒 Chiffré de bout en bout",
+        "heading": "Votre code OTP",
+        "intro": "Utilisez ce code pour finaliser votre vérification :",
+        "expires": "Ce code expire dans",
+        "notice_label": "Avis de sécurité :",
+        "notice": "Ne partagez jamais ce code. {org} ne vous demandera jamais votre code OTP par téléphone ou par email.",
+        "generated": "Généré le :",
+        "ignore": "Si vous n'avez pas demandé ce code, ignorez cet email et pensez à changer votre mot de passe.",
+        "rights": "Tous droits réservés.",
+        "privacy": "Politique de confidentialité",
+        "text_code": "Votre code de vérification :",
+        "text_notice": "Ne partagez jamais ce code. {org} ne vous demandera jamais votre code OTP.",
+        "text_ignore": "Si vous n'avez pas demandé ce code, ignorez cet email.",
+        "second": "seconde", "seconds": "secondes",
+        "minute": "minute", "minutes": "minutes",
+        "hour": "heure", "hours": "heures",
+    },
+}
+
+_STYLE = """
+        body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0; padding: 20px; background-color: #f5f5f5; }
+        .container { max-width: 600px; margin: 0 auto; background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 8px 32px rgba(0,0,0,0.1); }
+        .header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 40px 30px; text-align: center; position: relative; }
+        .header::before { content: ''; position: absolute; top: 0; left: 0; right: 0; bottom: 0; background: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100"><defs><pattern id="grain" width="100" height="100" patternUnits="userSpaceOnUse"><circle cx="25" cy="25" r="1" fill="white" opacity="0.1"/><circle cx="75" cy="75" r="1" fill="white" opacity="0.1"/></pattern></defs><rect width="100" height="100" fill="url(%23grain)"/></svg>'); opacity: 0.1; }
+        .content { padding: 50px 30px; text-align: center; }
+        .otp-code { font-size: 36px; font-weight: bold; color: #667eea; letter-spacing: 8px; margin: 30px 0; padding: 20px; background: linear-gradient(135deg, #f8f9ff 0%, #e8f0ff 100%); border-radius: 12px; border: 3px dashed #667eea; box-shadow: 0 4px 15px rgba(102, 126, 234, 0.2); }
+        .footer { background: #f8f9fa; padding: 30px; text-align: center; color: #6c757d; font-size: 14px; border-top: 1px solid #e9ecef; }
+        .warning { color: #dc3545; font-size: 14px; margin-top: 25px; padding: 15px; background: #fff5f5; border-radius: 8px; border-left: 4px solid #dc3545; }
+        .security-badge { display: inline-block; background: #28a745; color: white; padding: 5px 15px; border-radius: 20px; font-size: 12px; margin: 10px 0; }
+        .timestamp { color: #6c757d; font-size: 12px; margin-top: 15px; }
+"""
+
+_HTML = """<!DOCTYPE html>
+<html lang="{lang}">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{title} - {org}</title>
+<style>{style}</style>
+</head>
+<body>
+<div class="container">
+<div class="header">
+<h1>🔐 {org}</h1>
+<p>{tagline}</p>
+<div class="security-badge">{badge}</div>
+</div>
+<div class="content">
+<h2>{heading}</h2>
+<p>{intro}</p>
+<div class="otp-code">
+@@OTP_CODE_HTML@@
+</div>
+<p>{expires} <strong>
+@@OTP_TTL@@
+</strong></p>
+<div class="warning">
+⚠️ <strong>{notice_label}</strong> {notice}
+</div>
+<div class="timestamp">
+{generated}
+@@OTP_TIMESTAMP@@
+</div>
+</div>
+<div class="footer">
+<p>{ignore}</p>
+<p>© {year} {org}. {rights} | <a href="#" style="color: #667eea;">{privacy}</a></p>
+</div>
+</div>
+</body>
+</html>
+"""
+
+_TEXT = """{org} - {title}
+
+{text_code}
+@@OTP_CODE@@
+
+{expires}
+@@OTP_TTL@@
+
+{text_notice}
+
+{text_ignore}
+"""
+
+_QP_UTF8 = Charset("utf-8")
+_QP_UTF8.body_encoding = QP
+
+
+def resolve_locale(locale: Optional[str]) -> str:
+    """Map e.g. 'fr-FR' to 'fr'; unknown locales fall back to English."""
+    if not locale:
+        return DEFAULT_LOCALE
+    lang = locale.replace("_", "-").split("-", 1)[0].lower()
+    return lang if lang in LOCALES else DEFAULT_LOCALE
+
+
+def format_ttl(ttl_seconds: int, locale: str = DEFAULT_LOCALE) -> str:
+    words = LOCALES[resolve_locale(locale)]
+    for unit, size in (("hour", 3600), ("minute", 60)):
+        if ttl_seconds >= size and ttl_seconds % size == 0:
+            count = ttl_seconds // size
+            return f"{count} {words[unit if count == 1 else unit + 's']}"
+    return f"{ttl_seconds} {words['second' if ttl_seconds == 1 else 'seconds']}"
+
+
+def _qp(value: str) -> bytes:
+    return binascii.b2a_qp(value.encode("utf-8"))
+
+
+class OTPEmailTemplate:
+    """A serialized OTP email with placeholders for the per-send values."""
+
+    __slots__ = ("_head", "_body", "locale")
+
+    def __init__(self, organization: str, subject: str, locale: str, from_header: str, year: int):
+        self.locale = locale
+        text_words = {k: v.format(org=organization) for k, v in LOCALES[locale].items()}
+        html_words = {k: html.escape(v) for k, v in text_words.items()}
+
+        # Built under the SMTP policy so non-ASCII display names and subjects are
+        # RFC 2047 encoded; compat32 would leave them raw and fail to serialize
+        msg = MIMEMultipart("alternative", policy=SMTP)
+        msg["From"] = from_header
+        msg["To"] = _TO.decode()
+        msg["Subject"] = subject
+        msg.attach(MIMEText(_TEXT.format(org=organization, **text_words), "plain", _QP_UTF8, policy=SMTP))
+        msg.attach(MIMEText(_HTML.format(lang=locale, org=html.escape(organization), style=_STYLE, year=year,
+                                         **html_words), "html", _QP_UTF8, policy=SMTP))
+
+        raw = msg.as_bytes(policy=SMTP)
+        # Headers are spliced separately from the body so a token in the body can never
+        # be confused with the recipient header
+        split = raw.index(b"\r\n\r\n") + 4
+        self._head, self._body = raw[:split], raw[split:]
+
+    def render(self, to_email: str, otp_code: str, ttl_seconds: int, now: Optional[datetime] = None) -> bytes:
+        now = now or datetime.now(timezone.utc)
+        return (self._head.replace(_TO, to_email.encode("ascii"))
+                + self._body.replace(_CODE, _qp(otp_code))
+                .replace(_CODE_HTML, _qp(html.escape(otp_code)))
+                .replace(_TTL, _qp(format_ttl(ttl_seconds, self.locale)))
+                .replace(_TIMESTAMP, _qp(now.strftime("%Y-%m-%d %H:%M:%S UTC"))))
+
+
+@lru_cache(maxsize=128)
+def get_template(organization: str, subject: str, locale: str, from_header: str, year: int) -> OTPEmailTemplate:
+    return OTPEmailTemplate(organization, subject, locale, from_header, year)
+
+
+def render_otp_email(to_email: str, otp_code: str, ttl_seconds: int, organization: str, subject: str,
+                     from_header: str, locale: Optional[str] = None) -> bytes:
+    """Serialized RFC 5322 message ready for SMTP DATA."""
+    now = datetime.now(timezone.utc)
+    template = get_template(organization, subject, resolve_locale(locale), from_header, now.year)
+    return template.render(to_email, otp_code, ttl_seconds, now)
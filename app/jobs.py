@@ -0,0 +1,78 @@
+"""
+Background jobs shared by the storage, email and metrics subsystems
+"""
+import logging
+import threading
+from typing import Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_services: List = []
+_services_lock = threading.Lock()
+
+
+def register(service) -> None:
+    """Track a background service (anything with start()/stop()) and start it."""
+    with _services_lock:
+        _services.append(service)
+    service.start()
+
+
+def start_all() -> None:
+    """(Re)start every registered service whose threads are not running."""
+    with _services_lock:
+        services = list(_services)
+    for service in services:
+        service.start()
+
+
+def stop_all(timeout: Optional[float] = None) -> None:
+    with _services_lock:
+        services = list(_services)
+    for service in reversed(services):
+        try:
+            service.stop(timeout)
+        except Exception:
+            logger.exception("Failed to stop background service %r", service)
+
+
+class PeriodicTask:
+    """Run fn every interval seconds on a daemon thread.
+
+    fn may return a number of seconds to override the delay before the next run
+    (e.g. for backoff); wake() runs it early.
+    """
+
+    def __init__(self, name: str, interval: float, fn: Callable[[], Optional[float]]):
+        self.name = name
+        self.interval = interval
+        self._fn = fn
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                delay = self._fn()
+            except Exception:
+                logger.exception("Background task %s failed", self.name)
+                delay = None
+            self._wake.wait(self.interval if delay is None else delay)
+            self._wake.clear()
@@ -2,86 +2,57 @@ from dotenv import load_dotenv
 load_dotenv()  # Charger les variables d'environnement en premier
 
 from datetime import datetime, timezone
+import os
 import secrets
 import time
-import io
 from functools import wraps
 from typing import Optional
 import base64
 import binascii
-import qrcode
+import signal
+import json
 
-from flask import Flask, jsonify, request, render_template, redirect, session
+from flask import Flask, jsonify, make_response, request, render_template, redirect, session
 from flask_cors import CORS, cross_origin
 app = Flask(__name__) 
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-import redis
-import redis.exceptions
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
-from .config import get_settings
-from .otp import generate_code, hash_code_with_salt, new_otp_id, compute_hmac
+from .config import get_settings, reload_settings
+from .metrics import (
+    REQ_COUNTER, LATENCY, GEN_COUNT, VERIFY_OK, VERIFY_FAIL, EMAIL_SENT, EMAIL_FAILED,
+    OTP_GENERATE_DURATION, OTP_VERIFY_DURATION, TOTP_VERIFY_DURATION, TOTP_VERIFY_BATCH_DURATION,
+    READINESS_DURATION, SystemSampler, collector_registry, collect_totals, sample_sum, latency_aggregator, observe_latency, observe_duration,
+)
+from .otp import generate_code, hash_code_with_salt, new_otp_id
+from .rate_limit import RateLimiter
+from .security import SharedSecurityManager
 from .storage import RedisStorage
 from .email_service import email_service
+from .email_queue import EmailDispatcher, EmailQueueFull
+from .email_templates import LOCALES as EMAIL_LOCALES
+from . import jobs
 from .totp_service import totp_service
+from .qr import FORMATS as QR_FORMATS, MIMETYPES as QR_MIMETYPES, QRRenderTimeout, qr_renderer
 
 s = get_settings()
 
-# Metrics
-"""Prometheus metrics declarations.
-
-Existing counters/histograms:
-  http_requests_total{handler,method,code}      - per-endpoint request counts
-  http_request_duration_seconds{handler,method} - per-endpoint total latency
-  otp_generate_total                            - count of OTPs generated
-  otp_verify_success_total                      - successful OTP/TOTP verifications
-  otp_verify_fail_total{reason}                 - failed OTP/TOTP verifications by reason
-  otp_email_sent_total                          - emails successfully sent
-  otp_email_failed_total                        - failed email send attempts
-
-Added granular histograms (requirement B: histogram/metrics):
-  otp_generate_duration_seconds                 - time to generate & persist an OTP (excludes email send)
-  otp_verify_duration_seconds                   - time to verify & consume an OTP
-  totp_verify_duration_seconds                  - time to verify a TOTP token
-  otp_email_send_duration_seconds               - time spent sending OTP email (SMTP interaction)
-  readiness_check_duration_seconds              - time spent performing readiness probe (Redis ping, logic)
-"""
-REQ_COUNTER = Counter('http_requests_total', 'HTTP requests total', ['handler', 'method', 'code'])
-LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['handler', 'method'])
-GEN_COUNT = Counter('otp_generate_total', 'Number of OTP generated')
-VERIFY_OK = Counter('otp_verify_success_total', 'Number of successful OTP verifications')
-VERIFY_FAIL = Counter('otp_verify_fail_total', 'Number of failed OTP verifications', ['reason'])
-EMAIL_SENT = Counter('otp_email_sent_total', 'Number of OTP emails sent')
-EMAIL_FAILED = Counter('otp_email_failed_total', 'Number of failed OTP email sends')
-
-# New histograms (bucket choices tuned to expected latency distributions)
-OTP_GENERATE_DURATION = Histogram(
-    'otp_generate_duration_seconds',
-    'Time to generate and persist a single OTP (sans email send)',
-    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
-)
-OTP_VERIFY_DURATION = Histogram(
-    'otp_verify_duration_seconds',
-    'Time to verify and consume an OTP',
-    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
-)
-TOTP_VERIFY_DURATION = Histogram(
-    'totp_verify_duration_seconds',
-    'Time to verify a TOTP token over the configured window',
-    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
-)
-EMAIL_SEND_DURATION = Histogram(
-    'otp_email_send_duration_seconds',
-    'Time spent sending OTP email via SMTP',
-    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13)
-)
-READINESS_DURATION = Histogram(
-    'readiness_check_duration_seconds',
-    'Time to perform readiness probe (including Redis ping)',
-    buckets=(0.001, 0.003, 0.005, 0.01, 0.02, 0.05, 0.1)
-)
 
+def _reload_settings(*_args):
+    """Swap in a fresh settings snapshot (SIGHUP or POST /admin/settings/reload)."""
+    global s
+    s = reload_settings()
+    print("🔄 Settings reloaded")
+    return s
+
+
+if hasattr(signal, 'SIGHUP'):
+    try:
+        signal.signal(signal.SIGHUP, _reload_settings)
+    except ValueError:
+        # signal handlers can only be installed from the main thread
+        pass
 
 def create_app() -> Flask:
     app = Flask(__name__, template_folder="templates", static_folder="static")
@@ -103,50 +74,105 @@ def create_app() -> Flask:
         return resp
 
     storage = RedisStorage()
-
-    def rate_limit(limit: int = s.rate_limit_per_minute, burst: int = s.rate_limit_burst):
+    email_dispatcher = EmailDispatcher(storage)
+    jobs.register(email_dispatcher)
+    jobs.register(qr_renderer)
+    system_sampler = SystemSampler(s.metrics_sample_seconds)
+    jobs.register(system_sampler)
+    jobs.register(latency_aggregator)
+
+    limiter = RateLimiter(storage)
+    security = SharedSecurityManager(storage)
+    jobs.register(security)
+
+    def client_ip() -> str:
+        """Client address for rate limiting and IP blocking.
+
+        X-Forwarded-For is client-controlled up to the first trusted proxy, so only the
+        entry appended by the outermost of TRUSTED_PROXY_HOPS proxies is used (as
+        werkzeug's ProxyFix does); without enough entries, the peer address.
+        """
+        hops = s.trusted_proxy_hops
+        if hops > 0:
+            forwarded = [ip.strip() for ip in request.headers.get('X-Forwarded-For', '').split(',')]
+            if len(forwarded) >= hops and forwarded[-hops]:
+                return forwarded[-hops]
+        return request.remote_addr or 'unknown'
+
+    def rate_limit(limit: Optional[int] = None, burst: Optional[int] = None):
+        """Per-IP, per-endpoint GCRA limit: `limit` requests per minute, up to `burst` back to back.
+
+        One atomic script call per request on Redis; the in-memory limiter takes
+        over (per process) while the storage is in fallback mode.
+        """
         def decorator(fn):
             @wraps(fn)
             def wrapper(*args, **kwargs):
-                if storage._use_fallback:
-                    # Skip rate limiting when Redis is not available
-                    return fn(*args, **kwargs)
-
-                try:
-                    ip = request.headers.get('X-Forwarded-For', request.remote_addr) or 'unknown'
-                    
-                    # Enhanced rate limiting with sliding window
-                    key = f"{s.redis_namespace}:rl:{ip}:{request.endpoint}"
-                    now = int(time.time())
-                    
-                    if not storage._r.ping():
-                        storage._use_fallback = True
-                        return fn(*args, **kwargs)
-
-                    # Sliding window rate limiting
-                    pipe = storage._r.pipeline()
-                    pipe.zremrangebyscore(key, 0, now - 60)  # Remove old entries
-                    pipe.zcard(key)  # Count current entries
-                    pipe.zadd(key, {str(now): now})  # Add current request
-                    pipe.expire(key, 60)  # Set expiry
-                    
-                    results = pipe.execute()
-                    current_count = results[1]
-                    
-                    if current_count > limit:
-                        return jsonify({
-                            "error": "rate_limited", 
-                            "message": f"Too many requests. Limit: {limit} per minute",
-                            "retry_after": 60
-                        }), 429
-                    
-                    return fn(*args, **kwargs)
-                except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-                    storage._use_fallback = True
-                    return fn(*args, **kwargs)
+                limit_ = limit or s.rate_limit_per_minute
+                result = limiter.check(limiter.key(client_ip(), request.endpoint), limit_, 60, burst or s.rate_limit_burst)
+                headers = result.headers()
+                if not result.allowed:
+                    return jsonify({
+                        "error": "rate_limited",
+                        "message": f"Too many requests. Limit: {limit_} per minute",
+                        "retry_after": int(headers['Retry-After'])
+                    }), 429, headers
+
+                resp = make_response(fn(*args, **kwargs))
+                resp.headers.update(headers)
+                return resp
             return wrapper
         return decorator
 
+    # Verification failures that count towards an IP block (wrong guesses, not expired/used codes)
+    guess_failures = {'invalid', 'locked', 'invalid_token', 'not_enrolled', 'email_mismatch'}
+
+    def block_failed_guesses(fn):
+        """Reject IPs blocked by the SecurityManager before any other work (including rate limiting)."""
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            ip = client_ip()
+            if security.is_ip_blocked(ip):
+                VERIFY_FAIL.labels(reason='ip_blocked').inc()
+                retry_after = max(1, int(security.blocked_for(ip)))
+                resp, status = json_response(fn.__name__, {
+                    "valid": False,
+                    "success": False,
+                    "error": "ip_blocked",
+                    "message": "Too many failed attempts, try again later",
+                    "retry_after": retry_after
+                }, 429)
+                return resp, status, {'Retry-After': str(retry_after)}
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def parse_max_attempts(payload):
+        """(max_attempts or None for the OTP_MAX_ATTEMPTS default, error message)"""
+        value = payload.get('max_attempts')
+        if value is None:
+            return None, None
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            return None, "max_attempts must be an integer"
+        if value < 1:
+            return None, "max_attempts must be at least 1"
+        return value, None
+
+    def parse_window(value):
+        """(window in time steps, error message); None selects TOTP_DEFAULT_WINDOW"""
+        if value is None:
+            return min(s.totp_default_window, s.totp_max_window), None
+        try:
+            if isinstance(value, bool):
+                raise TypeError
+            value = int(value)
+        except (TypeError, ValueError):
+            return None, "window must be an integer"
+        if not 0 <= value <= s.totp_max_window:
+            return None, f"window must be between 0 and {s.totp_max_window}"
+        return value, None
+
     def is_admin_request() -> bool:
         auth = request.headers.get('Authorization', '')
         if not auth:
@@ -174,6 +200,27 @@ def create_app() -> Flask:
         REQ_COUNTER.labels(handler=handler_name, method=request.method, code=str(status)).inc()
         return jsonify(data), status
 
+    def queue_email(to_email: str, code: str, organization: Optional[str], subject: Optional[str],
+                    purpose: str, ttl: int, locale: Optional[str] = None):
+        """Validate and enqueue an OTP email in the caller's language (explicit locale, else Accept-Language).
+
+        Returns (status, fields for the response body): 202 when queued, 400 when the
+        request is rejected up front, 503 when the queue is full.
+        """
+        status = 400
+        error = email_service.check_request(to_email, subject, purpose)
+        if error is None and not email_service.smtp_configured():
+            error = email_service.not_configured_message(to_email, code)
+        if error is None:
+            try:
+                locale = locale or request.accept_languages.best_match(list(EMAIL_LOCALES))
+                job_id = email_dispatcher.submit(to_email, code, organization, subject, ttl, locale)
+                return 202, {"email_status": "queued", "email_job_id": job_id}
+            except EmailQueueFull as e:
+                status, error = 503, f"{e}, try again later"
+        EMAIL_FAILED.inc()
+        return status, {"email_sent": False, "email_error": error}
+
     def validate_length_ttl(length: int, ttl: int) -> Optional[str]:
         if not (4 <= length <= 20):
             return "Invalid length"
@@ -181,6 +228,12 @@ def create_app() -> Flask:
             return "Invalid ttl"
         return None
 
+    def validate_charset(charset) -> Optional[str]:
+        # a charset name or a literal alphabet; null selects the default
+        if charset is not None and not isinstance(charset, str):
+            return "charset must be a string"
+        return None
+
     @app.route('/health/live')
     @app.route('/healthz')
     @cross_origin(origins=["http://localhost:3000", "http://127.0.0.1:3000"], supports_credentials=True)
@@ -196,111 +249,63 @@ def create_app() -> Flask:
         if request.method == 'OPTIONS':
             READINESS_DURATION.observe(time.time() - _ready_start)
             return ('', 204)
+        # Health is tracked from command outcomes and a background heartbeat, so no PING here.
         # If Redis fallback is active, we still consider the service operational but degraded
-        if getattr(storage, '_use_fallback', False):
-            READINESS_DURATION.observe(time.time() - _ready_start)
-            return json_response('ready', {"ready": True, "degraded": True, "storage": "memory"})
-        try:
-            storage._r.ping()
-            READINESS_DURATION.observe(time.time() - _ready_start)
-            return json_response('ready', {"ready": True, "degraded": False, "storage": "redis"})
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            # Switch to degraded mode implicitly and report as ready but degraded
-            storage._use_fallback = True
+        if not storage.redis_healthy:
             READINESS_DURATION.observe(time.time() - _ready_start)
             return json_response('ready', {"ready": True, "degraded": True, "storage": "memory"})
+        READINESS_DURATION.observe(time.time() - _ready_start)
+        return json_response('ready', {"ready": True, "degraded": False, "storage": "redis"})
 
     @app.route('/metrics')
     def metrics():
-        return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+        return generate_latest(collector_registry()), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
     @app.route('/api/v1/metrics', methods=['GET'])
     @cross_origin(origins=["http://localhost:3000", "http://127.0.0.1:3000"], supports_credentials=True)
     def api_metrics():
         """Comprehensive metrics API for the monitoring dashboard"""
-        import psutil
-        import os
-        from datetime import datetime, timezone
-        
-        # Get Prometheus metrics
-        metrics_text = generate_latest().decode('utf-8')
-        
-        # Parse metrics
-        metrics_data = {}
-        for line in metrics_text.split('\n'):
-            if line and not line.startswith('#'):
-                parts = line.split(' ')
-                if len(parts) >= 2:
-                    metric_name = parts[0]
-                    try:
-                        value = float(parts[1])
-                        metrics_data[metric_name] = value
-                    except ValueError:
-                        continue
-        
-        # Calculate derived metrics
-        total_otps = metrics_data.get('otp_generate_total', 0)
-        successful_verifications = metrics_data.get('otp_verify_success_total', 0)
-        failed_verifications = metrics_data.get('otp_verify_fail_total', 0)
-        emails_sent = metrics_data.get('otp_email_sent_total', 0)
-        emails_failed = metrics_data.get('otp_email_failed_total', 0)
+        # Counters come straight from the registry (every worker's in multiprocess mode);
+        # host stats from the background sampler
+        totals = collect_totals()
+        total_otps = sample_sum(GEN_COUNT, totals=totals)
+        successful_verifications = sample_sum(VERIFY_OK, totals=totals)
+        failed_verifications = sample_sum(VERIFY_FAIL, totals=totals)
+        emails_sent = sample_sum(EMAIL_SENT, totals=totals)
+        emails_failed = sample_sum(EMAIL_FAILED, totals=totals)
         
         # Calculate success rate
         total_verifications = successful_verifications + failed_verifications
         success_rate = (successful_verifications / total_verifications * 100) if total_verifications > 0 else 0
         
-        # System metrics
-        try:
-            cpu_percent = psutil.cpu_percent(interval=1)
-            memory = psutil.virtual_memory()
-            memory_percent = memory.percent
-            
-            # Calculate uptime
-            boot_time = psutil.boot_time()
-            current_time = time.time()
-            uptime_seconds = current_time - boot_time
-            
-            # Format uptime
-            days = int(uptime_seconds // 86400)
-            hours = int((uptime_seconds % 86400) // 3600)
-            minutes = int((uptime_seconds % 3600) // 60)
-            
-            if days > 0:
-                uptime_str = f"{days}d {hours}h {minutes}m"
-            elif hours > 0:
-                uptime_str = f"{hours}h {minutes}m"
-            else:
-                uptime_str = f"{minutes}m"
-                
-        except Exception:
-            cpu_percent = 0
-            memory_percent = 0
-            uptime_str = "Unknown"
-        
-        # Active connections (approximate)
-        try:
-            connections = len(psutil.net_connections())
-        except Exception:
-            connections = 0
+        system = system_sampler.snapshot
         
-        # Response time (average from histogram)
+        # Response time (average over all handlers and methods since start)
         response_time = 0
-        if 'http_request_duration_seconds_sum' in metrics_data and 'http_request_duration_seconds_count' in metrics_data:
-            total_time = metrics_data['http_request_duration_seconds_sum']
-            total_requests = metrics_data['http_request_duration_seconds_count']
-            if total_requests > 0:
-                response_time = (total_time / total_requests) * 1000  # Convert to milliseconds
+        total_requests = sample_sum(LATENCY, '_count', totals)
+        if total_requests > 0:
+            response_time = (sample_sum(LATENCY, '_sum', totals) / total_requests) * 1000  # Convert to milliseconds
+        
+        # Tail latency over the last 5 minutes, across all handlers and per series
+        # (and across workers when they share PROMETHEUS_MULTIPROC_DIR)
+        http_series = latency_aggregator.series('http:')
+        recent = latency_aggregator.combined(http_series, 300)
         
         return json_response('metrics', {
             'totalOTPs': int(total_otps),
             'successRate': round(success_rate, 1),
             'emailsSent': int(emails_sent),
             'emailsFailed': int(emails_failed),
-            'uptime': uptime_str,
-            'cpuUsage': round(cpu_percent, 1),
-            'memoryUsage': round(memory_percent, 1),
-            'activeConnections': connections,
+            'uptime': system['uptime'],
+            'cpuUsage': round(system['cpu_percent'], 1),
+            'memoryUsage': round(system['memory_percent'], 1),
+            'activeConnections': system['connections'],
             'responseTime': round(response_time, 2),
+            'responseTimeP50': recent['p50'],
+            'responseTimeP95': recent['p95'],
+            'responseTimeP99': recent['p99'],
+            'latency': latency_aggregator.summary(),
+            'latencyProcesses': latency_aggregator.processes(),
             'storage': 'redis' if not getattr(storage, '_use_fallback', False) else 'memory',
             'timestamp': datetime.now(timezone.utc).isoformat()
         })
@@ -323,52 +328,126 @@ def create_app() -> Flask:
         email_subject = payload.get('email_subject')
         send_email = payload.get('send_email', False)
 
-        err = validate_length_ttl(length, ttl)
+        max_attempts, attempts_err = parse_max_attempts(payload)
+        err = validate_length_ttl(length, ttl) or validate_charset(charset) or attempts_err
         if err:
             VERIFY_FAIL.labels(reason='invalid_request').inc()
             return json_response('create_otp', {"error": err}, 400)
 
         code = generate_code(length, charset)
-        hmac_value, salt = hash_code_with_salt(code)
         otp_id = new_otp_id()
-        storage.create(otp_id, hmac_value, salt, ttl, subject, purpose)
-        OTP_GENERATE_DURATION.observe(time.time() - op_start)
+        hmac_value, salt = hash_code_with_salt(code, otp_id)
+        storage.create(otp_id, hmac_value, salt, ttl, subject, purpose, max_attempts)
+        observe_duration(OTP_GENERATE_DURATION, time.time() - op_start)
         GEN_COUNT.inc()
         expires_at = datetime.now(timezone.utc).timestamp() + ttl
 
         body = {
             "id": otp_id,
             "ttl": ttl,
+            "max_attempts": max_attempts or s.otp_max_attempts,
             "expires_at": datetime.fromtimestamp(expires_at, tz=timezone.utc).isoformat()
         }
 
-        # Send email if requested and email provided
+        # Queue the email if requested; delivery status is polled via /api/v1/email/<job_id>
+        status_code = 201
         if send_email and email:
-            email_start = time.time()
-            success, message = email_service.send_otp_email(
-                to_email=email,
-                otp_code=code,
-                organization=organization,
-                subject=email_subject,
-                purpose=purpose or ""
-            )
-            EMAIL_SEND_DURATION.observe(time.time() - email_start)
-
-            if success:
-                EMAIL_SENT.inc()
-                body["email_sent"] = True
-                body["email_message"] = message
-            else:
-                EMAIL_FAILED.inc()
-                body["email_sent"] = False
-                body["email_error"] = message
+            email_status, fields = queue_email(email, code, organization, email_subject, purpose or "", ttl,
+                                               payload.get('locale'))
+            body.update(fields)
+            if email_status == 202:
+                status_code = 202
 
         # Include code in response for debug/admin requests
         if s.debug or is_admin_request() or request.args.get('debug') == 'true':
             body["code"] = code
 
-        LATENCY.labels('create_otp', request.method).observe(time.time() - start)
-        return json_response('create_otp', body, 201)
+        observe_latency('create_otp', request.method, time.time() - start)
+        return json_response('create_otp', body, status_code)
+
+    @app.route('/api/v1/otp/batch', methods=['POST'])
+    @rate_limit()
+    def create_otp_batch():
+        """Issue many OTPs in one request and persist them with a single storage flush"""
+        start = time.time()
+        payload = request.get_json(force=True, silent=True) or {}
+        specs = payload.get('items')
+
+        if not isinstance(specs, list) or not specs:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('create_otp_batch', {"error": "items must be a non-empty list"}, 400)
+        if len(specs) > s.otp_batch_max_items:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('create_otp_batch', {
+                "error": f"Too many items. Limit: {s.otp_batch_max_items} per batch"
+            }, 400)
+
+        # Validate the whole batch before generating anything
+        max_attempts, err = parse_max_attempts(payload)
+        if err:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('create_otp_batch', {"error": err}, 400)
+        parsed = []
+        for i, spec in enumerate(specs):
+            try:
+                if not isinstance(spec, dict):
+                    raise TypeError
+                length = int(spec.get('length', s.otp_default_length))
+                ttl = int(spec.get('ttl', s.otp_default_ttl_seconds))
+            except (TypeError, ValueError):
+                VERIFY_FAIL.labels(reason='invalid_request').inc()
+                return json_response('create_otp_batch', {"error": "Invalid item", "index": i}, 400)
+            charset = spec.get('charset', 'digits')
+            err = validate_length_ttl(length, ttl) or validate_charset(charset)
+            if err:
+                VERIFY_FAIL.labels(reason='invalid_request').inc()
+                return json_response('create_otp_batch', {"error": err, "index": i}, 400)
+            parsed.append((length, ttl, spec.get('subject'), spec.get('purpose'), charset, spec.get('email')))
+
+        include_codes = s.debug or is_admin_request() or request.args.get('debug') == 'true'
+        now = datetime.now(timezone.utc).timestamp()
+        records = []
+        items = []
+        recipients = []
+        for length, ttl, subject, purpose, charset, email in parsed:
+            code = generate_code(length, charset)
+            otp_id = new_otp_id()
+            hmac_value, salt = hash_code_with_salt(code, otp_id)
+            records.append((otp_id, hmac_value, salt, ttl, subject, purpose))
+            item = {
+                "id": otp_id,
+                "ttl": ttl,
+                "expires_at": datetime.fromtimestamp(now + ttl, tz=timezone.utc).isoformat()
+            }
+            if include_codes:
+                item["code"] = code
+            items.append(item)
+            if email:
+                recipients.append((email, code, ttl))
+
+        storage.create_many(records, max_attempts)
+        GEN_COUNT.inc(len(records))
+        body = {"items": items, "count": len(items)}
+        status_code = 201
+
+        # Items carrying an "email" are mailed as one bulk job over a few shared SMTP sessions
+        if recipients:
+            if not email_service.smtp_configured():
+                EMAIL_FAILED.inc(len(recipients))
+                body["email_error"] = "SMTP not configured"
+            else:
+                try:
+                    body["email_job_id"] = email_dispatcher.submit_bulk(
+                        recipients, payload.get('organization'), payload.get('email_subject'),
+                        locale=payload.get('locale'))
+                    body["email_status"] = "queued"
+                    status_code = 202
+                except EmailQueueFull as e:
+                    EMAIL_FAILED.inc(len(recipients))
+                    body["email_error"] = f"{e}, try again later"
+
+        observe_latency('create_otp_batch', request.method, time.time() - start)
+        return json_response('create_otp_batch', body, status_code)
 
     @app.route('/api/v1/otp/generate', methods=['POST'])
     @rate_limit()
@@ -397,118 +476,200 @@ def create_app() -> Flask:
         }
         charset = charset_map.get(otp_type, 'digits')
 
-        err = validate_length_ttl(length, ttl)
+        max_attempts, attempts_err = parse_max_attempts(payload)
+        err = validate_length_ttl(length, ttl) or attempts_err
         if err:
             VERIFY_FAIL.labels(reason='invalid_request').inc()
             return json_response('generate_otp_email', {"error": err}, 400)
 
         # Generate OTP
         code = generate_code(length, charset)
-        hmac_value, salt = hash_code_with_salt(code)
         otp_id = new_otp_id()
-        storage.create(otp_id, hmac_value, salt, ttl, email, f"email_otp_{otp_type}")
-        OTP_GENERATE_DURATION.observe(time.time() - op_start)
+        hmac_value, salt = hash_code_with_salt(code, otp_id)
+        storage.create(otp_id, hmac_value, salt, ttl, email, f"email_otp_{otp_type}", max_attempts)
+        observe_duration(OTP_GENERATE_DURATION, time.time() - op_start)
         GEN_COUNT.inc()
 
-        # Send email
-        email_start = time.time()
-        success, message = email_service.send_otp_email(
-            to_email=email,
-            otp_code=code,
-            organization=organization,
-            subject=email_subject,
-            purpose=f"OTP verification - {otp_type}"
-        )
-        EMAIL_SEND_DURATION.observe(time.time() - email_start)
-
-        if success:
-            EMAIL_SENT.inc()
+        # Queue the email; the SMTP round-trip happens on a dispatcher worker
+        status_code, fields = queue_email(email, code, organization, email_subject, f"OTP verification - {otp_type}",
+                                          ttl, payload.get('locale'))
+
+        if status_code == 202:
             body = {
                 "success": True,
-                "message": f"OTP sent to {email}",
+                "message": f"OTP queued for {email}",
                 "otp_id": otp_id,
                 "type": otp_type,
-                "expires_in": ttl
+                "expires_in": ttl,
+                **fields
             }
-            status_code = 200
         else:
-            EMAIL_FAILED.inc()
             body = {
                 "success": False,
-                "error": message,
+                "error": fields["email_error"],
                 "otp_id": otp_id,
                 "type": otp_type,
                 "expires_in": ttl
             }
-            status_code = 400
 
         # Include code in response for debug/admin requests
         if s.debug or is_admin_request() or request.args.get('debug') == 'true':
             body["code"] = code
 
-        LATENCY.labels('generate_otp_email', request.method).observe(time.time() - start)
+        observe_latency('generate_otp_email', request.method, time.time() - start)
         return json_response('generate_otp_email', body, status_code)
 
+    @app.route('/api/v1/email/<job_id>', methods=['GET'])
+    def get_email_status(job_id: str):
+        """Delivery status of a queued OTP email: queued, retrying, sent or failed (bulk jobs: sending, partial)"""
+        status = email_dispatcher.status(job_id)
+        if status is None:
+            return json_response('email_status', {"error": "Unknown or expired email job"}, 404)
+        body = {
+            "job_id": job_id,
+            "status": status.get("status"),
+            "attempts": int(status.get("attempts", 0)),
+            "error": status.get("error"),
+            "updated_at": int(status.get("updated_at", 0)),
+        }
+        if "total" in status:
+            body["total"] = int(status["total"])
+            body["sent"] = int(status.get("sent", 0))
+            body["failed"] = int(status.get("failed", 0))
+            body["failures"] = json.loads(status.get("failures", "[]"))
+        return json_response('email_status', body)
+
     @app.route('/api/v1/totp/setup', methods=['POST'])
+    @block_failed_guesses
     @rate_limit()
     def setup_totp():
-        """Configure TOTP for a user/account"""
+        """Configure TOTP for a user/account (replacing an enrollment needs the admin token or a current code)"""
         start = time.time()
         payload = request.get_json(force=True, silent=True) or {}
         
         account_name = payload.get('account_name')
         issuer = payload.get('issuer', s.totp_issuer)
+        qr_format = payload.get('qr_format', 'png')
         
         if not account_name:
             return json_response('setup_totp', {"error": "account_name is required"}, 400)
+        if qr_format not in QR_FORMATS:
+            return json_response('setup_totp', {"error": f"qr_format must be one of {', '.join(QR_FORMATS)}"}, 400)
         
-        # Generate TOTP secret and URI
-        secret = totp_service.generate_secret()
+        # An existing enrollment is only replaced on request, by an admin or by someone
+        # who proves they hold it with a current code; otherwise anyone could take it over
+        replace = payload.get('replace') is True
+        if replace and not is_admin_request():
+            valid, reason = totp_service.verify_enrolled(storage, account_name, str(payload.get('token', '')),
+                                                         s.totp_default_window)
+            if not valid and reason != 'not_enrolled':
+                VERIFY_FAIL.labels(reason=reason).inc()
+                if reason in guess_failures:
+                    security.record_failed_attempt(client_ip())
+                return json_response('setup_totp', {
+                    "error": "A valid current token is required to replace the enrollment",
+                    "reason": reason
+                }, 403)
+            replace = valid
+
+        # Enroll server-side (secret stored encrypted) and build the URI
+        enrolled = totp_service.enroll(storage, account_name, issuer, replace=replace)
+        if enrolled is None:
+            return json_response('setup_totp', {
+                "error": "Account already enrolled; send replace=true with a current token to re-enroll"
+            }, 409)
+        enrollment_id, secret = enrolled
         totp_uri = totp_service.get_totp_uri(secret, account_name, issuer)
         
-        # Generate QR code
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(totp_uri)
-        qr.make(fit=True)
-        
-        # Convert QR code to base64 image
-        img_buffer = io.BytesIO()
-        qr.make_image(fill_color="black", back_color="white").save(img_buffer, format='PNG')
-        qr_base64 = base64.b64encode(img_buffer.getvalue()).decode()
-        
         response = {
+            "enrollment_id": enrollment_id,
             "secret": secret,
             "uri": totp_uri,
-            "qr_code": f"data:image/png;base64,{qr_base64}",
+            "qr_url": f"/api/v1/totp/qr/{enrollment_id}",
             "account_name": account_name,
             "issuer": issuer
         }
         
-        LATENCY.labels('setup_totp', request.method).observe(time.time() - start)
+        # Inline QR image (rendered off-thread in the QR process pool); "uri" leaves it to the
+        # client or to a later GET on qr_url
+        if qr_format != 'uri':
+            try:
+                image = qr_renderer.render(totp_uri, qr_format)
+                response["qr_code"] = f"data:{QR_MIMETYPES[qr_format]};base64,{base64.b64encode(image).decode()}"
+            except QRRenderTimeout as e:
+                # The enrollment is saved: answer with the URI, the image stays available at qr_url
+                print(f"⚠️  {e}; answering setup without the inline QR code")
+        
+        observe_latency('setup_totp', request.method, time.time() - start)
         return json_response('setup_totp', response)
 
+    @app.route('/api/v1/totp/qr/<enrollment_id>', methods=['GET'])
+    @rate_limit()
+    def totp_qr(enrollment_id: str):
+        """QR image of a recent enrollment (?format=png|svg), served for TOTP_QR_TTL_SECONDS after setup"""
+        fmt = request.args.get('format', 'png')
+        if fmt not in QR_MIMETYPES:
+            return json_response('totp_qr', {"error": "format must be png or svg"}, 400)
+
+        etag = f'"{enrollment_id}-{fmt}"'
+        found = totp_service.enrollment_uri(storage, enrollment_id)
+        if found is None:
+            return json_response('totp_qr', {"error": "Unknown or expired enrollment"}, 404)
+        totp_uri, remaining = found
+        # The image never changes for an enrollment; only the requester's browser may keep it
+        headers = {
+            'Cache-Control': f'private, max-age={remaining}',
+            'ETag': etag,
+        }
+        if request.headers.get('If-None-Match') == etag:
+            REQ_COUNTER.labels(handler='totp_qr', method=request.method, code='304').inc()
+            return '', 304, headers
+
+        try:
+            image = qr_renderer.render(totp_uri, fmt)
+        except QRRenderTimeout:
+            resp, status = json_response('totp_qr', {"error": "QR rendering is busy, try again"}, 503)
+            return resp, status, {'Retry-After': '1'}
+        REQ_COUNTER.labels(handler='totp_qr', method=request.method, code='200').inc()
+        return image, 200, {**headers, 'Content-Type': QR_MIMETYPES[fmt]}
+
     @app.route('/api/v1/totp/verify', methods=['POST'])
+    @block_failed_guesses
     @rate_limit()
     def verify_totp():
-        """Verify a TOTP code"""
+        """Verify a TOTP code for an enrolled account (or, statelessly, against a raw secret)"""
         start = time.time()
         verify_start = time.time()
         payload = request.get_json(force=True, silent=True) or {}
         
+        account_name = payload.get('account_name')
         secret = payload.get('secret')
         token = payload.get('token')
-        window = int(payload.get('window', s.totp_default_window))
+        window, window_error = parse_window(payload.get('window'))
+        if window_error:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('verify_totp', {
+                "valid": False,
+                "success": False,
+                "reason": "invalid_window",
+                "message": window_error
+            }, 400)
         
-        if not secret or not token:
+        if not (account_name or secret) or not token:
             VERIFY_FAIL.labels(reason='invalid_request').inc()
             return json_response('verify_totp', {
                 "valid": False,
                 "success": False,
                 "reason": "missing_parameters",
-                "message": "Both secret and token are required"
+                "message": "account_name (or secret) and token are required"
             }, 400)
         
-        valid, reason = totp_service.verify_totp(secret, token, window)
+        if account_name:
+            # Server-side enrollment: verify and record the time step atomically (no replay)
+            valid, reason = totp_service.verify_enrolled(storage, account_name, token, window)
+        else:
+            # Legacy stateless mode: the caller sends the secret, no replay protection
+            valid, reason = totp_service.verify_totp(secret, token, window)
         
         if valid:
             VERIFY_OK.inc()
@@ -520,6 +681,11 @@ def create_app() -> Flask:
             }
         else:
             VERIFY_FAIL.labels(reason=reason).inc()
+            if reason in guess_failures:
+                security.record_failed_attempt(client_ip())
+            # Don't reveal which accounts are enrolled
+            if reason == 'not_enrolled':
+                reason = 'invalid_token'
             response = {
                 "valid": False,
                 "success": False,
@@ -527,11 +693,78 @@ def create_app() -> Flask:
                 "message": f"TOTP verification failed: {reason}"
             }
         
-        TOTP_VERIFY_DURATION.observe(time.time() - verify_start)
-        LATENCY.labels('verify_totp', request.method).observe(time.time() - start)
+        observe_duration(TOTP_VERIFY_DURATION, time.time() - verify_start)
+        observe_latency('verify_totp', request.method, time.time() - start)
         return json_response('verify_totp', response)
 
+    @app.route('/api/v1/totp/verify/batch', methods=['POST'])
+    @block_failed_guesses
+    @rate_limit()
+    def verify_totp_batch():
+        """Verify many (account_name or secret, token) pairs in one request"""
+        start = time.time()
+        payload = request.get_json(force=True, silent=True) or {}
+        specs = payload.get('items')
+
+        if not isinstance(specs, list) or not specs:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('verify_totp_batch', {"error": "items must be a non-empty list"}, 400)
+        if len(specs) > s.totp_batch_max_items:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('verify_totp_batch', {
+                "error": f"Too many items. Limit: {s.totp_batch_max_items} per batch"
+            }, 400)
+
+        default_window, window_error = parse_window(payload.get('window'))
+        if window_error:
+            VERIFY_FAIL.labels(reason='invalid_request').inc()
+            return json_response('verify_totp_batch', {"error": window_error}, 400)
+        parsed = []
+        for i, spec in enumerate(specs):
+            if not isinstance(spec, dict):
+                VERIFY_FAIL.labels(reason='invalid_request').inc()
+                return json_response('verify_totp_batch', {"error": "Invalid item", "index": i}, 400)
+            window, window_error = parse_window(spec['window']) if 'window' in spec else (default_window, None)
+            if window_error:
+                VERIFY_FAIL.labels(reason='invalid_request').inc()
+                return json_response('verify_totp_batch', {"error": window_error, "index": i}, 400)
+            account_name, secret, token = spec.get('account_name'), spec.get('secret'), spec.get('token')
+            if not (account_name or secret) or not token or not all(
+                    value is None or isinstance(value, str) for value in (account_name, secret, token)):
+                VERIFY_FAIL.labels(reason='invalid_request').inc()
+                return json_response('verify_totp_batch', {
+                    "error": "Each item needs account_name (or secret) and token, as strings", "index": i
+                }, 400)
+            parsed.append((account_name, secret, token, window))
+
+        items = []
+        valid_count = 0
+        guesses = 0
+        for i, (valid, reason) in enumerate(totp_service.verify_batch(storage, parsed)):
+            if valid:
+                VERIFY_OK.inc()
+                valid_count += 1
+            else:
+                VERIFY_FAIL.labels(reason=reason).inc()
+                guesses += reason in guess_failures
+                # Don't reveal which accounts are enrolled
+                if reason == 'not_enrolled':
+                    reason = 'invalid_token'
+            items.append({"index": i, "valid": valid, "reason": reason})
+
+        if guesses:
+            security.record_failed_attempt(client_ip(), guesses)
+        TOTP_VERIFY_BATCH_DURATION.observe(time.time() - start)
+        observe_latency('verify_totp_batch', request.method, time.time() - start)
+        return json_response('verify_totp_batch', {
+            "items": items,
+            "count": len(items),
+            "valid": valid_count,
+            "invalid": len(items) - valid_count,
+        })
+
     @app.route('/api/v1/otp/verify', methods=['POST'])
+    @block_failed_guesses
     @rate_limit()
     def verify_otp():
         start = time.time()
@@ -545,26 +778,22 @@ def create_app() -> Flask:
             VERIFY_FAIL.labels(reason='invalid_request').inc()
             return json_response('verify_otp', {"valid": False, "reason": "invalid"}, 400)
 
-        meta = storage.get_meta(otp_id)
-        if not meta:
-            VERIFY_FAIL.labels(reason='not_found').inc()
-            return json_response('verify_otp', {"valid": False, "reason": "invalid"}, 200)
-
-        # Optional email validation
-        if email and meta.get('subject') and meta.get('subject') != email:
-            VERIFY_FAIL.labels(reason='email_mismatch').inc()
+        # Lookup, optional email match, compare and consume happen in one storage call
+        ok, reason = storage.check_and_consume(otp_id, code, email)
+        if reason in guess_failures:
+            security.record_failed_attempt(client_ip())
+        if reason in ('not_found', 'email_mismatch'):
+            VERIFY_FAIL.labels(reason=reason).inc()
             return json_response('verify_otp', {"valid": False, "reason": "invalid"}, 200)
 
-        hmac_candidate = compute_hmac(s.otp_pepper.encode('utf-8'), code, meta.get('salt', ''))
-        ok, reason = storage.verify_and_consume(otp_id, hmac_candidate)
         if ok:
             VERIFY_OK.inc()
             resp = {"valid": True, "success": True, "reason": "ok", "message": "OTP verified successfully"}
         else:
             VERIFY_FAIL.labels(reason=reason).inc()
             resp = {"valid": False, "success": False, "reason": reason, "message": f"OTP verification failed: {reason}"}
-        OTP_VERIFY_DURATION.observe(time.time() - verify_start)
-        LATENCY.labels('verify_otp', request.method).observe(time.time() - start)
+        observe_duration(OTP_VERIFY_DURATION, time.time() - verify_start)
+        observe_latency('verify_otp', request.method, time.time() - start)
         return json_response('verify_otp', resp)
 
     # Admin GUI (Bearer token required)
@@ -613,26 +842,19 @@ def create_app() -> Flask:
         charset = charset_map.get(otp_type, 'digits')
 
         code = generate_code(length, charset)
-        hmac_value, salt = hash_code_with_salt(code)
         otp_id = new_otp_id()
+        hmac_value, salt = hash_code_with_salt(code, otp_id)
         storage.create(otp_id, hmac_value, salt, ttl, subject, purpose)
         session['last_code'] = code
 
-        # Send email if requested
+        # Queue email if requested
         if send_email and email:
-            success, message = email_service.send_otp_email(
-                to_email=email,
-                otp_code=code,
-                organization=s.organization_name,
-                subject=None,
-                purpose=f"{purpose or 'OTP'} - {otp_type}"
-            )
-            if success:
-                session['email_sent'] = f"Email sent to {email} (Type: {otp_type})"
-                EMAIL_SENT.inc()
+            email_status, fields = queue_email(email, code, s.organization_name, None, f"{purpose or 'OTP'} - {otp_type}",
+                                               ttl)
+            if email_status == 202:
+                session['email_sent'] = f"Email queued for {email} (Type: {otp_type}, job {fields['email_job_id']})"
             else:
-                session['email_error'] = f"Failed to send email: {message}"
-                EMAIL_FAILED.inc()
+                session['email_error'] = f"Failed to send email: {fields['email_error']}"
 
         return redirect('/')
 
@@ -640,24 +862,49 @@ def create_app() -> Flask:
     @admin_required
     def admin_list_api():
         # pagination and filters
-        limit = int(request.args.get('limit', 50))
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 1000)
+        except ValueError:
+            return json_response('admin_otps', {"error": "limit must be an integer"}, 400)
         subject = request.args.get('subject')
         purpose = request.args.get('purpose')
         status = request.args.get('status')
-        items = storage.list_active(limit=limit, subject=subject, purpose=purpose, status=status)
-        return json_response('admin_otps', {"items": items, "count": len(items)})
+        cursor = request.args.get('cursor')
+        items, next_cursor = storage.list_page(limit=limit, subject=subject, purpose=purpose, status=status,
+                                               cursor=cursor)
+        return json_response('admin_otps', {"items": items, "count": len(items), "next_cursor": next_cursor})
 
-    @app.route('/admin/purge', methods=['POST'])
+    @app.route('/admin/settings/reload', methods=['POST'])
+    @admin_required
+    def admin_reload_settings():
+        settings = _reload_settings()
+        if request.environ.get('SERVER_SOFTWARE', '').startswith('gunicorn/'):
+            # Reloading here would only reach this worker: have the master replace them all
+            # (post_worker_init reloads the settings in each new worker)
+            os.kill(os.getppid(), signal.SIGHUP)
+            return json_response('admin_reload_settings', {
+                "reloaded": True, "scope": "all_workers", "environment": settings.environment
+            }, 202)
+        return json_response('admin_reload_settings', {
+            "reloaded": True, "scope": "process", "environment": settings.environment
+        })
+
+    @app.route('/admin/purge', methods=['GET', 'POST'])
     @admin_required
     def admin_purge():
-        storage.purge_index()
-        return redirect('/')
+        # Purging runs as a bounded background job; POST only asks it to run now
+        if request.method == 'POST':
+            storage.purge_job.wake()
+            return json_response('admin_purge', {"scheduled": True, "last_run": storage.purge_progress}, 202)
+        return json_response('admin_purge', {"last_run": storage.purge_progress})
 
     return app
 
 
-# WSGI entrypoint
-app = create_app()
+# WSGI entrypoint. Skipped when multiprocessing re-imports this module as __mp_main__
+# in a spawned QR render worker (python -m app.main), which must not start a second app.
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     # Local development server
@@ -0,0 +1,426 @@
+"""Prometheus metrics declarations.
+
+Existing counters/histograms:
+  http_requests_total{handler,method,code}      - per-endpoint request counts
+  http_request_duration_seconds{handler,method} - per-endpoint total latency
+  otp_generate_total                            - count of OTPs generated
+  otp_verify_success_total                      - successful OTP/TOTP verifications
+  otp_verify_fail_total{reason}                 - failed OTP/TOTP verifications by reason
+  otp_email_sent_total                          - emails successfully sent
+  otp_email_failed_total                        - failed email send attempts
+
+Added granular histograms (requirement B: histogram/metrics):
+  otp_generate_duration_seconds                 - time to generate & persist an OTP (excludes email send)
+  otp_verify_duration_seconds                   - time to verify & consume an OTP
+  totp_verify_duration_seconds                  - time to verify a TOTP token
+  otp_email_send_duration_seconds               - time spent sending OTP email (SMTP interaction)
+  readiness_check_duration_seconds              - time spent performing readiness probe (Redis ping, logic)
+
+Storage mode (see docs/METRICS.md):
+  otp_storage_fallback                          - 1 while the in-memory fallback is active
+  otp_storage_transitions_total{to}             - storage mode changes
+  otp_fallback_replayed_total                   - OTPs replayed into Redis on recovery
+  otp_purge_removed_total                       - expired index entries removed by the purge job
+
+Rate limiting (see app/rate_limit.py):
+  otp_rate_limited_total{tier}                  - rejected requests by tier: local (no Redis call), shared, memory
+  otp_rate_limit_syncs_total                    - checks that went to the shared limiter
+
+With several worker processes (gunicorn), set PROMETHEUS_MULTIPROC_DIR before the
+app starts: every process then writes its values to files in that directory and
+collector_registry() merges them, so /metrics and the dashboard show the whole pod
+rather than the worker that happened to serve the scrape.
+
+The dashboard API reads these straight from the registry (collect_totals/sample_sum)
+and takes host stats from SystemSampler, which refreshes them on a background thread.
+Request, OTP generate/verify and TOTP verify latencies are also fed (through
+observe_latency/observe_duration) to LatencyAggregator, which keeps sliding-window
+quantile sketches for p50/p95/p99 reporting; in multiprocess mode it shares them
+through the same directory so the percentiles also cover every worker.
+"""
+import json
+import logging
+import math
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, Optional, Tuple
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+from . import jobs
+
+logger = logging.getLogger(__name__)
+
+# prometheus_client reads the variable when it is imported; this mirrors its choice
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR') or os.environ.get('prometheus_multiproc_dir')
+if MULTIPROC_DIR:
+    # the metrics below open their value files as soon as they are declared
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+REQ_COUNTER = Counter('http_requests_total', 'HTTP requests total', ['handler', 'method', 'code'])
+LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['handler', 'method'])
+GEN_COUNT = Counter('otp_generate_total', 'Number of OTP generated')
+VERIFY_OK = Counter('otp_verify_success_total', 'Number of successful OTP verifications')
+VERIFY_FAIL = Counter('otp_verify_fail_total', 'Number of failed OTP verifications', ['reason'])
+EMAIL_SENT = Counter('otp_email_sent_total', 'Number of OTP emails sent')
+EMAIL_FAILED = Counter('otp_email_failed_total', 'Number of failed OTP email sends')
+
+# New histograms (bucket choices tuned to expected latency distributions)
+OTP_GENERATE_DURATION = Histogram(
+    'otp_generate_duration_seconds',
+    'Time to generate and persist a single OTP (sans email send)',
+    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+OTP_VERIFY_DURATION = Histogram(
+    'otp_verify_duration_seconds',
+    'Time to verify and consume an OTP',
+    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+TOTP_VERIFY_DURATION = Histogram(
+    'totp_verify_duration_seconds',
+    'Time to verify a TOTP token over the configured window',
+    buckets=(0.001, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+)
+TOTP_VERIFY_BATCH_DURATION = Histogram(
+    'totp_verify_batch_duration_seconds',
+    'Time to verify a whole TOTP batch, including the storage round trips',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+EMAIL_SEND_DURATION = Histogram(
+    'otp_email_send_duration_seconds',
+    'Time spent sending OTP email via SMTP',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13)
+)
+READINESS_DURATION = Histogram(
+    'readiness_check_duration_seconds',
+    'Time to perform readiness probe (including Redis ping)',
+    buckets=(0.001, 0.003, 0.005, 0.01, 0.02, 0.05, 0.1)
+)
+
+# In multiprocess mode a gauge needs a merge rule: the pod is in fallback if any live worker is
+STORAGE_FALLBACK = Gauge('otp_storage_fallback', '1 while the in-memory fallback storage is active',
+                         multiprocess_mode='livemax')
+STORAGE_TRANSITIONS = Counter('otp_storage_transitions_total', 'Storage mode changes', ['to'])
+FALLBACK_REPLAYED = Counter('otp_fallback_replayed_total', 'OTPs replayed from the in-memory fallback into Redis')
+PURGE_REMOVED = Counter('otp_purge_removed_total', 'Expired entries removed by the background purge')
+RATE_LIMITED = Counter('otp_rate_limited_total', 'Requests rejected by the rate limiter', ['tier'])
+RATE_LIMIT_SYNCS = Counter('otp_rate_limit_syncs_total', 'Rate limit checks that went to the shared (Redis) limiter')
+
+
+def collector_registry() -> CollectorRegistry:
+    """Registry to expose: the process's own, or one merging every worker's files in multiprocess mode."""
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    return registry
+
+
+def collect_totals(registry: Optional[CollectorRegistry] = None) -> Dict[str, float]:
+    """Every sample of the registry summed over its label sets, keyed by sample name.
+
+    In multiprocess mode this reads each worker's file once, so callers needing
+    several values should collect once and pass the result to sample_sum.
+    """
+    totals: Dict[str, float] = {}
+    for family in (registry or collector_registry()).collect():
+        for sample in family.samples:
+            totals[sample.name] = totals.get(sample.name, 0.0) + sample.value
+    return totals
+
+
+def sample_sum(metric, suffix: str = "_total", totals: Optional[Dict[str, float]] = None) -> float:
+    """Sum of a metric's samples over all label sets, e.g. suffix '_total' for counters
+    or '_sum'/'_count' for histograms. Reads the registry directly (no text exposition)."""
+    if totals is None:
+        totals = collect_totals()
+    return sum(totals.get(family.name + suffix, 0.0) for family in metric.describe())
+
+
+def clear_multiproc_dir() -> None:
+    """Remove the previous run's value files; call once in the master before workers start."""
+    if not MULTIPROC_DIR:
+        return
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    for entry in os.scandir(MULTIPROC_DIR):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop a dead worker's live gauge files and latency sketches so they stop counting."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+        try:
+            os.remove(os.path.join(MULTIPROC_DIR, f"latency_{pid}.json"))
+        except FileNotFoundError:
+            pass
+
+
+def format_uptime(seconds: float) -> str:
+    days = int(seconds // 86400)
+    hours = int((seconds % 86400) // 3600)
+    minutes = int((seconds % 3600) // 60)
+    if days > 0:
+        return f"{days}d {hours}h {minutes}m"
+    if hours > 0:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
+
+
+class SystemSampler:
+    """Keeps a rolling snapshot of CPU, memory and connection stats.
+
+    psutil.cpu_percent(interval=None) measures CPU since the previous call, so
+    sampling on a background thread gives the same figure as a blocking
+    one-second measurement without ever blocking a request. Connections are
+    counted for this process only rather than walking every socket on the host.
+    """
+
+    def __init__(self, interval: float):
+        self.snapshot: Dict[str, Any] = {
+            "cpu_percent": 0.0,
+            "memory_percent": 0.0,
+            "connections": 0,
+            "uptime": "Unknown",
+            "sampled_at": None,
+        }
+        self._boot_time: Optional[float] = None
+        self._task = jobs.PeriodicTask("system-sampler", interval, self.sample)
+
+    def start(self) -> None:
+        self._task.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._task.stop(timeout)
+
+    def sample(self) -> None:
+        try:
+            import psutil
+
+            if self._boot_time is None:
+                self._boot_time = psutil.boot_time()
+            proc = psutil.Process()
+            # psutil >= 6 renamed Process.connections to net_connections
+            connections = getattr(proc, "net_connections", None) or proc.connections
+            snapshot = {
+                "cpu_percent": psutil.cpu_percent(interval=None),
+                "memory_percent": psutil.virtual_memory().percent,
+                "connections": len(connections(kind="inet")),
+                "uptime": format_uptime(time.time() - self._boot_time),
+                "sampled_at": time.time(),
+            }
+        except Exception:
+            logger.exception("System stats sampling failed")
+            return
+        # swap the whole dict so readers never see a half-updated snapshot
+        self.snapshot = snapshot
+
+
+class LogSketch:
+    """Streaming quantile sketch with logarithmic buckets (relative error <= accuracy).
+
+    Each value v > 0 lands in bucket ceil(log_gamma(v)), gamma = (1+a)/(1-a), so memory
+    grows with the dynamic range of the data, not with the number of observations,
+    and sketches merge by adding bucket counts.
+    """
+
+    __slots__ = ("_gamma", "_log_gamma", "buckets", "count", "zeros")
+
+    MIN_VALUE = 1e-6  # 1µs; anything smaller is counted as zero
+
+    def __init__(self, accuracy: float = 0.01):
+        self._gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.zeros = 0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if value < self.MIN_VALUE:
+            self.zeros += 1
+            return
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: "LogSketch") -> None:
+        self.count += other.count
+        self.zeros += other.zeros
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # midpoint of the bucket (gamma^(i-1), gamma^i]
+                return 2 * self._gamma ** index / (self._gamma + 1)
+        return None
+
+
+class LatencyAggregator:
+    """Per-series latency sketches over sliding windows.
+
+    Time is cut into slices of slice_seconds; each series keeps one sketch per
+    slice for the longest window, and a window's quantiles merge the slices it
+    covers. Observing is a dict lookup and a bucket increment under one lock.
+
+    With share_dir (the Prometheus multiprocess directory) each process also
+    writes its sketches there every publish_seconds, and quantiles merge every
+    other process's latest file with the local sketches, so a reading covers
+    the whole pod (other workers' data lagging by up to publish_seconds).
+    """
+
+    def __init__(self, windows: Tuple[int, ...] = (60, 300), slice_seconds: int = 10, accuracy: float = 0.01,
+                 share_dir: Optional[str] = None, publish_seconds: float = 5.0):
+        self.windows = windows
+        self.slice_seconds = slice_seconds
+        self.accuracy = accuracy
+        self.share_dir = share_dir
+        self._slices_kept = max(windows) // slice_seconds
+        self._series: Dict[str, Deque[Tuple[int, LogSketch]]] = {}
+        self._lock = threading.Lock()
+        self._task = jobs.PeriodicTask("latency-publish", publish_seconds, self.publish)
+
+    def start(self) -> None:
+        if self.share_dir:
+            self._task.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._task.stop(timeout)
+
+    def publish(self) -> None:
+        """Write this process's sketches to share_dir (atomically, via rename)."""
+        with self._lock:
+            data = {name: [[slice_id, sketch.count, sketch.zeros, sketch.buckets] for slice_id, sketch in ring]
+                    for name, ring in self._series.items()}
+        path = os.path.join(self.share_dir, f"latency_{os.getpid()}.json")
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(data, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            logger.exception("Failed to publish latency sketches")
+
+    def _peers(self) -> list:
+        """Other processes' published sketches, as {series: [(slice_id, LogSketch), ...]} dicts."""
+        if not self.share_dir:
+            return []
+        own = f"latency_{os.getpid()}.json"
+        peers = []
+        try:
+            entries = [e for e in os.scandir(self.share_dir)
+                       if e.name.startswith("latency_") and e.name.endswith(".json") and e.name != own]
+        except OSError:
+            return []
+        for entry in entries:
+            try:
+                with open(entry.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                # the worker exited (or the file is being replaced) since the scan
+                continue
+            rings = {}
+            for name, slices in data.items():
+                ring = []
+                for slice_id, count, zeros, buckets in slices:
+                    sketch = LogSketch(self.accuracy)
+                    sketch.count, sketch.zeros = count, zeros
+                    sketch.buckets = {int(index): n for index, n in buckets.items()}
+                    ring.append((slice_id, sketch))
+                rings[name] = ring
+            peers.append(rings)
+        return peers
+
+    def processes(self) -> int:
+        """Number of processes whose sketches a reading covers."""
+        return 1 + len(self._peers())
+
+    def observe(self, series: str, seconds: float) -> None:
+        slice_id = int(time.time() // self.slice_seconds)
+        with self._lock:
+            ring = self._series.get(series)
+            if ring is None:
+                ring = self._series[series] = deque()
+            if not ring or ring[-1][0] != slice_id:
+                ring.append((slice_id, LogSketch(self.accuracy)))
+                while ring[0][0] <= slice_id - self._slices_kept:
+                    ring.popleft()
+            ring[-1][1].add(seconds)
+
+    def _merged(self, sources: list, series: Iterable[str], window: int, now_slice: int) -> LogSketch:
+        merged = LogSketch(self.accuracy)
+        oldest = now_slice - window // self.slice_seconds
+        for name in series:
+            for rings in sources:
+                for slice_id, sketch in rings.get(name, ()):
+                    if slice_id > oldest:
+                        merged.merge(sketch)
+        return merged
+
+    def summary(self, series: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        """{series: {"60s": {"count", "p50", "p95", "p99"}, ...}} with latencies in milliseconds."""
+        now_slice = int(time.time() // self.slice_seconds)
+        peers = self._peers()
+        with self._lock:
+            sources = [self._series, *peers]
+            names = list(series) if series is not None else sorted({name for rings in sources for name in rings})
+            return {name: {f"{window}s": self._describe(self._merged(sources, [name], window, now_slice))
+                           for window in self.windows}
+                    for name in names}
+
+    def combined(self, series: Iterable[str], window: int) -> Dict[str, Any]:
+        """Quantiles over several series merged together (e.g. every HTTP handler)."""
+        now_slice = int(time.time() // self.slice_seconds)
+        peers = self._peers()
+        with self._lock:
+            return self._describe(self._merged([self._series, *peers], list(series), window, now_slice))
+
+    def series(self, prefix: str = "") -> list:
+        peers = self._peers()
+        with self._lock:
+            return sorted({name for rings in (self._series, *peers) for name in rings if name.startswith(prefix)})
+
+    @staticmethod
+    def _describe(sketch: LogSketch) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"count": sketch.count}
+        for label, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+            value = sketch.quantile(q)
+            out[label] = round(value * 1000, 3) if value is not None else None
+        return out
+
+
+latency_aggregator = LatencyAggregator(share_dir=MULTIPROC_DIR)
+
+# Histograms whose observations are also tracked by the aggregator, by series name
+_AGGREGATED = {
+    OTP_GENERATE_DURATION: "otp_generate",
+    OTP_VERIFY_DURATION: "otp_verify",
+    TOTP_VERIFY_DURATION: "totp_verify",
+}
+
+
+def observe_latency(handler: str, method: str, seconds: float) -> None:
+    """Record a request latency in the http_request_duration_seconds histogram and the aggregator."""
+    LATENCY.labels(handler, method).observe(seconds)
+    latency_aggregator.observe(f"http:{handler}", seconds)
+
+
+def observe_duration(histogram: Histogram, seconds: float) -> None:
+    """Record an operation duration in its histogram and, for tracked ones, the aggregator."""
+    histogram.observe(seconds)
+    series = _AGGREGATED.get(histogram)
+    if series is not None:
+        latency_aggregator.observe(series, seconds)
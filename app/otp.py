@@ -3,7 +3,8 @@ import hmac
 import secrets
 import string
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
 from .config import get_settings
 
@@ -28,39 +29,81 @@ def _hash_code(code: str, salt: str) -> str:
     return compute_hmac(pepper_bytes, code, salt)
 
 
-def generate_code(length: int, charset: Optional[str] = None) -> str:
-    s = get_settings()
+class Alphabet:
+    """An alphabet prepared once for unbiased rejection sampling from random bytes."""
+
+    __slots__ = ("symbols", "size", "_table", "_reject")
+
+    def __init__(self, symbols: str):
+        self.symbols = symbols
+        self.size = len(symbols)
+        self._table = None
+        self._reject = b""
+        if self.size <= 256 and symbols.isascii():
+            # Bytes below the largest multiple of size map uniformly onto the alphabet;
+            # the rest are dropped by bytes.translate()
+            limit = 256 - (256 % self.size)
+            self._table = bytes(ord(symbols[b % self.size]) if b < limit else 0 for b in range(256))
+            self._reject = bytes(range(limit, 256))
+
+    def draw(self, length: int) -> str:
+        if self._table is None:
+            return "".join(secrets.choice(self.symbols) for _ in range(length))
+
+        accept_ratio = 1 - len(self._reject) / 256
+        # Oversample so that one token_bytes() call almost always suffices
+        want = int(length / accept_ratio) + 8
+        out = secrets.token_bytes(want).translate(self._table, self._reject)
+        while len(out) < length:
+            out += secrets.token_bytes(want).translate(self._table, self._reject)
+        return out[:length].decode("ascii")
+
+
+def _dedupe(symbols: str) -> str:
+    # dict keeps insertion order, so this is an O(n) order-preserving dedupe
+    return "".join(dict.fromkeys(symbols))
+
+
+_NAMED_ALPHABETS = {
+    ("digits", "numeric", "d", "0123456789"): string.digits,  # 0123456789
+    ("alnum", "alphanumeric", "a"): string.ascii_letters + string.digits,  # abcABC123
+    ("alpha", "alphabet", "letters"): string.ascii_letters,  # abcdefABCDEF
+    ("upper", "uppercase"): string.ascii_uppercase,  # ABCDEFGH
+    ("lower", "lowercase"): string.ascii_lowercase,  # abcdefgh
+    ("hex", "hexadecimal", "x"): string.hexdigits.lower(),  # 0123456789abcdef
+    ("symbols", "special"): "!@#$%^&*",  # Special characters
+}
+
+# Registry of named charsets, resolved once at import
+ALPHABETS: Dict[str, Alphabet] = {}
+for _names, _symbols in _NAMED_ALPHABETS.items():
+    _alphabet = Alphabet(_dedupe(_symbols))
+    for _name in _names:
+        ALPHABETS[_name] = _alphabet
+
+
+@lru_cache(maxsize=256)
+def _literal_alphabet(symbols: str) -> Alphabet:
+    return Alphabet(_dedupe(symbols) or string.digits)
+
+
+def resolve_alphabet(charset: Optional[str] = None) -> Alphabet:
+    """Map a charset name or literal alphabet to a prepared Alphabet."""
+    default = get_settings().otp_charset
     if not charset:
-        charset = s.otp_charset
-
-    # Support for different OTP types
-    if charset in ("digits", "numeric", "d", "0123456789"):
-        alphabet = string.digits  # 0123456789
-    elif charset in ("alnum", "alphanumeric", "a"):
-        alphabet = string.ascii_letters + string.digits  # abcABC123
-    elif charset in ("alpha", "alphabet", "letters"):
-        alphabet = string.ascii_letters  # abcdefABCDEF
-    elif charset in ("upper", "uppercase"):
-        alphabet = string.ascii_uppercase  # ABCDEFGH
-    elif charset in ("lower", "lowercase"):
-        alphabet = string.ascii_lowercase  # abcdefgh
-    elif charset in ("hex", "hexadecimal", "x"):
-        alphabet = string.hexdigits.lower()  # 0123456789abcdef
-    elif charset in ("symbols", "special"):
-        alphabet = "!@#$%^&*"  # Special characters
-    else:
-        # fallback: interpret as literal alphabet or use default
-        alphabet = charset if len(charset) > 1 else s.otp_charset
-
-    # Deduplicate preserving order and ensure we have valid characters
-    if alphabet:
-        alphabet = "".join(sorted(set(alphabet), key=alphabet.index))
-
-    # Final fallback to digits if empty
-    if not alphabet:
-        alphabet = string.digits
-
-    return "".join(secrets.choice(alphabet) for _ in range(length))
+        charset = default
+
+    alphabet = ALPHABETS.get(charset)
+    if alphabet is not None:
+        return alphabet
+    # fallback: interpret as literal alphabet or use default
+    if len(charset) <= 1:
+        return ALPHABETS.get(default) or _literal_alphabet(default)
+    return _literal_alphabet(charset)
+
+
+def generate_code(length: int, charset: Optional[str] = None) -> str:
+    return resolve_alphabet(charset).draw(length)
 
 
 def new_otp_id() -> str:
@@ -68,6 +111,8 @@ def new_otp_id() -> str:
 
 
 def hash_code_with_salt(code: str, salt: Optional[str] = None) -> Tuple[str, str]:
+    # New OTPs pass their own id as salt: it is unique and random, and lets the
+    # verifier compute the candidate HMAC without first reading the record
     if not salt:
         salt = secrets.token_hex(16)
     return _hash_code(code, salt), salt
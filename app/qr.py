@@ -0,0 +1,124 @@
+"""
+QR code rendering for TOTP enrollment
+
+Rendering is CPU-bound (matrix encoding plus image compression), so it runs in
+a small process pool instead of on the request threads, and results are kept
+in an LRU cache so repeated fetches of the same enrollment are free.
+"""
+import hashlib
+import io
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+import qrcode
+import qrcode.image.svg
+
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("png", "svg", "uri")
+MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+class QRRenderTimeout(Exception):
+    """The render pool did not produce the image in time."""
+
+
+def render(data: str, fmt: str, box_size: int = 4) -> bytes:
+    """Encode data as a QR image; runs inside the pool workers, so it must stay importable and picklable."""
+    qr = qrcode.QRCode(border=4, box_size=box_size,
+                       image_factory=qrcode.image.svg.SvgPathImage if fmt == "svg" else None)
+    qr.add_data(data)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    if fmt == "svg":
+        qr.make_image().save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+class QRRenderer:
+    """Process pool plus LRU cache of rendered images.
+
+    The pool is created lazily (so each forked web worker gets its own) and
+    uses spawn, which is safe in a process that already runs threads. With
+    QR_RENDER_PROCESSES=0 images are rendered inline.
+    """
+
+    def __init__(self):
+        self._pool: Optional[Executor] = None
+        self._cache: "OrderedDict[Tuple[bytes, str], bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        # nothing to do: the pool starts on first use
+        pass
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=timeout is None or timeout > 0, cancel_futures=True)
+
+    def _executor(self) -> Optional[Executor]:
+        processes = get_settings().qr_render_processes
+        if processes <= 0:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=processes,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            return self._pool
+
+    def _discard(self, pool: Executor) -> None:
+        """Drop a broken pool so the next render starts a fresh one."""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, data: str, fmt: str, timeout: Optional[float] = 10.0) -> bytes:
+        """Rendered image bytes for data (e.g. an otpauth:// URI) in png or svg.
+
+        Raises QRRenderTimeout if the pool takes longer than timeout seconds.
+        """
+        s = get_settings()
+        # the URI contains the TOTP secret, so only its hash is used as cache key
+        key = (hashlib.sha256(data.encode("utf-8")).digest(), fmt)
+        with self._lock:
+            image = self._cache.get(key)
+            if image is not None:
+                self._cache.move_to_end(key)
+                return image
+
+        pool = self._executor()
+        if pool is None:
+            image = render(data, fmt, s.qr_png_box_size)
+        else:
+            try:
+                future: Future = pool.submit(render, data, fmt, s.qr_png_box_size)
+                image = future.result(timeout)
+            except BrokenProcessPool:
+                # A render process died (e.g. OOM-killed): replace the pool, render this one here
+                logger.warning("QR render pool is broken, restarting it")
+                self._discard(pool)
+                image = render(data, fmt, s.qr_png_box_size)
+            except FutureTimeout:
+                future.cancel()
+                raise QRRenderTimeout(f"QR rendering took longer than {timeout}s")
+
+        with self._lock:
+            self._cache[key] = image
+            while len(self._cache) > s.qr_cache_size:
+                self._cache.popitem(last=False)
+        return image
+
+
+qr_renderer = QRRenderer()
@@ -0,0 +1,259 @@
+"""
+Request rate limiting with the generic cell rate algorithm (GCRA)
+
+Each key stores a single number, its theoretical arrival time (TAT): the
+moment the key would be back to an empty allowance if no further requests
+came in. A request costs one emission interval (period / limit); it is let
+through as long as the new TAT stays within burst intervals of now. This is
+equivalent to a token bucket of size burst refilled at limit per period, but
+needs one value per key and one atomic read-modify-write.
+
+In front of the shared (Redis) limiter sits a per-process tier that remembers,
+for each key, the allowance Redis last reported. Clients that were rejected
+are rejected locally until their Retry-After has passed, and clients far from
+their limit spend their allowance locally between syncs; only requests close
+to the limit, or after sync_seconds, pay a Redis round trip.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from .config import get_settings
+from .connection import REDIS_ERRORS
+from .metrics import RATE_LIMITED, RATE_LIMIT_SYNCS
+
+# KEYS[1] = TAT key; ARGV = emission interval (µs), burst, cost, served
+# served is cost a local tier already let through: it is charged whether or not the
+# request itself is allowed, and may push the TAT past an empty allowance (a debt the
+# client pays back in time before it is allowed again).
+# Redis' clock is used so replicas with skewed clocks share one timeline. Times are
+# integer microseconds, written with %d since Lua's default number format would
+# round them. Returns {allowed, remaining, retry_after_us, reset_us}.
+GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local emission = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local served = tonumber(ARGV[4] or 0)
+local tat = tonumber(redis.call('GET', KEYS[1]) or now)
+if tat < now then tat = now end
+if served > 0 then
+  tat = tat + emission * served
+end
+local new_tat = tat + emission * cost
+local allow_at = new_tat - emission * burst
+if allow_at > now then
+  if served > 0 then
+    redis.call('SET', KEYS[1], string.format('%d', tat), 'PX', math.ceil((tat - now) / 1000))
+  end
+  return {0, 0, allow_at - now, tat - now}
+end
+redis.call('SET', KEYS[1], string.format('%d', new_tat), 'PX', math.ceil((new_tat - now) / 1000))
+return {1, math.floor((emission * burst - (new_tat - now)) / emission), 0, new_tat - now}
+"""
+
+
+class RateLimitResult(NamedTuple):
+    allowed: bool
+    limit: int          # the burst: requests allowed back to back from a full allowance
+    remaining: int
+    retry_after: float  # seconds until the request would be allowed (0 when allowed)
+    reset: float        # seconds until the allowance is fully restored
+    policy: str         # e.g. "60;w=60": sustained limit per window
+
+    def headers(self) -> Dict[str, str]:
+        """RateLimit-* response headers (IETF draft), plus Retry-After when limited."""
+        headers = {
+            "RateLimit-Policy": self.policy,
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(math.ceil(self.reset)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+def _params(limit: int, period: float, burst: Optional[int]):
+    """Emission interval in microseconds, burst size and policy header value."""
+    limit = max(1, limit)
+    return max(1, int(period * 1_000_000 // limit)), max(1, burst or limit), f"{limit};w={period:g}"
+
+
+class MemoryRateLimiter:
+    """GCRA over an in-process dict, used while Redis is unavailable.
+
+    Limits then apply per process rather than across replicas. The dict is an
+    LRU bounded by max_keys; evicting a key only forgets a client's past usage.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._tat: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, key: str, limit: int, period: float = 60, burst: Optional[int] = None,
+              cost: int = 1) -> RateLimitResult:
+        emission, burst_, policy = _params(limit, period, burst)
+        now = time.time() * 1_000_000
+        with self._lock:
+            tat = max(self._tat.get(key, now), now)
+            new_tat = tat + emission * cost
+            allow_at = new_tat - emission * burst_
+            if allow_at > now:
+                return RateLimitResult(False, burst_, 0, (allow_at - now) / 1e6, (tat - now) / 1e6, policy)
+            self._tat[key] = new_tat
+            self._tat.move_to_end(key)
+            while len(self._tat) > self.max_keys:
+                self._tat.popitem(last=False)
+        remaining = int((emission * burst_ - (new_tat - now)) // emission)
+        return RateLimitResult(True, burst_, remaining, 0.0, (new_tat - now) / 1e6, policy)
+
+
+class _LocalEntry:
+    __slots__ = ("blocked_until", "remaining", "pending", "synced_at", "reset_at")
+
+    def __init__(self):
+        self.blocked_until = 0.0
+        self.remaining = 0      # allowance Redis reported at the last sync
+        self.pending = 0        # cost spent locally since then, not yet sent to Redis
+        self.synced_at = -math.inf
+        self.reset_at = 0.0
+
+
+class _Stripe:
+    __slots__ = ("lock", "entries")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, _LocalEntry]" = OrderedDict()
+
+
+class LocalRateLimiter:
+    """Per-process tier in front of the shared limiter.
+
+    Keys are spread over lock-striped LRU dicts (like the in-memory storage
+    shards), bounded to max_keys in total. decide() answers from the cached
+    state when it can and otherwise tells the caller how much cost to send to
+    the shared limiter; record() stores the answer.
+
+    A request is served locally when the key is still blocked, or when the
+    last sync is younger than sync_seconds and the allowance left after it
+    stays above half the burst. Local spending is flushed with the next sync
+    and charged even when Redis refuses the request that carries it. Across
+    W processes a client can get ahead of its allowance by at most
+    W * burst / 2 (one local run each); Redis then refuses it until that debt
+    is paid back, so over time it never exceeds its sustained limit.
+    """
+
+    def __init__(self, sync_seconds: float, max_keys: int, stripes: int = 16):
+        self.sync_seconds = sync_seconds
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._per_stripe = max(1, max_keys // stripes)
+
+    def _stripe(self, key: str) -> _Stripe:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _entry(self, stripe: _Stripe, key: str) -> _LocalEntry:
+        # caller holds stripe.lock
+        entry = stripe.entries.get(key)
+        if entry is None:
+            entry = stripe.entries[key] = _LocalEntry()
+            while len(stripe.entries) > self._per_stripe:
+                stripe.entries.popitem(last=False)
+        else:
+            stripe.entries.move_to_end(key)
+        return entry
+
+    def decide(self, key: str, burst: int, policy: str, cost: int = 1) -> Tuple[Optional[RateLimitResult], int]:
+        """(result, 0) when answered locally, else (None, cost to send to the shared limiter).
+
+        The cost to send includes the locally served cost not yet flushed.
+        """
+        now = time.monotonic()
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = self._entry(stripe, key)
+            if entry.blocked_until > now:
+                return RateLimitResult(False, burst, 0, entry.blocked_until - now,
+                                       max(0.0, entry.reset_at - now), policy), 0
+            left = entry.remaining - entry.pending - cost
+            if now - entry.synced_at < self.sync_seconds and left >= burst // 2:
+                entry.pending += cost
+                return RateLimitResult(True, burst, left, 0.0, max(0.0, entry.reset_at - now), policy), 0
+            take, entry.pending = entry.pending + cost, 0
+        return None, take
+
+    def record(self, key: str, result: RateLimitResult) -> None:
+        now = time.monotonic()
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = self._entry(stripe, key)
+            entry.remaining = result.remaining
+            entry.synced_at = now
+            entry.reset_at = now + result.reset
+            entry.blocked_until = now + result.retry_after if not result.allowed else 0.0
+
+    def size(self) -> int:
+        return sum(len(stripe.entries) for stripe in self._stripes)
+
+
+class RateLimiter:
+    """GCRA in one EVALSHA per check, with the in-memory limiter as fallback.
+
+    The script is registered on the storage's ScriptRegistry so it is reloaded
+    together with the storage scripts after a Redis restart. Checks go through
+    the LocalRateLimiter tier first unless its sync interval is 0.
+    """
+
+    def __init__(self, storage, memory: Optional[MemoryRateLimiter] = None,
+                 local: Optional[LocalRateLimiter] = None):
+        s = get_settings()
+        self.storage = storage
+        self.memory = memory or MemoryRateLimiter()
+        self.local = local or LocalRateLimiter(s.rate_limit_local_sync_seconds, s.rate_limit_local_max_keys)
+        storage.scripts.register('gcra', GCRA_SCRIPT)
+
+    def key(self, client: str, scope: str) -> str:
+        return f"{self.storage.ns}:gcra:{client}:{scope}"
+
+    def check(self, key: str, limit: int, period: float = 60, burst: Optional[int] = None,
+              cost: int = 1) -> RateLimitResult:
+        if self.storage._use_fallback:
+            result = self.memory.check(key, limit, period, burst, cost)
+            if not result.allowed:
+                RATE_LIMITED.labels(tier='memory').inc()
+            return result
+
+        emission, burst_, policy = _params(limit, period, burst)
+        take = cost
+        if self.local.sync_seconds > 0:
+            result, take = self.local.decide(key, burst_, policy, cost)
+            if result is not None:
+                if not result.allowed:
+                    RATE_LIMITED.labels(tier='local').inc()
+                return result
+
+        # Cost already served locally is charged unconditionally; only this request can be refused
+        result = self._shared(key, emission, burst_, policy, cost, take - cost)
+        if result is None:
+            return self.memory.check(key, limit, period, burst, cost)
+        if self.local.sync_seconds > 0:
+            self.local.record(key, result)
+        if not result.allowed:
+            RATE_LIMITED.labels(tier='shared').inc()
+        return result
+
+    def _shared(self, key: str, emission: int, burst: int, policy: str, cost: int,
+                served: int = 0) -> Optional[RateLimitResult]:
+        RATE_LIMIT_SYNCS.inc()
+        try:
+            allowed, remaining, retry_us, reset_us = self.storage.scripts(
+                'gcra', keys=[key], args=[emission, burst, cost, served])
+        except REDIS_ERRORS as e:
+            self.storage.handle_redis_error(e)
+            return None
+        return RateLimitResult(bool(allowed), burst, int(remaining), retry_us / 1e6, reset_us / 1e6, policy)
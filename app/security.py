@@ -1,47 +1,114 @@
 """
 Enhanced security features for the OTP service
+
+Brute-force protection: failed verifications are counted per IP in fixed time
+buckets, and an IP with more than SECURITY_MAX_FAILURES failures within
+SECURITY_WINDOW_SECONDS is blocked for SECURITY_BLOCK_SECONDS.
 """
 import time
 import hashlib
 import secrets
+import threading
+from collections import OrderedDict
 from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 import ipaddress
 
+from . import jobs
+from .config import get_settings
+from .connection import REDIS_ERRORS
+
+
+class _FailureCounter:
+    """Failure counts of one IP, one slot per time bucket (a ring indexed by bucket number)."""
+
+    __slots__ = ("buckets", "counts")
+
+    def __init__(self, size: int):
+        self.buckets = [-1] * size
+        self.counts = [0] * size
+
+    def add(self, bucket: int, count: int) -> int:
+        """Add count to bucket and return the total over the window ending at it."""
+        i = bucket % len(self.buckets)
+        if self.buckets[i] != bucket:
+            self.buckets[i] = bucket
+            self.counts[i] = 0
+        self.counts[i] += count
+        oldest = bucket - len(self.buckets)
+        total = 0
+        for b, c in zip(self.buckets, self.counts):
+            if b > oldest:
+                total += c
+        return total
+
+
 class SecurityManager:
-    def __init__(self):
-        self.failed_attempts: Dict[str, List[float]] = {}
-        self.blocked_ips: Dict[str, float] = {}
+    """Per-process brute-force protection.
+
+    Each tracked IP costs a fixed-size ring of bucket counters, and both the
+    tracked and the blocked IPs are LRU dicts bounded by max_tracked, so memory
+    stays flat under a spray of source addresses. is_ip_blocked() is a single
+    dict lookup, cheap enough to run before anything else on a request.
+    """
+
+    def __init__(self, max_failures: Optional[int] = None, window_seconds: Optional[int] = None,
+                 block_seconds: Optional[int] = None, max_tracked: Optional[int] = None, buckets: int = 12):
+        s = get_settings()
+        self.max_failures = max_failures or s.security_max_failures
+        self.window_seconds = window_seconds or s.security_window_seconds
+        self.block_seconds = block_seconds or s.security_block_seconds
+        self.max_tracked = max_tracked or s.security_max_tracked_ips
+        self.buckets = buckets
+        self.bucket_seconds = max(1, self.window_seconds // buckets)
+        self.failed_attempts: "OrderedDict[str, _FailureCounter]" = OrderedDict()
+        self.blocked_ips: "OrderedDict[str, float]" = OrderedDict()  # ip -> blocked until (epoch seconds)
+        self._lock = threading.Lock()
         self.suspicious_patterns = [
             'admin', 'test', '123456', 'password', 'login'
         ]
-    
+
+    def start(self) -> None:
+        pass
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        pass
+
     def is_ip_blocked(self, ip: str) -> bool:
         """Check if IP is temporarily blocked"""
-        if ip in self.blocked_ips:
-            if time.time() - self.blocked_ips[ip] < 3600:  # 1 hour block
-                return True
+        until = self.blocked_ips.get(ip)
+        return until is not None and until > time.time()
+
+    def blocked_for(self, ip: str) -> float:
+        """Seconds left on the IP's block (0 when not blocked)"""
+        until = self.blocked_ips.get(ip)
+        return max(0.0, until - time.time()) if until is not None else 0.0
+
+    def record_failed_attempt(self, ip: str, count: int = 1) -> bool:
+        """Record failed attempts and block if too many; True when the IP is now blocked"""
+        now = time.time()
+        with self._lock:
+            counter = self.failed_attempts.get(ip)
+            if counter is None:
+                counter = self.failed_attempts[ip] = _FailureCounter(self.buckets)
+                while len(self.failed_attempts) > self.max_tracked:
+                    self.failed_attempts.popitem(last=False)
             else:
-                del self.blocked_ips[ip]
+                self.failed_attempts.move_to_end(ip)
+            total = counter.add(int(now // self.bucket_seconds), count)
+        if total > self.max_failures:
+            self._block(ip, now + self.block_seconds)
+            return True
         return False
-    
-    def record_failed_attempt(self, ip: str) -> None:
-        """Record failed attempt and block if too many"""
-        now = time.time()
-        if ip not in self.failed_attempts:
-            self.failed_attempts[ip] = []
-        
-        # Clean old attempts (older than 1 hour)
-        self.failed_attempts[ip] = [
-            attempt for attempt in self.failed_attempts[ip] 
-            if now - attempt < 3600
-        ]
-        
-        self.failed_attempts[ip].append(now)
-        
-        # Block if more than 5 attempts in 1 hour
-        if len(self.failed_attempts[ip]) > 5:
-            self.blocked_ips[ip] = now
+
+    def _block(self, ip: str, until: float) -> None:
+        with self._lock:
+            known = self.blocked_ips.get(ip)
+            self.blocked_ips[ip] = max(until, known or 0.0)
+            self.blocked_ips.move_to_end(ip)
+            while len(self.blocked_ips) > self.max_tracked:
+                self.blocked_ips.popitem(last=False)
+        if known is None or known < time.time():
             print(f"🚨 IP {ip} blocked due to too many failed attempts")
     
     def is_suspicious_email(self, email: str) -> bool:
@@ -61,5 +128,96 @@ class SecurityManager:
         except ValueError:
             return False
 
-# Global security manager
+
+# KEYS[1] = failure hash of the IP (field = bucket number), KEYS[2] = blocked zset (score = until)
+# ARGV = ip, count, buckets, bucket_seconds, max_failures, block_seconds
+# Returns the block expiry (epoch seconds, Redis clock) or 0.
+FAILURE_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+local buckets = tonumber(ARGV[3])
+local bucket_seconds = tonumber(ARGV[4])
+local bucket = math.floor(now / bucket_seconds)
+redis.call('HINCRBY', KEYS[1], bucket, ARGV[2])
+redis.call('EXPIRE', KEYS[1], buckets * bucket_seconds)
+local total = 0
+local fields = redis.call('HGETALL', KEYS[1])
+for i = 1, #fields, 2 do
+  if tonumber(fields[i]) <= bucket - buckets then
+    redis.call('HDEL', KEYS[1], fields[i])
+  else
+    total = total + tonumber(fields[i + 1])
+  end
+end
+if total > tonumber(ARGV[5]) then
+  local untl = now + tonumber(ARGV[6])
+  local known = tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]) or 0)
+  if untl > known then redis.call('ZADD', KEYS[2], untl, ARGV[1]) end
+  return math.max(untl, known)
+end
+return 0
+"""
+
+
+class SharedSecurityManager(SecurityManager):
+    """SecurityManager whose counters and blocks live in Redis, shared by all replicas.
+
+    Failures go through one Lua script; blocks are copied into the local dict
+    every SECURITY_SYNC_SECONDS by a background task, so is_ip_blocked() stays
+    a local lookup. While the storage is in fallback mode, counting and blocking
+    are local to the process.
+    """
+
+    def __init__(self, storage, **kwargs):
+        super().__init__(**kwargs)
+        self.storage = storage
+        self._blocked_key = f"{storage.ns}:sec:blocked"
+        storage.scripts.register('security_failure', FAILURE_SCRIPT)
+        self._task = jobs.PeriodicTask("security-sync", get_settings().security_sync_seconds, self.sync)
+
+    def start(self) -> None:
+        self._task.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._task.stop(timeout)
+
+    def record_failed_attempt(self, ip: str, count: int = 1) -> bool:
+        if self.storage._use_fallback:
+            return super().record_failed_attempt(ip, count)
+        try:
+            until = self.storage.scripts('security_failure', keys=[f"{self.storage.ns}:sec:fail:{ip}", self._blocked_key],
+                                         args=[ip, count, self.buckets, self.bucket_seconds,
+                                               self.max_failures, self.block_seconds])
+        except REDIS_ERRORS as e:
+            self.storage.handle_redis_error(e)
+            return super().record_failed_attempt(ip, count)
+        if until:
+            self._block(ip, float(until))
+            return True
+        return False
+
+    def sync(self) -> None:
+        """Replace the local view of blocked IPs with Redis' (keeping unexpired local-only blocks)."""
+        if self.storage._use_fallback:
+            return
+        now = time.time()
+        try:
+            pipe = self.storage._r.pipeline(transaction=False)
+            pipe.zremrangebyscore(self._blocked_key, '-inf', int(now))
+            pipe.zrangebyscore(self._blocked_key, int(now), '+inf', start=0, num=self.max_tracked, withscores=True)
+            _, shared = pipe.execute()
+        except REDIS_ERRORS as e:
+            self.storage.handle_redis_error(e)
+            return
+        blocked: "OrderedDict[str, float]" = OrderedDict(shared)
+        with self._lock:
+            for ip, until in self.blocked_ips.items():
+                if until > now and until > blocked.get(ip, 0.0):
+                    blocked[ip] = until
+            # swap the whole dict so lock-free readers never see it half built
+            self.blocked_ips = blocked
+            while len(self.blocked_ips) > self.max_tracked:
+                self.blocked_ips.popitem(last=False)
+
+
+# Global security manager (process-local; create_app uses the Redis-backed SharedSecurityManager)
 security_manager = SecurityManager()
@@ -1,125 +1,605 @@
 from __future__ import annotations
+import heapq
 import time
-from typing import Optional, Dict, Tuple, Any
+from typing import Optional, Dict, List, Tuple, Any
 import threading
+import uuid
 
 import redis
 
+from . import jobs
 from .config import get_settings
+from .connection import REDIS_ERRORS, RedisConnectionManager
+from .metrics import STORAGE_FALLBACK, STORAGE_TRANSITIONS, FALLBACK_REPLAYED, PURGE_REMOVED
 from .otp import verify_code, compute_hmac
 
 
-class InMemoryStorage:
-    """Fallback in-memory storage when Redis is not available"""
+def _parse_cursor(cursor: Optional[str], now: int) -> Tuple[int, str]:
+    """Turn an opaque "<expiry>:<otp_id>" cursor into (min_score, last_id)."""
+    if cursor:
+        score, _, last_id = cursor.partition(':')
+        try:
+            score = int(score)
+        except ValueError:
+            return now, ''
+        if score >= now:
+            return score, last_id
+    return now, ''
+
+
+def _max_attempts(value: Optional[int]) -> int:
+    """Wrong codes an OTP tolerates before it is burned (0 = unlimited)."""
+    return get_settings().otp_max_attempts if value is None else max(0, value)
+
+
+class _Record:
+    """One OTP held by InMemoryStorage."""
+
+    __slots__ = ("hmac", "salt", "subject", "purpose", "used", "created_at", "used_at", "expires_at",
+                 "attempts", "max_attempts", "locked")
+
+    def __init__(self, hmac_value: str, salt: str, subject: Optional[str], purpose: Optional[str],
+                 created_at: int, expires_at: float, max_attempts: int = 0):
+        self.hmac = hmac_value
+        self.salt = salt
+        self.subject = subject or ""
+        self.purpose = purpose or ""
+        self.used = False
+        self.created_at = created_at
+        self.used_at: Optional[int] = None
+        self.expires_at = expires_at
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.locked = False
+
+    def consume(self) -> None:
+        self.used = True
+        self.used_at = int(time.time())
+
+    def fail(self) -> str:
+        """Count a wrong code; burn the OTP once max_attempts wrong codes were tried."""
+        self.attempts += 1
+        if self.max_attempts and self.attempts >= self.max_attempts:
+            self.consume()
+            self.locked = True
+            return 'locked'
+        return 'invalid'
+
+    def to_dict(self) -> Dict[str, str]:
+        # Same shape as the Redis hash
+        data = {
+            "hmac": self.hmac,
+            "salt": self.salt,
+            "subject": self.subject,
+            "purpose": self.purpose,
+            "used": "1" if self.used else "0",
+            "created_at": str(self.created_at),
+            "attempts": str(self.attempts),
+            "max_attempts": str(self.max_attempts),
+        }
+        if self.locked:
+            data["locked"] = "1"
+        if self.used_at is not None:
+            data["used_at"] = str(self.used_at)
+        return data
+
+
+class _Shard:
+    __slots__ = ("lock", "data", "expiry")
 
     def __init__(self):
-        self._data: Dict[str, Dict[str, Any]] = {}
-        self._index: Dict[str, float] = {}  # otp_id -> expiry_timestamp
-        self._lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.data: Dict[str, _Record] = {}
+        self.expiry: List[Tuple[float, str]] = []  # min-heap of (expires_at, otp_id)
 
-    def create(self, otp_id: str, hmac_value: str, salt: str, ttl_seconds: int, subject: Optional[str],
-               purpose: Optional[str]) -> None:
-        with self._lock:
-            expiry = time.time() + ttl_seconds
-            self._data[otp_id] = {
-                "hmac": hmac_value,
-                "salt": salt,
-                "subject": subject or "",
-                "purpose": purpose or "",
-                "used": "0",
-                "created_at": str(int(time.time())),
-                "expires_at": expiry
-            }
-            self._index[otp_id] = expiry
 
-    def get_meta(self, otp_id: str) -> Optional[Dict[str, str]]:
-        with self._lock:
-            if otp_id not in self._data:
-                return None
+class InMemoryStorage:
+    """Fallback in-memory storage when Redis is not available.
 
-            # Check if expired
-            if time.time() > self._data[otp_id]["expires_at"]:
-                del self._data[otp_id]
-                self._index.pop(otp_id, None)
-                return None
+    Records are spread over lock-striped shards keyed by otp_id, so concurrent
+    requests rarely contend. Each shard keeps a min-heap of expiry times, which
+    makes purge_index() O(expired) instead of a scan of every record.
+    """
 
-            # Return copy without expires_at
-            data = self._data[otp_id].copy()
-            data.pop("expires_at", None)
-            return data
+    def __init__(self, shards: Optional[int] = None):
+        count = shards or get_settings().memory_shards
+        self._shards = [_Shard() for _ in range(max(1, count))]
+        self._email_status: Dict[str, Tuple[float, Dict[str, str]]] = {}
+        self._email_lock = threading.Lock()
+        self._totp: Dict[str, Dict[str, str]] = {}
+        self._totp_qr: Dict[str, Tuple[float, str]] = {}
+        self._totp_lock = threading.Lock()
 
-    def verify_and_consume(self, otp_id: str, hmac_candidate: str) -> Tuple[bool, str]:
-        with self._lock:
-            if otp_id not in self._data:
-                return False, 'not_found'
+    def _shard(self, otp_id: str) -> _Shard:
+        return self._shards[hash(otp_id) % len(self._shards)]
 
-            data = self._data[otp_id]
+    def _live(self, shard: _Shard, otp_id: str, now: float) -> Optional[_Record]:
+        # caller holds shard.lock
+        record = shard.data.get(otp_id)
+        if record is not None and now > record.expires_at:
+            del shard.data[otp_id]
+            return None
+        return record
 
-            # Check if expired
-            if time.time() > data["expires_at"]:
-                del self._data[otp_id]
-                self._index.pop(otp_id, None)
-                return False, 'expired'
+    def create(self, otp_id: str, hmac_value: str, salt: str, ttl_seconds: int, subject: Optional[str],
+               purpose: Optional[str], max_attempts: Optional[int] = None) -> None:
+        now = time.time()
+        record = _Record(hmac_value, salt, subject, purpose, int(now), now + ttl_seconds,
+                         _max_attempts(max_attempts))
+        shard = self._shard(otp_id)
+        with shard.lock:
+            shard.data[otp_id] = record
+            heapq.heappush(shard.expiry, (record.expires_at, otp_id))
+
+    def create_many(self, records, max_attempts: Optional[int] = None) -> None:
+        """Bulk insert of (otp_id, hmac, salt, ttl_seconds, subject, purpose) tuples, one lock per shard."""
+        now = time.time()
+        max_attempts = _max_attempts(max_attempts)
+        by_shard: Dict[int, List[Tuple[str, _Record]]] = {}
+        for otp_id, hmac_value, salt, ttl_seconds, subject, purpose in records:
+            record = _Record(hmac_value, salt, subject, purpose, int(now), now + ttl_seconds, max_attempts)
+            by_shard.setdefault(hash(otp_id) % len(self._shards), []).append((otp_id, record))
+        for i, items in by_shard.items():
+            shard = self._shards[i]
+            with shard.lock:
+                for otp_id, record in items:
+                    shard.data[otp_id] = record
+                    heapq.heappush(shard.expiry, (record.expires_at, otp_id))
 
-            # Check if already used
-            if data["used"] == "1":
+    def get_meta(self, otp_id: str) -> Optional[Dict[str, str]]:
+        shard = self._shard(otp_id)
+        with shard.lock:
+            record = self._live(shard, otp_id, time.time())
+            return record.to_dict() if record is not None else None
+
+    def verify_and_consume(self, otp_id: str, hmac_candidate: str) -> Tuple[bool, str]:
+        shard = self._shard(otp_id)
+        with shard.lock:
+            record = shard.data.get(otp_id)
+            if record is None:
+                return False, 'not_found'
+            if time.time() > record.expires_at:
+                del shard.data[otp_id]
+                return False, 'expired'
+            if record.locked:
+                return False, 'locked'
+            if record.used:
                 return False, 'used'
+            if record.hmac == hmac_candidate:
+                record.consume()
+                return True, 'ok'
+            return False, record.fail()
 
-            # Verify HMAC
-            if data["hmac"] == hmac_candidate:
-                data["used"] = "1"
-                data["used_at"] = str(int(time.time()))
-                self._index.pop(otp_id, None)
+    def check_and_consume(self, otp_id: str, code: str, subject: Optional[str] = None) -> Tuple[bool, str]:
+        """Look up, optionally match the subject, compare and consume in one locked step."""
+        shard = self._shard(otp_id)
+        with shard.lock:
+            record = shard.data.get(otp_id)
+            if record is None:
+                return False, 'not_found'
+            if time.time() > record.expires_at:
+                del shard.data[otp_id]
+                return False, 'expired'
+            if subject and record.subject and record.subject != subject:
+                return False, 'email_mismatch'
+            if record.locked:
+                return False, 'locked'
+            if record.used:
+                return False, 'used'
+            if verify_code(code, record.hmac, record.salt):
+                record.consume()
                 return True, 'ok'
-            else:
-                return False, 'invalid'
+            return False, record.fail()
 
     def list_active(self, limit: int = 50, subject: Optional[str] = None, purpose: Optional[str] = None,
                     status: Optional[str] = None):
-        with self._lock:
-            now = time.time()
-            out = []
-
-            # Clean up expired entries and collect active ones
-            expired_keys = []
-            for oid, data in self._data.items():
-                if now > data["expires_at"]:
-                    expired_keys.append(oid)
-                    continue
-
-                # Apply filters
-                if subject and data.get('subject') != subject:
-                    continue
-                if purpose and data.get('purpose') != purpose:
-                    continue
-                if status == 'used' and data.get('used') != '1':
-                    continue
-                if status == 'active' and data.get('used') == '1':
-                    continue
-
-                # Add to results (without expires_at)
-                result_data = data.copy()
-                result_data.pop("expires_at", None)
-                out.append({"id": oid, **result_data})
-
-            # Clean up expired entries
-            for key in expired_keys:
-                self._data.pop(key, None)
-                self._index.pop(key, None)
-
-            # Sort by creation time and limit
-            out.sort(key=lambda x: int(x.get('created_at', 0)), reverse=True)
-            return out[:limit]
+        return self.list_page(limit, subject, purpose, status)[0]
+
+    def list_page(self, limit: int = 50, subject: Optional[str] = None, purpose: Optional[str] = None,
+                  status: Optional[str] = None, cursor: Optional[str] = None):
+        limit = max(1, limit)
+        now = time.time()
+        min_score, cursor_id = _parse_cursor(cursor, int(now))
+        out = []
+        for shard in self._shards:
+            with shard.lock:
+                for oid, record in shard.data.items():
+                    if now > record.expires_at:
+                        continue
+                    if subject and record.subject != subject:
+                        continue
+                    if purpose and record.purpose != purpose:
+                        continue
+                    if status == 'used' and not record.used:
+                        continue
+                    if status == 'active' and record.used:
+                        continue
+                    # Same (expiry, id) ordering and cursor semantics as the Redis indexes
+                    score = int(record.expires_at)
+                    if score < min_score or (score == min_score and cursor_id and oid <= cursor_id):
+                        continue
+                    out.append((score, oid, record.to_dict()))
+
+        out.sort(key=lambda x: (x[0], x[1]))
+        next_cursor = None
+        if len(out) > limit:
+            out = out[:limit]
+            next_cursor = f"{out[-1][0]}:{out[-1][1]}"
+        return [{"id": oid, **data} for _, oid, data in out], next_cursor
+
+    def export_live(self):
+        """Snapshot of unexpired records as (otp_id, fields, remaining_ttl_ms, expiry) tuples."""
+        now = time.time()
+        out = []
+        for shard in self._shards:
+            with shard.lock:
+                for oid, record in shard.data.items():
+                    if record.expires_at <= now:
+                        continue
+                    out.append((oid, record.to_dict(), int((record.expires_at - now) * 1000), int(record.expires_at)))
+        return out
+
+    def discard(self, otp_ids) -> None:
+        for oid in otp_ids:
+            shard = self._shard(oid)
+            with shard.lock:
+                shard.data.pop(oid, None)
+
+    def save_totp(self, account: str, fields: Dict[str, str], qr_ttl: Optional[int] = None,
+                  replace: bool = True) -> bool:
+        now = time.time()
+        with self._totp_lock:
+            if not replace and account in self._totp:
+                return False
+            self._totp[account] = {**fields, "last_step": "0"}
+            if qr_ttl:
+                # drop expired QR references while we hold the lock
+                for eid in [eid for eid, (expires_at, _) in self._totp_qr.items() if expires_at <= now]:
+                    del self._totp_qr[eid]
+                self._totp_qr[fields["id"]] = (now + qr_ttl, account)
+        return True
+
+    def get_totp_qr_account(self, enrollment_id: str) -> Optional[Tuple[str, int]]:
+        with self._totp_lock:
+            entry = self._totp_qr.get(enrollment_id)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1], int(entry[0] - time.time())
+
+    def get_totp(self, account: str) -> Optional[Dict[str, str]]:
+        with self._totp_lock:
+            fields = self._totp.get(account)
+            return dict(fields) if fields is not None else None
+
+    def accept_totp_step(self, account: str, enrollment_id: str, step: int) -> str:
+        with self._totp_lock:
+            fields = self._totp.get(account)
+            if fields is None or fields.get("id") != enrollment_id:
+                return "stale"
+            if step <= int(fields.get("last_step", "0")):
+                return "replay"
+            fields["last_step"] = str(step)
+            return "ok"
+
+    def get_totp_many(self, accounts) -> Dict[str, Optional[Dict[str, str]]]:
+        with self._totp_lock:
+            return {account: dict(self._totp[account]) if account in self._totp else None for account in accounts}
+
+    def accept_totp_steps(self, entries) -> List[str]:
+        return [self.accept_totp_step(account, enrollment_id, step) for account, enrollment_id, step in entries]
+
+    def export_totp(self):
+        with self._totp_lock:
+            return [(account, dict(fields)) for account, fields in self._totp.items()]
+
+    def discard_totp(self, accounts) -> None:
+        with self._totp_lock:
+            for account in accounts:
+                self._totp.pop(account, None)
+
+    def put_email_status(self, job_id: str, fields: Dict[str, str], ttl_seconds: int,
+                         max_entries: int = 10000) -> None:
+        now = time.time()
+        with self._email_lock:
+            entry = self._email_status.get(job_id)
+            merged = dict(entry[1]) if entry is not None and entry[0] > now else {}
+            merged.update(fields)
+            self._email_status[job_id] = (now + ttl_seconds, merged)
+            if len(self._email_status) > max_entries:
+                # dicts keep insertion order, so the first entries are the oldest jobs
+                for oid in list(self._email_status)[:len(self._email_status) - max_entries]:
+                    del self._email_status[oid]
+
+    def get_email_status(self, job_id: str) -> Optional[Dict[str, str]]:
+        with self._email_lock:
+            entry = self._email_status.get(job_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._email_status[job_id]
+                return None
+            return dict(entry[1])
 
     def purge_index(self):
-        # For in-memory storage, just clean up expired entries
-        with self._lock:
-            now = time.time()
-            expired_keys = [oid for oid, data in self._data.items() if now > data["expires_at"]]
-            for key in expired_keys:
-                self._data.pop(key, None)
-                self._index.pop(key, None)
-            return len(expired_keys)
+        # Pop expired heap entries; only the expired records are touched
+        now = time.time()
+        removed = 0
+        for shard in self._shards:
+            with shard.lock:
+                heap = shard.expiry
+                while heap and heap[0][0] <= now:
+                    expires_at, oid = heapq.heappop(heap)
+                    record = shard.data.get(oid)
+                    # the id may have been dropped or re-created since this entry was pushed
+                    if record is not None and record.expires_at == expires_at:
+                        del shard.data[oid]
+                        removed += 1
+        return removed
+
+
+# Server-side scripts, loaded once per connection and invoked via EVALSHA
+VERIFY_SCRIPT = """
+    local otp_key = KEYS[1]
+    local index_key = KEYS[2]
+    local all_key = KEYS[3]
+    local used_key = KEYS[4]
+    local provided_hmac = ARGV[1]
+    local otp_id = ARGV[2]
+    if redis.call('EXISTS', otp_key) == 0 then
+      return 'not_found'
+    end
+    local state = redis.call('HMGET', otp_key, 'used', 'locked', 'max_attempts')
+    if state[2] == '1' then
+      return 'locked'
+    end
+    if state[1] == '1' then
+      return 'used'
+    end
+    local ttl = redis.call('PTTL', otp_key)
+    if ttl <= 0 then
+      return 'expired'
+    end
+    local stored_hmac = redis.call('HGET', otp_key, 'hmac')
+    if stored_hmac == provided_hmac then
+      redis.call('HSET', otp_key, 'used', '1')
+      redis.call('HSET', otp_key, 'used_at', tostring(redis.call('TIME')[1]))
+      redis.call('ZREM', index_key, otp_id)
+      local expiry = redis.call('ZSCORE', all_key, otp_id)
+      if expiry then
+        redis.call('ZADD', used_key, expiry, otp_id)
+      end
+      return 'ok'
+    end
+    local attempts = redis.call('HINCRBY', otp_key, 'attempts', 1)
+    local max_attempts = tonumber(state[3] or ARGV[3])
+    if max_attempts > 0 and attempts >= max_attempts then
+      redis.call('HSET', otp_key, 'used', '1', 'locked', '1', 'used_at', tostring(redis.call('TIME')[1]))
+      redis.call('ZREM', index_key, otp_id)
+      local expiry = redis.call('ZSCORE', all_key, otp_id)
+      if expiry then
+        redis.call('ZADD', used_key, expiry, otp_id)
+      end
+      return 'locked'
+    end
+    return 'invalid'
+"""
+
+CHECK_SCRIPT = """
+    local otp_key = KEYS[1]
+    local index_key = KEYS[2]
+    local all_key = KEYS[3]
+    local used_key = KEYS[4]
+    local provided_hmac = ARGV[1]
+    local otp_id = ARGV[2]
+    local subject = ARGV[3]
+    local salt = ARGV[4]
+    local meta = redis.call('HMGET', otp_key, 'hmac', 'salt', 'subject', 'used', 'locked', 'max_attempts')
+    if not meta[1] then
+      return 'not_found'
+    end
+    if subject ~= '' and meta[3] and meta[3] ~= '' and meta[3] ~= subject then
+      return 'email_mismatch'
+    end
+    if meta[5] == '1' then
+      return 'locked'
+    end
+    if meta[4] == '1' then
+      return 'used'
+    end
+    local ttl = redis.call('PTTL', otp_key)
+    if ttl <= 0 then
+      return 'expired'
+    end
+    if meta[2] ~= salt then
+      return 'salt:' .. (meta[2] or '')
+    end
+    if meta[1] == provided_hmac then
+      redis.call('HSET', otp_key, 'used', '1', 'used_at', tostring(redis.call('TIME')[1]))
+      redis.call('ZREM', index_key, otp_id)
+      local expiry = redis.call('ZSCORE', all_key, otp_id)
+      if expiry then
+        redis.call('ZADD', used_key, expiry, otp_id)
+      end
+      return 'ok'
+    end
+    -- Wrong code: count it, and burn the OTP once max_attempts is reached. Records created
+    -- before attempts were tracked use the current default (ARGV[5]).
+    local attempts = redis.call('HINCRBY', otp_key, 'attempts', 1)
+    local max_attempts = tonumber(meta[6] or ARGV[5])
+    if max_attempts > 0 and attempts >= max_attempts then
+      redis.call('HSET', otp_key, 'used', '1', 'locked', '1', 'used_at', tostring(redis.call('TIME')[1]))
+      redis.call('ZREM', index_key, otp_id)
+      local expiry = redis.call('ZSCORE', all_key, otp_id)
+      if expiry then
+        redis.call('ZADD', used_key, expiry, otp_id)
+      end
+      return 'locked'
+    end
+    return 'invalid'
+"""
+
+
+# Re-insert an OTP created while in fallback mode without clobbering newer Redis state.
+# KEYS: otp hash, active index, all index, used index, then subject/purpose indexes if any
+# ARGV: otp id, remaining TTL (ms), expiry, used flag, locked flag, then the hash fields
+REPLAY_SCRIPT = """
+    local otp_key = KEYS[1]
+    local index_key = KEYS[2]
+    local all_key = KEYS[3]
+    local used_key = KEYS[4]
+    local otp_id = ARGV[1]
+    local expiry = ARGV[3]
+    local used = ARGV[4]
+    if redis.call('EXISTS', otp_key) == 1 then
+      if used == '1' then
+        redis.call('HSET', otp_key, 'used', '1')
+        if ARGV[5] == '1' then
+          redis.call('HSET', otp_key, 'locked', '1')
+        end
+        redis.call('ZREM', index_key, otp_id)
+        redis.call('ZADD', used_key, expiry, otp_id)
+      end
+      return 0
+    end
+    redis.call('HSET', otp_key, unpack(ARGV, 6))
+    redis.call('PEXPIRE', otp_key, ARGV[2])
+    redis.call('ZADD', all_key, expiry, otp_id)
+    if used == '1' then
+      redis.call('ZADD', used_key, expiry, otp_id)
+    else
+      redis.call('ZADD', index_key, expiry, otp_id)
+    end
+    for i = 5, #KEYS do
+      redis.call('ZADD', KEYS[i], expiry, otp_id)
+    end
+    return 1
+"""
+
+# One page of ids ordered by (expiry, id) from the intersection of the given indexes.
+# KEYS: indexes to intersect, then a scratch key. ARGV: min expiry, cursor id, limit
+LIST_SCRIPT = """
+    local n = #KEYS - 1
+    local tmp = KEYS[#KEYS]
+    local src = KEYS[1]
+    if n > 1 then
+      local args = {'ZINTERSTORE', tmp, n}
+      for i = 1, n do
+        args[#args + 1] = KEYS[i]
+      end
+      args[#args + 1] = 'AGGREGATE'
+      args[#args + 1] = 'MIN'
+      redis.call(unpack(args))
+      src = tmp
+    end
+    local min_score = tonumber(ARGV[1])
+    local cursor_id = ARGV[2]
+    local want = 2 * (tonumber(ARGV[3]) + 1)
+    local out = {}
+    local offset = 0
+    while #out < want do
+      local page = redis.call('ZRANGEBYSCORE', src, min_score, '+inf', 'WITHSCORES', 'LIMIT', offset, want)
+      if #page == 0 then
+        break
+      end
+      for i = 1, #page, 2 do
+        -- skip ties at the cursor score up to and including the cursor id
+        if cursor_id == '' or tonumber(page[i + 1]) > min_score or page[i] > cursor_id then
+          out[#out + 1] = page[i]
+          out[#out + 1] = page[i + 1]
+          if #out >= want then
+            break
+          end
+        end
+      end
+      offset = offset + want
+    end
+    if n > 1 then
+      redis.call('DEL', tmp)
+    end
+    return out
+"""
+
+# Remove up to ARGV[2] expired members (score <= ARGV[1]) from one expiry index.
+# Returns {removed, expired members still left}
+PURGE_SCRIPT = """
+    local expired = redis.call('ZCOUNT', KEYS[1], '-inf', ARGV[1])
+    if expired == 0 then
+      return {0, 0}
+    end
+    local take = math.min(expired, tonumber(ARGV[2]))
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, take - 1)
+    return {take, expired - take}
+"""
+
+# Add an OTP issued before the all/used/subject/purpose indexes existed to them, keeping
+# any score already there. KEYS: otp hash, active, all and used indexes, then its
+# subject/purpose indexes. ARGV[1] = otp id. Returns 1 if it was missing from the all index
+INDEX_BACKFILL_SCRIPT = """
+    local otp_key = KEYS[1]
+    local ttl = redis.call('PTTL', otp_key)
+    if ttl <= 0 then
+      return 0
+    end
+    local otp_id = ARGV[1]
+    local expiry = redis.call('ZSCORE', KEYS[2], otp_id)
+    if not expiry then
+      expiry = tonumber(redis.call('TIME')[1]) + math.floor(ttl / 1000)
+    end
+    local added = redis.call('ZADD', KEYS[3], 'NX', expiry, otp_id)
+    if redis.call('HGET', otp_key, 'used') == '1' then
+      redis.call('ZADD', KEYS[4], 'NX', expiry, otp_id)
+    end
+    for i = 5, #KEYS do
+      redis.call('ZADD', KEYS[i], 'NX', expiry, otp_id)
+    end
+    return added
+"""
+
+# Accept a TOTP time step for an enrollment at most once, and only moving forward
+TOTP_STEP_SCRIPT = """
+    local current = redis.call('HMGET', KEYS[1], 'id', 'last_step')
+    if not current[1] or current[1] ~= ARGV[1] then
+      return 'stale'
+    end
+    if tonumber(ARGV[2]) <= tonumber(current[2] or '0') then
+      return 'replay'
+    end
+    redis.call('HSET', KEYS[1], 'last_step', ARGV[2])
+    return 'ok'
+"""
+
+# Restore an enrollment made during a fallback period unless Redis already has one
+TOTP_REPLAY_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+      return 0
+    end
+    redis.call('HSET', KEYS[1], unpack(ARGV))
+    return 1
+"""
+
+
+class ScriptRegistry:
+    """Named Lua scripts bound to a Redis client and invoked via EVALSHA.
+
+    Only the SHA1 goes over the wire; redis-py's Script reloads the source on a
+    NOSCRIPT reply (e.g. after a Redis restart or failover). Other subsystems
+    register their own scripts through register().
+    """
+
+    def __init__(self, client: redis.Redis):
+        self._client = client
+        self._scripts: Dict[str, Any] = {}
+
+    def register(self, name: str, source: str) -> None:
+        self._scripts[name] = self._client.register_script(source)
+
+    def load_all(self) -> None:
+        """SCRIPT LOAD everything up front so the first calls don't hit NOSCRIPT."""
+        for script in self._scripts.values():
+            script.sha = self._client.script_load(script.script)
+
+    def __call__(self, name: str, keys=(), args=(), client=None):
+        return self._scripts[name](keys=list(keys), args=list(args), client=client)
 
 
 class RedisStorage:
@@ -128,55 +608,342 @@ class RedisStorage:
         self._fallback = InMemoryStorage()
         self._use_fallback = False
 
-        try:
-            self._r: redis.Redis = redis.from_url(s.redis_url, decode_responses=True)
-            # Test connection
-            self._r.ping()
-            self.ns = s.redis_namespace
+        self.ns = s.redis_namespace
+        self._conn = RedisConnectionManager(s)
+        self._r: redis.Redis = self._conn.client
+        self.scripts = ScriptRegistry(self._r)
+        self.scripts.register('verify', VERIFY_SCRIPT)
+        self.scripts.register('check', CHECK_SCRIPT)
+        self.scripts.register('replay', REPLAY_SCRIPT)
+        self.scripts.register('list', LIST_SCRIPT)
+        self.scripts.register('purge', PURGE_SCRIPT)
+        self.scripts.register('totp_step', TOTP_STEP_SCRIPT)
+        self.scripts.register('totp_replay', TOTP_REPLAY_SCRIPT)
+        self.scripts.register('index_backfill', INDEX_BACKFILL_SCRIPT)
+        self._transition_lock = threading.Lock()
+        self._purge_scan_cursor: Optional[int] = None
+        self._backfill_cursor = 0
+        self._backfill_added = 0
+        self._backfill_token = uuid.uuid4().hex
+        self.purge_progress: Dict[str, Any] = {"last_run": None, "removed": 0, "complete": True, "duration_ms": 0}
+
+        # Test connection
+        if self._conn.probe():
+            self.scripts.load_all()
             print("✅ Connected to Redis successfully")
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as e:
-            print(f"⚠️  Redis connection failed: {e}")
+        else:
+            print(f"⚠️  Redis connection failed: {self._conn.last_error}")
             print("🔄 Falling back to in-memory storage (data will not persist)")
             self._use_fallback = True
+        jobs.register(self)
+        # The heartbeat keeps probing with backoff and brings us back once Redis recovers
+        self._conn.add_listener(self._on_health_change)
+        self._conn.start()
+        # Expired index entries are purged in the background, never on a request thread
+        self.purge_job = jobs.PeriodicTask("otp-purge", s.purge_interval_seconds, self._run_purge)
+        jobs.register(self.purge_job)
+        # One-off: index OTPs issued before the listing indexes existed (stops once done)
+        self.backfill_job = jobs.PeriodicTask("otp-index-backfill", 5.0, self._run_backfill)
+        jobs.register(self.backfill_job)
+
+    def start(self) -> None:
+        # Registered with jobs so this runs again in every gunicorn worker: with preload_app
+        # the master set the gauge before the multiprocess directory was wiped, and a
+        # forked worker starts from fresh metric files
+        STORAGE_FALLBACK.set(int(self._use_fallback))
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        pass
+
+    @property
+    def redis_healthy(self) -> bool:
+        return not self._use_fallback and self._conn.healthy
+
+    def handle_redis_error(self, exc: Exception) -> None:
+        """Record a failed Redis command and switch to the in-memory fallback."""
+        self._conn.mark_failed(exc)
+        self._enter_fallback("⚠️  Redis connection lost, switching to fallback storage")
+
+    def _on_health_change(self, healthy: bool) -> None:
+        if healthy:
+            self._recover()
+        else:
+            self._enter_fallback("⚠️  Redis heartbeat failed, switching to fallback storage")
+
+    def _enter_fallback(self, message: str) -> None:
+        with self._transition_lock:
+            if self._use_fallback:
+                return
+            self._use_fallback = True
+        print(message)
+        STORAGE_FALLBACK.set(1)
+        STORAGE_TRANSITIONS.labels(to='memory').inc()
+
+    def _recover(self) -> None:
+        """Leave fallback mode, replaying OTPs that were issued while Redis was down.
+
+        Records are replayed once before flipping back (so other replicas can verify
+        them) and once after, to pick up anything created or consumed in between.
+        The replay script never overwrites a record that already exists in Redis.
+        """
+        failure: Optional[Exception] = None
+        with self._transition_lock:
+            if not self._use_fallback:
+                return
+            try:
+                self.scripts.load_all()
+                replayed = self._replay(self._fallback.export_live())
+                self._use_fallback = False
+                records = self._fallback.export_live()
+                replayed += self._replay(records)
+                enrollments = self._fallback.export_totp()
+                self._replay_totp(enrollments)
+            except REDIS_ERRORS as e:
+                self._use_fallback = True
+                failure = e
+            else:
+                self._fallback.discard(oid for oid, _, _, _ in records)
+                self._fallback.discard_totp(account for account, _ in enrollments)
+        if failure is not None:
+            # Only after releasing the lock: mark_failed notifies the health listeners,
+            # which end up in _enter_fallback and take _transition_lock again
+            self._conn.mark_failed(failure)
+            return
+        print(f"✅ Redis connection restored, leaving fallback storage ({replayed} OTPs, "
+              f"{len(enrollments)} TOTP enrollments replayed)")
+        STORAGE_FALLBACK.set(0)
+        STORAGE_TRANSITIONS.labels(to='redis').inc()
+        FALLBACK_REPLAYED.inc(replayed)
+
+    def _replay(self, records, chunk_size: int = 1000) -> int:
+        replayed = 0
+        for i in range(0, len(records), chunk_size):
+            pipe = self._r.pipeline(transaction=False)
+            for otp_id, fields, ttl_ms, expiry in records[i:i + chunk_size]:
+                args = [otp_id, ttl_ms, expiry, fields.get("used", "0"), fields.get("locked", "0")]
+                for k, v in fields.items():
+                    args += [k, v]
+                keys = [self._key(otp_id), *self._status_keys(),
+                        *self._filter_keys(fields.get("subject"), fields.get("purpose"))]
+                self.scripts('replay', keys=keys, args=args, client=pipe)
+            replayed += sum(pipe.execute())
+        return replayed
+
+    def _replay_totp(self, enrollments) -> None:
+        pipe = self._r.pipeline(transaction=False)
+        for account, fields in enrollments:
+            args = []
+            for k, v in fields.items():
+                args += [k, v]
+            self.scripts('totp_replay', keys=[self._totp_key(account)], args=args, client=pipe)
+        pipe.execute()
 
     def _key(self, otp_id: str) -> str:
         return f"{self.ns}:otp:{otp_id}"
 
+    def _totp_key(self, account: str) -> str:
+        return f"{self.ns}:totp:{account}"
+
     def _index_key(self) -> str:
         return f"{self.ns}:index"
 
+    def _status_keys(self):
+        # active (unused) index, all OTPs, used OTPs; all scored by expiry timestamp
+        return [self._index_key(), f"{self.ns}:idx:all", f"{self.ns}:idx:used"]
+
+    def _filter_keys(self, subject: Optional[str] = None, purpose: Optional[str] = None):
+        keys = []
+        if subject:
+            keys.append(f"{self.ns}:idx:subject:{subject}")
+        if purpose:
+            keys.append(f"{self.ns}:idx:purpose:{purpose}")
+        return keys
+
     def close(self):
-        if not self._use_fallback:
-            self._r.close()
+        self._conn.close()
 
-    def create(self, otp_id: str, hmac_value: str, salt: str, ttl_seconds: int, subject: Optional[str], purpose: Optional[str]) -> None:
+    def create(self, otp_id: str, hmac_value: str, salt: str, ttl_seconds: int, subject: Optional[str],
+               purpose: Optional[str], max_attempts: Optional[int] = None) -> None:
         if self._use_fallback:
-            return self._fallback.create(otp_id, hmac_value, salt, ttl_seconds, subject, purpose)
+            return self._fallback.create(otp_id, hmac_value, salt, ttl_seconds, subject, purpose, max_attempts)
 
         try:
-            if not self._r.ping():
-                print("⚠️  Redis connection lost, switching to fallback storage")
-                self._use_fallback = True
-                return self._fallback.create(otp_id, hmac_value, salt, ttl_seconds, subject, purpose)
+            pipe = self._r.pipeline()
+            self._queue_create(pipe, int(time.time()), _max_attempts(max_attempts), otp_id, hmac_value, salt,
+                               ttl_seconds, subject, purpose)
+            pipe.execute()
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.create(otp_id, hmac_value, salt, ttl_seconds, subject, purpose, max_attempts)
+
+    def create_many(self, records, max_attempts: Optional[int] = None) -> None:
+        """Persist (otp_id, hmac, salt, ttl_seconds, subject, purpose) tuples in one pipeline flush."""
+        if self._use_fallback:
+            return self._fallback.create_many(records, max_attempts)
+
+        try:
+            now = int(time.time())
+            limit = _max_attempts(max_attempts)
+            pipe = self._r.pipeline(transaction=False)
+            for record in records:
+                self._queue_create(pipe, now, limit, *record)
+            pipe.execute()
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.create_many(records, max_attempts)
+
+    def _queue_create(self, pipe, now: int, max_attempts: int, otp_id: str, hmac_value: str, salt: str,
+                      ttl_seconds: int, subject: Optional[str], purpose: Optional[str]) -> None:
+        key = self._key(otp_id)
+        pipe.hset(key, mapping={
+            "hmac": hmac_value,
+            "salt": salt,
+            "subject": subject or "",
+            "purpose": purpose or "",
+            "used": "0",
+            "created_at": str(now),
+            "attempts": "0",
+            "max_attempts": str(max_attempts),
+        })
+        pipe.expire(key, ttl_seconds)
+        # add to the active, all and subject/purpose indexes with expiration timestamp as score
+        expiry = {otp_id: now + ttl_seconds}
+        pipe.zadd(self._index_key(), expiry)
+        pipe.zadd(f"{self.ns}:idx:all", expiry)
+        for index_key in self._filter_keys(subject, purpose):
+            pipe.zadd(index_key, expiry)
+
+    def save_totp(self, account: str, fields: Dict[str, str], qr_ttl: Optional[int] = None,
+                  replace: bool = True) -> bool:
+        """Store (or replace) the TOTP enrollment of an account; resets the replay guard.
 
-            key = self._key(otp_id)
+        With replace=False an existing enrollment is left untouched and False is
+        returned. With qr_ttl, the enrollment id also maps back to the account for
+        that many seconds, so its QR code can be fetched by id.
+        """
+        if self._use_fallback:
+            return self._fallback.save_totp(account, fields, qr_ttl, replace)
+
+        try:
+            key = self._totp_key(account)
+            if not replace:
+                # Same create-if-absent script the fallback replay uses, so two concurrent
+                # setups for one account cannot both succeed
+                args = []
+                for k, v in {**fields, "last_step": "0"}.items():
+                    args += [k, v]
+                if not self.scripts('totp_replay', keys=[key], args=args):
+                    return False
             pipe = self._r.pipeline()
-            pipe.hset(key, mapping={
-                "hmac": hmac_value,
-                "salt": salt,
-                "subject": subject or "",
-                "purpose": purpose or "",
-                "used": "0",
-                "created_at": str(int(time.time())),
-            })
+            if replace:
+                pipe.delete(key)
+                pipe.hset(key, mapping={**fields, "last_step": "0"})
+            if qr_ttl:
+                pipe.set(f"{self.ns}:totp_qr:{fields['id']}", account, ex=qr_ttl)
+            pipe.execute()
+            return True
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.save_totp(account, fields, qr_ttl, replace)
+
+    def get_totp_qr_account(self, enrollment_id: str) -> Optional[Tuple[str, int]]:
+        """(account, remaining seconds) for an enrollment whose QR code may still be served."""
+        if self._use_fallback:
+            return self._fallback.get_totp_qr_account(enrollment_id)
+
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            key = f"{self.ns}:totp_qr:{enrollment_id}"
+            pipe.get(key)
+            pipe.ttl(key)
+            account, ttl = pipe.execute()
+            if account is None:
+                return self._fallback.get_totp_qr_account(enrollment_id)
+            return account, max(int(ttl), 0)
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.get_totp_qr_account(enrollment_id)
+
+    def get_totp(self, account: str) -> Optional[Dict[str, str]]:
+        if self._use_fallback:
+            return self._fallback.get_totp(account)
+
+        try:
+            data = self._r.hgetall(self._totp_key(account))
+            return data if data else None
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.get_totp(account)
+
+    def accept_totp_step(self, account: str, enrollment_id: str, step: int) -> str:
+        """Atomically record step as the last accepted one.
+
+        Returns 'ok', 'replay' (step not newer than the last accepted one) or
+        'stale' (no enrollment, or it was replaced since enrollment_id was read).
+        """
+        if self._use_fallback:
+            return self._fallback.accept_totp_step(account, enrollment_id, step)
+
+        try:
+            return self.scripts('totp_step', keys=[self._totp_key(account)], args=[enrollment_id, step])
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.accept_totp_step(account, enrollment_id, step)
+
+    def get_totp_many(self, accounts) -> Dict[str, Optional[Dict[str, str]]]:
+        """Enrollments of several accounts in one pipelined round trip."""
+        accounts = list(accounts)
+        if self._use_fallback:
+            return self._fallback.get_totp_many(accounts)
+
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            for account in accounts:
+                pipe.hgetall(self._totp_key(account))
+            return {account: data or None for account, data in zip(accounts, pipe.execute())}
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.get_totp_many(accounts)
+
+    def accept_totp_steps(self, entries) -> List[str]:
+        """accept_totp_step for many (account, enrollment_id, step) entries, pipelined and applied in order."""
+        entries = list(entries)
+        if self._use_fallback:
+            return self._fallback.accept_totp_steps(entries)
+
+        try:
+            pipe = self._r.pipeline(transaction=False)
+            for account, enrollment_id, step in entries:
+                self.scripts('totp_step', keys=[self._totp_key(account)], args=[enrollment_id, step], client=pipe)
+            return pipe.execute()
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.accept_totp_steps(entries)
+
+    def put_email_status(self, job_id: str, fields: Dict[str, str], ttl_seconds: int) -> None:
+        if self._use_fallback:
+            return self._fallback.put_email_status(job_id, fields, ttl_seconds)
+
+        try:
+            key = f"{self.ns}:email:{job_id}"
+            pipe = self._r.pipeline(transaction=False)
+            pipe.hset(key, mapping=fields)
             pipe.expire(key, ttl_seconds)
-            # add to index sorted set with expiration timestamp as score
-            pipe.zadd(self._index_key(), {otp_id: int(time.time()) + ttl_seconds})
             pipe.execute()
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            print("⚠️  Redis connection lost, switching to fallback storage")
-            self._use_fallback = True
-            return self._fallback.create(otp_id, hmac_value, salt, ttl_seconds, subject, purpose)
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.put_email_status(job_id, fields, ttl_seconds)
+
+    def get_email_status(self, job_id: str) -> Optional[Dict[str, str]]:
+        if self._use_fallback:
+            return self._fallback.get_email_status(job_id)
+
+        try:
+            data = self._r.hgetall(f"{self.ns}:email:{job_id}")
+            return data if data else self._fallback.get_email_status(job_id)
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.get_email_status(job_id)
 
     def get_meta(self, otp_id: str) -> Optional[Dict[str, str]]:
         if self._use_fallback:
@@ -185,9 +952,8 @@ class RedisStorage:
         try:
             data = self._r.hgetall(self._key(otp_id))
             return data if data else None
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            print("⚠️  Redis connection lost, switching to fallback storage")
-            self._use_fallback = True
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
             return self._fallback.get_meta(otp_id)
 
     def verify_and_consume(self, otp_id: str, hmac_candidate: str) -> Tuple[bool, str]:
@@ -196,85 +962,194 @@ class RedisStorage:
 
         try:
             # atomic verify and consume via Lua
-            script = """
-            local otp_key = KEYS[1]
-            local index_key = KEYS[2]
-            local provided_hmac = ARGV[1]
-            local otp_id = ARGV[2]
-            if redis.call('EXISTS', otp_key) == 0 then
-              return 'not_found'
-            end
-            local used = redis.call('HGET', otp_key, 'used')
-            if used == '1' then
-              return 'used'
-            end
-            local ttl = redis.call('PTTL', otp_key)
-            if ttl <= 0 then
-              return 'expired'
-            end
-            local stored_hmac = redis.call('HGET', otp_key, 'hmac')
-            if stored_hmac == provided_hmac then
-              redis.call('HSET', otp_key, 'used', '1')
-              redis.call('HSET', otp_key, 'used_at', tostring(redis.call('TIME')[1]))
-              redis.call('ZREM', index_key, otp_id)
-              return 'ok'
-            else
-              return 'invalid'
-            end
-            """
-            res = self._r.eval(script, 2, self._key(otp_id), self._index_key(), hmac_candidate, otp_id)
+            res = self.scripts('verify', keys=[self._key(otp_id), *self._status_keys()],
+                               args=[hmac_candidate, otp_id, get_settings().otp_max_attempts])
             return (res == 'ok', res if isinstance(res, str) else 'invalid')
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            print("⚠️  Redis connection lost, switching to fallback storage")
-            self._use_fallback = True
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
             return self._fallback.verify_and_consume(otp_id, hmac_candidate)
 
-    def list_active(self, limit: int = 50, subject: Optional[str] = None, purpose: Optional[str] = None, status: Optional[str] = None):
+    def check_and_consume(self, otp_id: str, code: str, subject: Optional[str] = None) -> Tuple[bool, str]:
+        """Verify a raw code in a single round trip.
+
+        OTPs are salted with their own id, so the candidate HMAC is computed before
+        calling Redis and the script does lookup, subject match, compare and consume
+        atomically. Records carrying a random salt (issued before this scheme) make
+        the script answer with their salt and cost one extra round trip.
+        """
         if self._use_fallback:
-            return self._fallback.list_active(limit, subject, purpose, status)
+            return self._fallback.check_and_consume(otp_id, code, subject)
 
         try:
-            # list by soonest expiry
-            now = int(time.time())
-            ids = self._r.zrangebyscore(self._index_key(), now - 86400, now + 86400 * 7, start=0, num=limit)
-            out = []
-            for oid in ids:
-                meta = self.get_meta(oid)
-                if not meta:
-                    continue
-                if subject and meta.get('subject') != subject:
-                    continue
-                if purpose and meta.get('purpose') != purpose:
-                    continue
-                if status == 'used' and meta.get('used') != '1':
-                    continue
-                if status == 'active' and meta.get('used') == '1':
-                    continue
-                out.append({"id": oid, **meta})
-            return out
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            print("⚠️  Redis connection lost, switching to fallback storage")
-            self._use_fallback = True
-            return self._fallback.list_active(limit, subject, purpose, status)
+            salt = otp_id
+            res = self._run_check(otp_id, code, salt, subject)
+            if isinstance(res, str) and res.startswith('salt:'):
+                salt = res[len('salt:'):]
+                res = self._run_check(otp_id, code, salt, subject)
+            if not isinstance(res, str) or res.startswith('salt:'):
+                res = 'invalid'
+            return res == 'ok', res
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.check_and_consume(otp_id, code, subject)
 
-    def purge_index(self):
+    def _run_check(self, otp_id: str, code: str, salt: str, subject: Optional[str]):
+        s = get_settings()
+        hmac_candidate = compute_hmac(s.otp_pepper.encode('utf-8'), code, salt)
+        return self.scripts('check', keys=[self._key(otp_id), *self._status_keys()],
+                            args=[hmac_candidate, otp_id, subject or '', salt, s.otp_max_attempts])
+
+    def list_active(self, limit: int = 50, subject: Optional[str] = None, purpose: Optional[str] = None, status: Optional[str] = None):
+        return self.list_page(limit, subject, purpose, status)[0]
+
+    def list_page(self, limit: int = 50, subject: Optional[str] = None, purpose: Optional[str] = None,
+                  status: Optional[str] = None, cursor: Optional[str] = None):
+        """One page of live OTPs ordered by soonest expiry, filtered by Redis-side indexes.
+
+        Returns (items, next_cursor); next_cursor is None on the last page.
+        """
+        limit = max(1, limit)
         if self._use_fallback:
-            return self._fallback.purge_index()
+            return self._fallback.list_page(limit, subject, purpose, status, cursor)
 
         try:
-            # remove entries whose keys are gone
-            ids = self._r.zrange(self._index_key(), 0, -1)
-            removed = 0
-            pipe = self._r.pipeline()
-            for oid in ids:
-                exists = self._r.exists(self._key(oid))
-                if not exists:
-                    pipe.zrem(self._index_key(), oid)
-                    removed += 1
-            if removed:
-                pipe.execute()
+            active_key, all_key, used_key = self._status_keys()
+            base = {'active': active_key, 'used': used_key}.get(status, all_key)
+            keys = self._filter_keys(subject, purpose) + [base]
+            min_score, cursor_id = _parse_cursor(cursor, int(time.time()))
+            scratch = f"{self.ns}:tmp:list:{uuid.uuid4().hex}"
+            flat = self.scripts('list', keys=keys + [scratch], args=[min_score, cursor_id, limit])
+
+            page = list(zip(flat[0::2], flat[1::2]))
+            next_cursor = None
+            if len(page) > limit:
+                page = page[:limit]
+                last_id, last_score = page[-1]
+                next_cursor = f"{int(float(last_score))}:{last_id}"
+
+            pipe = self._r.pipeline(transaction=False)
+            for oid, _ in page:
+                pipe.hgetall(self._key(oid))
+            out = [{"id": oid, **meta} for (oid, _), meta in zip(page, pipe.execute()) if meta]
+            return out, next_cursor
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return self._fallback.list_page(limit, subject, purpose, status, cursor)
+
+    def purge_index(self, max_seconds: Optional[float] = None) -> int:
+        """Drop expired members from the expiry indexes in bounded chunks.
+
+        Each chunk is one Lua call removing at most PURGE_BATCH_SIZE members by
+        rank (members are scored by expiry, so expired ones come first). A run
+        stops once max_seconds is spent and the next run resumes the SCAN over
+        subject/purpose indexes where this one stopped.
+        """
+        started = time.monotonic()
+        if self._use_fallback:
+            removed = self._fallback.purge_index()
+            self._record_purge(removed, True, started)
             return removed
-        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
-            print("⚠️  Redis connection lost, switching to fallback storage")
-            self._use_fallback = True
-            return self._fallback.purge_index()
+
+        s = get_settings()
+        deadline = started + (s.purge_max_seconds if max_seconds is None else max_seconds)
+        now = int(time.time())
+        removed = 0
+        complete = False
+        try:
+            if self._purge_scan_cursor is None:
+                # start of a pass: the shared indexes first
+                done, removed = self._purge_keys(self._status_keys(), now, s.purge_batch_size, deadline)
+                if done:
+                    self._purge_scan_cursor = 0
+            while self._purge_scan_cursor is not None and time.monotonic() < deadline:
+                cursor, keys = self._r.scan(self._purge_scan_cursor, match=f"{self.ns}:idx:*", count=200)
+                done, n = self._purge_keys(keys, now, s.purge_batch_size, deadline)
+                removed += n
+                if not done:
+                    # out of time mid-page; the page is redone next run
+                    break
+                if not cursor:
+                    self._purge_scan_cursor = None
+                    complete = True
+                    break
+                self._purge_scan_cursor = cursor
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+        self._record_purge(removed, complete, started)
+        return removed
+
+    def _purge_keys(self, keys, now: int, batch: int, deadline: float) -> Tuple[bool, int]:
+        removed = 0
+        for key in keys:
+            while True:
+                if time.monotonic() >= deadline:
+                    return False, removed
+                n, left = self.scripts('purge', keys=[key], args=[now, batch])
+                removed += n
+                if not left:
+                    break
+        return True, removed
+
+    def _record_purge(self, removed: int, complete: bool, started: float) -> None:
+        PURGE_REMOVED.inc(removed)
+        self.purge_progress = {
+            "last_run": int(time.time()),
+            "removed": removed,
+            "complete": complete,
+            "duration_ms": round((time.monotonic() - started) * 1000, 2),
+        }
+
+    def backfill_indexes(self, max_seconds: Optional[float] = None) -> bool:
+        """Add OTPs issued before the all/used/subject/purpose indexes existed to them.
+
+        Listings read those indexes, so without this such OTPs would only show up
+        under status=active until they expire. Runs in bounded SCAN chunks over the
+        OTP hashes, holding a short lock so one replica does the work, and records
+        completion in Redis so it happens once per namespace. Returns True when done.
+        """
+        if self._use_fallback:
+            return False
+        deadline = time.monotonic() + (get_settings().purge_max_seconds if max_seconds is None else max_seconds)
+        done_key, lock_key = f"{self.ns}:meta:idx_backfilled", f"{self.ns}:lock:idx_backfill"
+        prefix = f"{self.ns}:otp:"
+        try:
+            if self._r.exists(done_key):
+                return True
+            if not self._r.set(lock_key, self._backfill_token, nx=True, ex=60):
+                if self._r.get(lock_key) != self._backfill_token:
+                    return False
+                self._r.expire(lock_key, 60)
+            while time.monotonic() < deadline:
+                cursor, keys = self._r.scan(self._backfill_cursor, match=f"{prefix}*", count=200)
+                if keys:
+                    pipe = self._r.pipeline(transaction=False)
+                    for key in keys:
+                        pipe.hmget(key, "subject", "purpose")
+                    metas = pipe.execute()
+                    pipe = self._r.pipeline(transaction=False)
+                    for key, (subject, purpose) in zip(keys, metas):
+                        self.scripts('index_backfill', keys=[key, *self._status_keys(), *self._filter_keys(subject, purpose)],
+                                     args=[key[len(prefix):]], client=pipe)
+                    self._backfill_added += sum(pipe.execute())
+                self._backfill_cursor = cursor
+                if not cursor:
+                    self._r.set(done_key, str(int(time.time())))
+                    self._r.delete(lock_key)
+                    print(f"✅ Listing indexes backfilled ({self._backfill_added} older OTPs added)")
+                    return True
+            return False
+        except REDIS_ERRORS as e:
+            self.handle_redis_error(e)
+            return False
+
+    def _run_backfill(self) -> Optional[float]:
+        if self.backfill_indexes():
+            self.backfill_job.stop()
+            return None
+        # keep going soon while unfinished
+        return 1.0
+
+    def _run_purge(self) -> Optional[float]:
+        self.purge_index()
+        # keep going soon while a pass is unfinished
+        return None if self.purge_progress["complete"] else 1.0
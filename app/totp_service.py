@@ -1,49 +1,127 @@
 import base64
+import hashlib
 import hmac
+import logging
+import os
+import secrets
 import struct
+import threading
 import time
-from typing import Tuple, Optional
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Optional
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 from .config import get_settings
+from .metrics import TOTP_VERIFY_DURATION, observe_duration
+
+logger = logging.getLogger(__name__)
+
+
+class _StepTable:
+    """Codes of one secret around a counter, computed lazily in 0, -1, +1, -2, +2, ...
+    order and shared by every token checked against that secret."""
+
+    __slots__ = ("_service", "_keyed", "_counter", "_offsets", "_next", "_codes")
+
+    def __init__(self, service: "TOTPService", keyed: hmac.HMAC, counter: int, window: int):
+        self._service = service
+        self._keyed = keyed
+        self._counter = counter
+        self._offsets = [0] + [o for step in range(1, window + 1) for o in (-step, step)]
+        self._next = 0
+        self._codes: Dict[int, int] = {}
+
+    def find(self, expected: int) -> Optional[int]:
+        step = self._codes.get(expected)
+        if step is not None:
+            return step
+        while self._next < len(self._offsets):
+            step = self._counter + self._offsets[self._next]
+            self._next += 1
+            code = self._service._code_at(self._keyed, step)
+            # keep the step closest to now if two steps share a code
+            self._codes.setdefault(code, step)
+            if code == expected:
+                return step
+        return None
 
 
 class TOTPService:
     def __init__(self):
-        self.settings = get_settings()
         self.time_step = 30  # TOTP standard time step (30 seconds)
         self.digits = 6      # TOTP standard digits
+        # sha256(secret) -> HMAC-SHA1 object already keyed with the decoded secret.
+        # Copying it per time step skips both the base32 decode and the key setup.
+        self._keys: "OrderedDict[bytes, hmac.HMAC]" = OrderedDict()
+        self._keys_lock = threading.Lock()
+        # account -> (enrollment id, secret) for server-side enrollments, so a verify
+        # usually needs a single Redis round trip (the atomic step check)
+        self._enrollments: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+
+    @property
+    def settings(self):
+        # Always read the current snapshot so a settings reload takes effect
+        return get_settings()
 
     def generate_secret(self, length: int = 32) -> str:
         """Generate a random secret key for TOTP."""
-        import secrets
         return base64.b32encode(secrets.token_bytes(length)).decode('utf-8')
 
+    def _cipher(self) -> AESGCM:
+        # AES-256-GCM key derived from the pepper, separate from its use in OTP hashing
+        key = hashlib.sha256(b"otp-service:totp-secret:" + self.settings.otp_pepper.encode('utf-8')).digest()
+        return AESGCM(key)
+
+    def encrypt_secret(self, secret: str, account_name: str) -> str:
+        """Encrypt a secret for storage; the account name is bound as associated data."""
+        nonce = os.urandom(12)
+        sealed = self._cipher().encrypt(nonce, secret.encode('utf-8'), account_name.encode('utf-8'))
+        return base64.b64encode(nonce + sealed).decode('ascii')
+
+    def decrypt_secret(self, blob: str, account_name: str) -> str:
+        raw = base64.b64decode(blob)
+        return self._cipher().decrypt(raw[:12], raw[12:], account_name.encode('utf-8')).decode('utf-8')
+
+    def _keyed_hmac(self, secret: str) -> hmac.HMAC:
+        """Keyed HMAC-SHA1 for a base32 secret, from a bounded LRU cache.
+
+        The cache key is a hash of the secret so raw secrets are never kept as
+        dict keys. Raises ValueError (binascii.Error) for an invalid secret.
+        """
+        digest = hashlib.sha256(secret.encode('utf-8')).digest()
+        with self._keys_lock:
+            keyed = self._keys.get(digest)
+            if keyed is not None:
+                self._keys.move_to_end(digest)
+                return keyed
+
+        keyed = hmac.new(base64.b32decode(secret.upper()), digestmod='sha1')
+        with self._keys_lock:
+            self._keys[digest] = keyed
+            while len(self._keys) > self.settings.totp_key_cache_size:
+                self._keys.popitem(last=False)
+        return keyed
+
+    def _code_at(self, keyed: hmac.HMAC, counter: int) -> int:
+        mac = keyed.copy()
+        mac.update(struct.pack('>Q', counter))
+        hmac_result = mac.digest()
+
+        # Dynamic truncation (RFC 4226): 4 bytes at the offset given by the low nibble
+        offset = hmac_result[-1] & 0xf
+        code = struct.unpack('>L', hmac_result[offset:offset + 4])[0] & 0x7fffffff
+        return code % (10 ** self.digits)
+
     def get_totp_token(self, secret: str, current_time: Optional[int] = None) -> str:
         """Generate a TOTP token for the given secret and time."""
         if current_time is None:
             current_time = int(time.time())
-        
-        # Calculate counter value (number of time steps since epoch)
-        time_counter = struct.pack('>Q', current_time // self.time_step)
-        
-        # Decode base32 secret
-        key = base64.b32decode(secret.upper())
-        
-        # Calculate HMAC-SHA1
-        hmac_obj = hmac.new(key, time_counter, 'sha1')
-        hmac_result = hmac_obj.digest()
-        
-        # Get offset
-        offset = hmac_result[-1] & 0xf
-        
-        # Generate 4-byte code
-        code_bytes = hmac_result[offset:offset + 4]
-        code = struct.unpack('>L', code_bytes)[0]
-        
-        # Apply modulus to get the desired number of digits
-        code = code & 0x7fffffff
-        code = code % (10 ** self.digits)
-        
+
+        # Counter value is the number of time steps since epoch
+        code = self._code_at(self._keyed_hmac(secret), current_time // self.time_step)
+
         # Return code with leading zeros if necessary
         return str(code).zfill(self.digits)
 
@@ -58,15 +136,8 @@ class TOTPService:
             Tuple of (is_valid, reason)
         """
         try:
-            token = str(token).zfill(self.digits)
-            current_time = int(time.time())
-
-            # Check tokens in time window
-            for offset in range(-window, window + 1):
-                check_time = current_time + (offset * self.time_step)
-                if self.get_totp_token(secret, check_time) == token:
-                    return True, "ok"
-
+            if self.match_step(secret, token, window) is not None:
+                return True, "ok"
             return False, "invalid_token"
 
         except (ValueError, TypeError):
@@ -74,6 +145,205 @@ class TOTPService:
         except Exception as e:
             return False, f"verification_error: {str(e)}"
 
+    def match_step(self, secret: str, token: str, window: int = 1) -> Optional[int]:
+        """Time step (counter) at which token is valid within the window, or None."""
+        token = str(token)
+        # Callers validate the window; the cap here keeps any other path from widening it
+        window = max(0, min(window, self.settings.totp_max_window))
+        # A token that cannot match any step is rejected before any HMAC is computed
+        if not token.isdigit() or len(token) > self.digits:
+            return None
+        expected = int(token)
+        keyed = self._keyed_hmac(secret)
+        counter = int(time.time()) // self.time_step
+
+        # Most tokens match the current step, so check 0, -1, +1, -2, +2, ... and stop at the first hit
+        if self._code_at(keyed, counter) == expected:
+            return counter
+        for step in range(1, window + 1):
+            if self._code_at(keyed, counter - step) == expected:
+                return counter - step
+            if self._code_at(keyed, counter + step) == expected:
+                return counter + step
+        return None
+
+    def enroll(self, storage, account_name: str, issuer: str, replace: bool = False) -> Optional[Tuple[str, str]]:
+        """
+        Create the server-side enrollment of an account; an existing one is only
+        overwritten with replace=True
+        Returns: (enrollment_id, secret), or None if the account is already enrolled
+        """
+        secret = self.generate_secret()
+        enrollment_id = "totp_" + secrets.token_urlsafe(12)
+        saved = storage.save_totp(account_name, {
+            "id": enrollment_id,
+            "secret": self.encrypt_secret(secret, account_name),
+            "issuer": issuer,
+            "created_at": str(int(time.time())),
+        }, qr_ttl=self.settings.totp_qr_ttl_seconds, replace=replace)
+        if not saved:
+            return None
+        self._remember(account_name, enrollment_id, secret)
+        return enrollment_id, secret
+
+    def _remember(self, account_name: str, enrollment_id: str, secret: str) -> None:
+        with self._keys_lock:
+            self._enrollments[account_name] = (enrollment_id, secret)
+            self._enrollments.move_to_end(account_name)
+            while len(self._enrollments) > self.settings.totp_key_cache_size:
+                self._enrollments.popitem(last=False)
+
+    def _enrollment(self, storage, account_name: str, refresh: bool) -> Tuple[Optional[Tuple[str, str]], bool]:
+        """((enrollment_id, secret) or None, whether it came from the local cache)"""
+        if not refresh:
+            with self._keys_lock:
+                enrollment = self._enrollments.get(account_name)
+                if enrollment is not None:
+                    self._enrollments.move_to_end(account_name)
+                    return enrollment, True
+        fields = storage.get_totp(account_name)
+        if not fields:
+            with self._keys_lock:
+                self._enrollments.pop(account_name, None)
+            return None, False
+        secret = self.decrypt_secret(fields["secret"], account_name)
+        self._remember(account_name, fields["id"], secret)
+        return (fields["id"], secret), False
+
+    def enrollment_uri(self, storage, enrollment_id: str) -> Optional[Tuple[str, int]]:
+        """(otpauth URI, seconds it may still be served) for a recent enrollment, or None."""
+        ref = storage.get_totp_qr_account(enrollment_id)
+        if ref is None:
+            return None
+        account_name, remaining = ref
+        fields = storage.get_totp(account_name)
+        # the account may have re-enrolled since
+        if not fields or fields.get("id") != enrollment_id:
+            return None
+        secret = self.decrypt_secret(fields["secret"], account_name)
+        return self.get_totp_uri(secret, account_name, fields.get("issuer") or None), remaining
+
+    def verify_enrolled(self, storage, account_name: str, token: str, window: int = 1) -> Tuple[bool, str]:
+        """
+        Verify a token against the account's stored enrollment and record its time step,
+        so the same token (or an older one) is never accepted twice
+        Returns:
+            Tuple of (is_valid, reason)
+        """
+        try:
+            # The cached enrollment may be outdated if the account re-enrolled on another
+            # replica: a mismatch or a 'stale' answer re-reads it from storage once
+            refresh = False
+            while True:
+                enrollment, from_cache = self._enrollment(storage, account_name, refresh)
+                if enrollment is None:
+                    return False, "not_enrolled"
+                enrollment_id, secret = enrollment
+                step = self.match_step(secret, token, window)
+                if step is None:
+                    if from_cache:
+                        refresh = True
+                        continue
+                    return False, "invalid_token"
+                result = storage.accept_totp_step(account_name, enrollment_id, step)
+                if result == "ok":
+                    return True, "ok"
+                if result == "replay":
+                    return False, "replayed_token"
+                if not from_cache:
+                    return False, "not_enrolled"
+                refresh = True
+
+        except InvalidTag:
+            logger.error("Cannot decrypt the TOTP secret of %s (was OTP_PEPPER changed?)", account_name)
+            return False, "verification_error: undecryptable secret"
+        except (ValueError, TypeError):
+            return False, "invalid_format"
+
+    def verify_batch(self, storage, items: List[Tuple[Optional[str], Optional[str], str, int]]) -> List[Tuple[bool, str]]:
+        """
+        Verify many tokens at once
+        Args:
+            items: (account_name, secret, token, window) tuples; account_name selects the stored
+                   enrollment (with replay protection), otherwise secret is used statelessly
+        Returns:
+            Per-item (is_valid, reason), in input order
+
+        The time step is computed once for the whole batch, codes are computed once per
+        (secret, window) and shared by all tokens of that secret, and enrollments are read
+        and their steps recorded in one pipelined storage call each.
+        """
+        counter = int(time.time()) // self.time_step
+        results: List[Optional[Tuple[bool, str]]] = [None] * len(items)
+
+        # Resolve enrollments for every account in the batch with one storage read
+        enrollments: Dict[str, Optional[Tuple[str, str]]] = {}
+        undecryptable = set()
+        accounts = {account for account, _, _, _ in items if account}
+        for account, fields in (storage.get_totp_many(accounts) if accounts else {}).items():
+            if not fields:
+                enrollments[account] = None
+                continue
+            try:
+                secret = self.decrypt_secret(fields["secret"], account)
+            except (InvalidTag, ValueError):
+                logger.error("Cannot decrypt the TOTP secret of %s (was OTP_PEPPER changed?)", account)
+                undecryptable.add(account)
+                continue
+            enrollments[account] = (fields["id"], secret)
+            self._remember(account, fields["id"], secret)
+
+        tables: Dict[Tuple[str, int], Optional[_StepTable]] = {}
+        pending: List[Tuple[int, Tuple[str, str, int]]] = []
+        for i, (account, secret, token, window) in enumerate(items):
+            started = time.time()
+            if account:
+                if account in undecryptable:
+                    results[i] = (False, "verification_error: undecryptable secret")
+                    continue
+                enrollment = enrollments.get(account)
+                if enrollment is None:
+                    results[i] = (False, "not_enrolled")
+                    continue
+                enrollment_id, secret = enrollment
+            token = str(token)
+            if not token.isdigit() or len(token) > self.digits:
+                results[i] = (False, "invalid_token")
+                continue
+
+            window = max(0, min(window, self.settings.totp_max_window))
+            key = (secret, window)
+            if key not in tables:
+                try:
+                    tables[key] = _StepTable(self, self._keyed_hmac(secret), counter, window)
+                except (ValueError, TypeError):
+                    tables[key] = None
+            table = tables[key]
+            if table is None:
+                results[i] = (False, "invalid_format")
+                continue
+
+            step = table.find(int(token))
+            observe_duration(TOTP_VERIFY_DURATION, time.time() - started)
+            if step is None:
+                results[i] = (False, "invalid_token")
+            elif account:
+                pending.append((i, (account, enrollment_id, step)))
+            else:
+                results[i] = (True, "ok")
+
+        # Record accepted steps in submission order; a repeated token in the batch is a replay
+        if pending:
+            outcomes = storage.accept_totp_steps(entry for _, entry in pending)
+            for (i, _), outcome in zip(pending, outcomes):
+                if outcome == "ok":
+                    results[i] = (True, "ok")
+                elif outcome == "replay":
+                    results[i] = (False, "replayed_token")
+                else:
+                    results[i] = (False, "not_enrolled")
+        return results
+
     def get_totp_uri(self, secret: str, account_name: str, issuer: str = None) -> str:
         """
         Generate a TOTP URI for QR code generation.
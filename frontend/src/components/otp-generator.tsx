@@ -375,7 +375,7 @@ export function OTPGenerator() {
                       const res = await fetch(`${API_BASE_URL}/api/v1/totp/verify`, {
                         method: 'POST',
                         headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ secret: totpData.secret, token: totpToken })
+                        body: JSON.stringify({ account_name: totpData.account_name, token: totpToken })
                       })
                       const json = await res.json()
                       if (json.valid) {
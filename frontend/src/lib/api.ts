@@ -8,6 +8,8 @@ export interface GenerateOTPResponse {
   email_sent?: boolean;
   email_message?: string;
   email_error?: string;
+  email_status?: 'queued';
+  email_job_id?: string;
 }
 
 export interface VerifyOTPResponse {
@@ -18,6 +20,7 @@ export interface VerifyOTPResponse {
 }
 
 export interface TOTPSetupResponse {
+  enrollment_id: string;
   secret: string;
   uri: string;
   qr_code: string;
@@ -89,7 +92,8 @@ export const api = {
   },
 
   verifyTOTP: async (data: {
-    secret: string;
+    account_name?: string;
+    secret?: string;
     token: string;
     window?: number;
   }): Promise<VerifyOTPResponse> => {
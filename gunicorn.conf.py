@@ -0,0 +1,106 @@
+"""
+Gunicorn configuration (production entry point)
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+Defaults suit a container: gthread workers sized from the CPU quota, the app
+preloaded in the master so workers share its memory copy-on-write, and
+background services (email dispatcher, Redis heartbeat, purge, samplers)
+started in each worker after the fork and drained when it exits. Every value
+can be overridden with the environment variables read below; see
+docs/DEPLOYMENT.md for the measurements behind them.
+
+With PROMETHEUS_MULTIPROC_DIR set, every worker writes its metrics to that
+directory; the hooks below wipe it when the master starts and drop a worker's
+live gauges when it exits.
+"""
+import math
+import os
+
+from dotenv import load_dotenv
+
+# The multiprocess directory must be known before prometheus_client is imported
+load_dotenv()
+
+from app import jobs, metrics  # noqa: E402
+
+
+def cpu_quota() -> int:
+    """CPUs this container may use: the cgroup quota if any, else the CPUs we are pinned to."""
+    try:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(1, math.ceil(int(quota) / int(period)))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                return max(1, math.ceil(quota / period))
+        except (OSError, ValueError):
+            pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '8000')}"
+
+# gthread: a few threads per process overlap Redis/SMTP waits while the GIL limits each
+# process to one CPU. gevent (pip install gevent) suits many slow, mostly idle clients.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", str(cpu_quota() + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Preloading imports the app once in the master; it is skipped for gevent, whose monkey
+# patching has to happen before the app creates its locks and threads.
+preload_app = os.getenv("GUNICORN_PRELOAD", "false" if worker_class == "gevent" else "true").lower() == "true"
+
+# Keep idle client connections open longer than the load balancer does (60s on most),
+# so the balancer never reuses a connection gunicorn has just closed
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "65"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+errorlog = "-"
+
+
+def on_starting(server):
+    if workers > 1 and not metrics.MULTIPROC_DIR:
+        server.log.warning("PROMETHEUS_MULTIPROC_DIR is not set: /metrics will only show the worker serving the scrape")
+    metrics.clear_multiproc_dir()
+
+
+def when_ready(server):
+    # With preload_app the app's background threads started in the master; they would not
+    # survive the fork anyway, and the master serves no requests
+    jobs.stop_all(timeout=1)
+
+
+def post_worker_init(worker):
+    # Runs after the fork (and after gevent's monkey patching): pick up the current .env,
+    # so a HUP to the master (which replaces the workers) also reloads settings, and
+    # (re)start the background services in this worker. Starting them also re-publishes
+    # state gauges such as otp_storage_fallback, whose master-side values on_starting wiped
+    if preload_app:
+        from app import main
+        main._reload_settings()
+    jobs.start_all()
+
+
+def worker_exit(server, worker):
+    # In-flight requests are done; let queued emails go out before the master's
+    # graceful_timeout runs out
+    jobs.stop_all(timeout=max(1, graceful_timeout - 5))
+
+
+def child_exit(server, worker):
+    metrics.mark_process_dead(worker.pid)